@@ -0,0 +1,644 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2018 Jaguar Land Rover
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import argparse
+import ast
+import collections
+import os
+import socket
+import tempfile
+import threading
+import time
+import tracemalloc
+import zmq
+import ipc
+import ipc.shm
+import ipc.stream
+import ipc.zeromq
+import vsm
+import vsmlib.expression
+import vsmlib.windows
+import vsmlib.history
+import vsmlib.scheduler
+import vsmlib.staleness
+
+TIME_TRAVEL_RULE = '''
+- parallel:
+    - condition: >
+        (
+        speed.value >= (88 - 10) * 1.6 &&
+        speed.value <  88 * 1.6
+        ) ||
+        (
+        flux_capacitor.energy_generated >= 1.21 * 0.9 &&
+        flux_capacitor.energy_generated < 1.21
+        )
+      emit:
+          signal: lights.internal.time_travel_imminent.{index}
+          value: true
+
+    - condition: >
+        flux_capacitor.energy_generated >= 1.21 * 0.9 &&
+        !(flux_capacitor.energy_generated >= 1.21)
+      emit:
+          signal: lights.external.time_travel_imminent.{index}
+          value: true
+'''
+
+
+class NullIPC(ipc.IPC):
+    """IPC module discarding all the signals sent by the VSM."""
+
+    def send(self, signal, value):
+        pass
+
+
+class EchoIPC(ipc.IPC):
+    """IPC module keeping the signals sent by the VSM to send them back."""
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, signal, value):
+        self.sent.append((signal, value))
+
+
+class ZeromqPeer(ipc.IPC):
+    """Other end of the ZeromqIPC socket."""
+
+    def __init__(self):
+        self._context = zmq.Context()
+        self._socket = self._context.socket(zmq.PAIR)
+        self._socket.connect(ipc.zeromq.SOCKET_ADDR)
+
+    def close(self):
+        self._socket.close()
+
+    def send(self, signal, value):
+        self._socket.send_pyobj((signal, value))
+
+    def receive(self):
+        return self._socket.recv_pyobj()
+
+
+def _set_up_vsm(signals):
+    vsm.signal_to_num = {signal: num for num, signal in enumerate(signals)}
+    vsm.logger = vsm.Logger(os.open(os.devnull, os.O_WRONLY))
+    vsm.ipc_obj = NullIPC()
+
+
+def _load_state(rules, **kwargs):
+    vsm.config_tree = vsm.TreeNode(vsm.NODE_ROOT, None)
+    vsm.node_refs.clear()
+    with tempfile.NamedTemporaryFile('w', suffix='.yaml') as rules_file:
+        rules_file.write(rules)
+        rules_file.flush()
+        return vsm.State(None, rules_file.name, **kwargs)
+
+
+def _run_signals(state, signals, count):
+    start = time.perf_counter()
+    for i in range(count):
+        state.got_signal(*signals[i % len(signals)])
+    return (time.perf_counter() - start) * 1000
+
+
+def _eval_expressions(state, signals, count):
+    """Only evaluate the condition expressions, like State.got_signal()."""
+    # the rules are only subscribed to their signals once these are all set
+    for signal, value in signals:
+        state.got_signal(signal, value)
+    variables = dict(signals)
+    start = time.perf_counter()
+    for i in range(count):
+        signal, value = signals[i % len(signals)]
+        variables[signal] = value
+        results = {}
+        for rule in state.rules[signal]:
+            expression = state.rule_conditions[rule].expression
+            if id(expression) not in results:
+                results[id(expression)] = expression(variables)
+    return (time.perf_counter() - start) * 1000
+
+
+def _print_result(name, duration_ms, count):
+    print("{:<32} {:10.1f} ms {:10.2f} us/signal".format(
+        name, duration_ms, duration_ms * 1000 / count))
+
+
+def bench_optimizer(args):
+    """Rule evaluation with and without the rules optimizer."""
+    rules = ''.join(TIME_TRAVEL_RULE.format(index=i)
+                    for i in range(args.scale))
+    signals = ['speed.value', 'flux_capacitor.energy_generated']
+    for i in range(args.scale):
+        signals.append('lights.internal.time_travel_imminent.{}'.format(i))
+        signals.append('lights.external.time_travel_imminent.{}'.format(i))
+    _set_up_vsm(signals)
+
+    # values chosen to keep all the conditions false, so nothing is emitted
+    inputs = [('speed.value', 50), ('flux_capacitor.energy_generated', 0.5),
+              ('speed.value', 150), ('flux_capacitor.energy_generated', 2.0)]
+
+    print("{} conditions, {} signals".format(args.scale * 2, args.count))
+    for optimize in (False, True):
+        state = _load_state(rules, optimize=optimize)
+        expressions = set(id(c.expression)
+                          for c in state.rule_conditions.values())
+        name = "optimize={} ({} expr)".format(optimize, len(expressions))
+        duration_ms = _eval_expressions(state, inputs, args.count)
+        _print_result(name + " eval", duration_ms, args.count)
+        duration_ms = _run_signals(state, inputs, args.count)
+        _print_result(name + " total", duration_ms, args.count)
+
+
+# condition expressions as translated from the rules files, with the names of
+# the signals they use
+EVALUATOR_CONDITIONS = [
+    'speed_value >= (88 - 10) * 1.6 and speed_value < 88 * 1.6',
+    'flux_capacitor_energy_generated >= 1.21 * 0.9 and '
+    'not flux_capacitor_energy_generated >= 1.21',
+]
+EVALUATOR_NAMES = {
+    'speed_value': 'speed.value',
+    'flux_capacitor_energy_generated': 'flux_capacitor.energy_generated',
+}
+
+
+def _legacy_evaluator(condition):
+    """Condition evaluation as done before the restricted compiler: eval() of
+    the expression with an undotted copy of the variables, then exec() of the
+    rule."""
+    expression = compile(condition, '<string>', 'eval')
+    rule = compile('if __condition_result__:\n    pass\n', '<string>', 'exec')
+
+    def evaluate(variables):
+        namespace = {k.replace('.', '_'): v for k, v in variables.items()}
+        namespace['__condition_result__'] = eval(expression, {}, namespace)
+        exec(rule, {}, namespace)
+    return evaluate
+
+
+def _compiled_evaluator(condition):
+    expression = vsmlib.expression.compile_expression(
+        ast.parse(condition, mode='eval').body, EVALUATOR_NAMES)
+
+    def rule(result):
+        pass
+
+    def evaluate(variables):
+        rule(expression(variables))
+    return evaluate
+
+
+def bench_evaluator(args):
+    """Condition evaluation with eval()/exec() and with compiled functions."""
+    conditions = [EVALUATOR_CONDITIONS[i % len(EVALUATOR_CONDITIONS)]
+                  for i in range(args.scale)]
+    variables = {'speed.value': 50, 'flux_capacitor.energy_generated': 0.5}
+
+    print("{} conditions, {} signals".format(args.scale, args.count))
+    for name, make in (('eval/exec', _legacy_evaluator),
+                       ('compiled', _compiled_evaluator)):
+        evaluators = [make(condition) for condition in conditions]
+        start = time.perf_counter()
+        for i in range(args.count):
+            variables['speed.value'] = i % 200
+            for evaluate in evaluators:
+                evaluate(variables)
+        _print_result(name, (time.perf_counter() - start) * 1000, args.count)
+
+
+def bench_predicates(args):
+    """Rule evaluation with and without the predicate index."""
+    gears = ['park', 'reverse', 'neutral', 'drive']
+    rules = ''
+    for i in range(args.scale):
+        rules += '- condition: speed.value > {}\n'.format(i * 2)
+        rules += '- condition: speed.value <= {}\n'.format(i * 2 + 1)
+        rules += "- condition: transmission.gear == '{}{}'\n".format(
+            gears[i % len(gears)], i // len(gears))
+    _set_up_vsm(['speed.value', 'transmission.gear'])
+
+    # the speed slowly changes, the gear seldom does
+    inputs = []
+    for i in range(100):
+        inputs.append(('speed.value', args.scale + i % 10))
+        inputs.append(('transmission.gear', 'drive0' if i < 50 else 'park0'))
+
+    print("{} conditions, {} signals".format(args.scale * 3, args.count))
+    for index in (False, True):
+        state = _load_state(rules, index_predicates=index)
+        duration_ms = _run_signals(state, inputs, args.count)
+        _print_result("index_predicates={}".format(index), duration_ms,
+                      args.count)
+
+
+NESTED_RULE = '''
+- condition: enabled_{index} == true
+  parallel:
+    - condition: b > 10
+      parallel:
+        - condition: c > 10
+          parallel:
+            - condition: d > 10
+'''
+
+
+def bench_frames(args):
+    """Signals of a CAN frame processed one at a time or as one frame."""
+    signals = ['can_{}'.format(i) for i in range(8)]
+    rules = ''.join('- condition: {} > {} && {} < {}\n'.format(
+        signals[i % 8], i, signals[(i + 1) % 8], i + 10)
+        for i in range(args.scale))
+    _set_up_vsm(signals)
+
+    frames = [{signal: (i * 7 + j) % args.scale
+               for j, signal in enumerate(signals)} for i in range(16)]
+    count = args.count // len(signals)
+    print("{} conditions, {} frames of {} signals".format(
+        args.scale, count, len(signals)))
+
+    state = _load_state(rules)
+    start = time.perf_counter()
+    for i in range(count):
+        for signal, value in frames[i % len(frames)].items():
+            state.got_signal(signal, value)
+    duration_ms = (time.perf_counter() - start) * 1000
+    _print_result("one signal at a time", duration_ms, count)
+
+    state = _load_state(rules)
+    start = time.perf_counter()
+    for i in range(count):
+        state.got_frame(frames[i % len(frames)])
+    duration_ms = (time.perf_counter() - start) * 1000
+    _print_result("one frame at a time", duration_ms, count)
+
+
+def bench_gating(args):
+    """Evaluation of nested conditions while their parents are met or not."""
+    rules = ''.join(NESTED_RULE.format(index=i) for i in range(args.scale))
+    enabled = ['enabled_{}'.format(i) for i in range(args.scale)]
+    _set_up_vsm(enabled + ['b', 'c', 'd'])
+
+    inputs = [(signal, value) for value in (20, 5)
+              for signal in ('b', 'c', 'd')]
+
+    print("{} nested conditions, {} signals".format(args.scale * 4,
+                                                    args.count))
+    for active in (False, True):
+        state = _load_state(rules)
+        for signal in enabled:
+            state.got_signal(signal, active)
+        duration_ms = _run_signals(state, inputs, args.count)
+        _print_result("parents met={}".format(active), duration_ms,
+                      args.count)
+
+
+def bench_sequence(args):
+    """Signal updates for the steps of a long sequence."""
+    steps = ['step_{}'.format(i) for i in range(args.scale)]
+    rules = '- sequence:\n' + ''.join(
+        '    - condition: {} == true\n'.format(step) for step in steps)
+    _set_up_vsm(steps)
+
+    # the first step is never met, so all the other updates are blocked
+    inputs = [(step, True) for step in steps[1:]]
+    state = _load_state(rules)
+    duration_ms = _run_signals(state, inputs, args.count)
+    _print_result("{} steps, blocked".format(args.scale), duration_ms,
+                  args.count)
+
+    # each step is met in turn
+    inputs = [(step, True) for step in steps]
+    state = _load_state(rules)
+    duration_ms = _run_signals(state, inputs, args.count)
+    _print_result("{} steps, in order".format(args.scale), duration_ms,
+                  args.count)
+
+
+def bench_startup(args):
+    """Signal updates while the other signals of the conditions are unset."""
+    sensors = ['sensor_{}'.format(i) for i in range(args.scale)]
+    rules = ''.join('- condition: {} == true && speed > {}\n'.format(sensor, i)
+                    for i, sensor in enumerate(sensors))
+    _set_up_vsm(sensors + ['speed'])
+
+    inputs = [('speed', value) for value in range(args.scale)]
+    for sensors_set in (False, True):
+        state = _load_state(rules)
+        if sensors_set:
+            for sensor in sensors:
+                state.got_signal(sensor, False)
+        duration_ms = _run_signals(state, inputs, args.count)
+        _print_result("{} conditions, sensors set={}".format(
+            args.scale, sensors_set), duration_ms, args.count)
+
+
+def bench_propagation(args):
+    """Chains of rules emitting the signal of the next rule."""
+    links = ['link_{}'.format(i) for i in range(args.scale + 1)]
+    rules = ''.join('- condition: {} == true\n'
+                    '  emit:\n'
+                    '    signal: {}\n'
+                    '    value: true\n'.format(signal, next_signal)
+                    for signal, next_signal in zip(links, links[1:]))
+    _set_up_vsm(links)
+
+    # the emitted signals sent back by another process, without the transport
+    echo = EchoIPC()
+    vsm.ipc_obj = echo
+    state = _load_state(rules)
+    start = time.perf_counter()
+    for i in range(args.count):
+        state.got_signal(links[0], True)
+        while echo.sent:
+            vsm.process(state, *echo.sent.pop(0))
+    duration_ms = (time.perf_counter() - start) * 1000
+    _print_result("{} links, echoed".format(args.scale), duration_ms,
+                  args.count)
+
+    vsm.ipc_obj = NullIPC()
+    state = _load_state(rules, propagate_emits=True)
+    duration_ms = _run_signals(state, [(links[0], True)], args.count)
+    _print_result("{} links, propagated".format(args.scale), duration_ms,
+                  args.count)
+
+
+def _recomputed_aggregates(samples, now, length_ms):
+    values = [value for time_ms, value in samples if time_ms >= now - length_ms]
+    return sum(values) / len(values), min(values), max(values)
+
+
+def bench_windows(args):
+    """Windowed aggregates kept up to date or recomputed on each update."""
+    length_ms = args.scale * 10
+    print("window of {} values".format(args.scale))
+
+    # one value per 10 ms
+    clock = [0]
+    window = vsmlib.windows.SignalWindow(lambda: clock[0])
+    aggregates = [window.aggregate(function, length_ms)
+                  for function in ('avg', 'min', 'max')]
+    start = time.perf_counter()
+    for i in range(args.count):
+        clock[0] = i * 10
+        window.append(i % 97)
+        for aggregate in aggregates:
+            aggregate()
+    duration_ms = (time.perf_counter() - start) * 1000
+    _print_result("incremental", duration_ms, args.count)
+
+    samples = collections.deque(maxlen=vsmlib.windows.CAPACITY_DEFAULT)
+    start = time.perf_counter()
+    for i in range(args.count):
+        samples.append((i * 10, i % 97))
+        _recomputed_aggregates(samples, i * 10, length_ms)
+    duration_ms = (time.perf_counter() - start) * 1000
+    _print_result("recomputed", duration_ms, args.count)
+
+    # the same aggregates in conditions
+    rules = ''.join('- condition: {}(speed, {}) > 50\n'.format(function,
+                                                                length_ms)
+                    for function in ('avg', 'min', 'max'))
+    _set_up_vsm(['speed'])
+    state = _load_state(rules)
+    duration_ms = _run_signals(state, [('speed', i % 97) for i in range(97)],
+                               args.count)
+    _print_result("conditions", duration_ms, args.count)
+
+
+def bench_history(args):
+    """History of numeric signals in arrays or in deques of tuples."""
+    size = vsmlib.history.SIZE_DEFAULT
+    signals = ['signal.{}'.format(i) for i in range(args.scale)]
+    print("{} signals, {} values each".format(args.scale, size))
+
+    # enough values to fill the history of each signal
+    count = max(args.count, args.scale * size)
+    tracemalloc.start()
+    history = vsmlib.history.HistoryStore(size)
+    start = time.perf_counter()
+    for i in range(count):
+        history.record(signals[i % args.scale], i * 0.5, i)
+    duration_ms = (time.perf_counter() - start) * 1000
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    _print_result("arrays", duration_ms, count)
+    print("  {} kB".format(memory // 1024))
+    del history
+
+    tracemalloc.start()
+    deques = {}
+    start = time.perf_counter()
+    for i in range(count):
+        signal = signals[i % args.scale]
+        if signal not in deques:
+            deques[signal] = collections.deque(maxlen=size)
+        deques[signal].append((i, i * 0.5))
+    duration_ms = (time.perf_counter() - start) * 1000
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    _print_result("deques", duration_ms, count)
+    print("  {} kB".format(memory // 1024))
+
+
+def bench_staleness(args):
+    """Signal timeouts re-armed on each value, lazily or with a timer each."""
+    count = args.scale * 10
+    signals = ['signal.{}'.format(i) for i in range(count)]
+    print("{} signals".format(count))
+
+    def clock():
+        return time.perf_counter() * 1000
+
+    # the deadlines are only moved when they are reached
+    scheduler = vsmlib.scheduler.DeadlineScheduler(clock)
+    monitor = vsmlib.staleness.StalenessMonitor(clock, scheduler, print)
+    monitor.set_timeouts({signal: 60000 for signal in signals})
+    start = time.perf_counter()
+    for i in range(args.count):
+        monitor.received(signals[i % count])
+    duration_ms = (time.perf_counter() - start) * 1000
+    _print_result("staleness monitor", duration_ms, args.count)
+    monitor.set_timeouts({})
+
+    # cancelled and scheduled again on each value
+    deadlines = {signal: scheduler.schedule(clock() + 60000, print)
+                 for signal in signals}
+    start = time.perf_counter()
+    for i in range(args.count):
+        signal = signals[i % count]
+        scheduler.cancel(deadlines[signal])
+        deadlines[signal] = scheduler.schedule(clock() + 60000, print)
+    duration_ms = (time.perf_counter() - start) * 1000
+    _print_result("rescheduled", duration_ms, args.count)
+
+    # like delayed emits, a timer per value
+    timers = {}
+    start = time.perf_counter()
+    for i in range(args.count):
+        signal = signals[i % count]
+        if signal in timers:
+            timers[signal].cancel()
+        timers[signal] = threading.Timer(60, print)
+        timers[signal].start()
+    duration_ms = (time.perf_counter() - start) * 1000
+    _print_result("timers", duration_ms, args.count)
+    for timer in timers.values():
+        timer.cancel()
+
+
+def bench_temporal(args):
+    """Deadlines of held() on the shared scheduler or with a timer each."""
+    count = args.scale * 10
+    print("{} deadlines".format(count))
+
+    def clock():
+        return time.perf_counter() * 1000
+
+    # armed and cancelled before they are due, like the expression of a held()
+    # which becomes false again
+    scheduler = vsmlib.scheduler.DeadlineScheduler(clock)
+    start = time.perf_counter()
+    deadlines = [scheduler.schedule(clock() + 60000, print)
+                 for i in range(count)]
+    for deadline in deadlines:
+        scheduler.cancel(deadline)
+    duration_ms = (time.perf_counter() - start) * 1000
+    _print_result("scheduler", duration_ms, count)
+
+    start = time.perf_counter()
+    timers = [threading.Timer(60, print) for i in range(count)]
+    for timer in timers:
+        timer.start()
+    for timer in timers:
+        timer.cancel()
+    duration_ms = (time.perf_counter() - start) * 1000
+    _print_result("timers", duration_ms, count)
+    for timer in timers:
+        timer.join()
+
+    # conditions whose held() expression alternates between true and false
+    rules = ''.join('- condition: held(speed > {}, 60000)\n'.format(i)
+                    for i in range(count))
+    _set_up_vsm(['speed'])
+    state = _load_state(rules)
+    duration_ms = _run_signals(state, [('speed', 0), ('speed', count)],
+                               args.count)
+    _print_result("conditions", duration_ms, args.count)
+
+
+def _ipc_pair_shm(directory, count):
+    # big enough for all the signals, as the rings drop them when full
+    path = os.path.join(directory, 'ring')
+    return (lambda: ipc.shm.ShmRingIPC(path, slots=count),
+            lambda: ipc.shm.ShmRingIPC(path, peer=True))
+
+
+def _ipc_pair_socket(directory, count):
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    port = server.getsockname()[1]
+
+    def vsm_side():
+        conn, _ = server.accept()
+        stream = conn.makefile('rw')
+        return ipc.stream.StreamIPC(stream, stream)
+
+    return vsm_side, lambda: ipc.stream.SocketIPC('127.0.0.1', port)
+
+
+def _ipc_pair_zeromq(directory, count):
+    return ipc.zeromq.ZeromqIPC, ZeromqPeer
+
+
+def _receive(ipc_obj):
+    """Wait for a signal, as some modules may return without one."""
+    while True:
+        message = ipc_obj.receive()
+        if message is not ipc.NO_SIGNAL:
+            return message
+
+
+def _ipc_peer(make_peer, count):
+    """Receive the signals, then echo them for the latency test."""
+    peer = make_peer()
+    for i in range(count):
+        _receive(peer)
+    peer.send('done', count)
+    for i in range(count):
+        peer.send(*_receive(peer))
+    peer.close()
+
+
+def bench_ipc(args):
+    """Throughput and latency of the IPC modules between two processes."""
+    pairs = [('shm', _ipc_pair_shm), ('socket', _ipc_pair_socket),
+             ('zeromq', _ipc_pair_zeromq)]
+    print("{} signals".format(args.count))
+    for name, make_pair in pairs:
+        with tempfile.TemporaryDirectory() as directory:
+            make_vsm_side, make_peer = make_pair(directory, args.count)
+            if name == 'shm':
+                # the rings need to exist before the peer attaches to them
+                vsm_side = make_vsm_side()
+            pid = os.fork()
+            if pid == 0:
+                _ipc_peer(make_peer, args.count)
+                os._exit(0)
+            if name != 'shm':
+                vsm_side = make_vsm_side()
+
+            start = time.perf_counter()
+            for i in range(args.count):
+                vsm_side.send('speed.value', i)
+            _receive(vsm_side)
+            duration_ms = (time.perf_counter() - start) * 1000
+            _print_result(name + " throughput", duration_ms, args.count)
+
+            start = time.perf_counter()
+            for i in range(args.count):
+                vsm_side.send('speed.value', i)
+                _receive(vsm_side)
+            duration_ms = (time.perf_counter() - start) * 1000
+            _print_result(name + " round trip", duration_ms, args.count)
+
+            vsm_side.close()
+            os.waitpid(pid, 0)
+
+
+BENCHMARKS = {
+    'evaluator': bench_evaluator,
+    'frames': bench_frames,
+    'gating': bench_gating,
+    'history': bench_history,
+    'ipc': bench_ipc,
+    'optimizer': bench_optimizer,
+    'predicates': bench_predicates,
+    'propagation': bench_propagation,
+    'sequence': bench_sequence,
+    'staleness': bench_staleness,
+    'startup': bench_startup,
+    'temporal': bench_temporal,
+    'windows': bench_windows,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS.keys()),
+                        help="Benchmark to run")
+    parser.add_argument('--scale', type=int, default=100,
+                        help="How many times to repeat the sample rules")
+    parser.add_argument('--count', type=int, default=2000,
+                        help="Number of input signals to process")
+    args = parser.parse_args()
+
+    BENCHMARKS[args.benchmark](args)
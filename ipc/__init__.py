@@ -7,9 +7,14 @@
 # Authors:
 #  * Guillaume Tucker <guillaume.tucker@collabora.com>
 
+import fnmatch
 import importlib
+import re
 import select
 
+# returned by receive() when the input it handled didn't make a whole signal
+NO_SIGNAL = object()
+
 
 def load(name, *args, **kwargs):
     """Load an IPC class and return an instance of it.
@@ -56,7 +61,10 @@ class IPC(object):
         When called, this method should block while the IPC module is waiting
         for an incoming message to be read.  It should then handle the data and
         reformat it to return a (signal, value) 2-tuple with strings, in the
-        same format as for the send(signal, value) method arguments.
+        same format as for the send(signal, value) method arguments.  Modules
+        which may wake up without a whole signal to return, eg on a partial
+        line, return NO_SIGNAL rather than block the other modules, and None
+        is returned for an invalid message.
         """
         raise NotImplementedError("IPC.receive")
 
@@ -73,6 +81,67 @@ class FilenoIPC(IPC):
         raise NotImplementedError("IPC.fileno")
 
 
+class RoutingTable(object):
+    """Table deciding which destinations each signal is sent to.
+
+    The routes are a dictionary with a list of patterns for each destination:
+    signal names, signal numbers (looked up in the optional signal name to
+    number dictionary) or glob patterns such as `lights.*`.  Destinations
+    without any route get all the signals.
+
+    The list of destinations of a signal is worked out the first time it is
+    sent and then kept, so each send only costs a dictionary lookup.
+    """
+
+    def __init__(self, destinations, routes, signal_to_num=None):
+        unknown = set(routes) - set(destinations)
+        if unknown:
+            raise ValueError("routes for unknown destinations: {}".format(
+                ", ".join(sorted(unknown))))
+
+        self._destinations = list(destinations)
+        self._matchers = []
+        for destination in self._destinations:
+            patterns = routes.get(destination)
+            if patterns is None:
+                self._matchers.append(None)
+            else:
+                self._matchers.append(self._compile(patterns, signal_to_num))
+        self._cache = {}
+
+        if signal_to_num:
+            for signal in signal_to_num:
+                self.destinations(signal)
+
+    @staticmethod
+    def _compile(patterns, signal_to_num):
+        names = set()
+        globs = []
+        num_to_signal = {num: signal
+                         for signal, num in (signal_to_num or {}).items()}
+        for pattern in patterns:
+            if isinstance(pattern, int):
+                if pattern in num_to_signal:
+                    names.add(num_to_signal[pattern])
+            elif any(c in pattern for c in '*?['):
+                globs.append(fnmatch.translate(pattern))
+            else:
+                names.add(pattern)
+        regex = re.compile('|'.join(globs)).match if globs else None
+        return names, regex
+
+    def destinations(self, signal):
+        """Return the tuple of destination indexes of a signal."""
+        destinations = self._cache.get(signal)
+        if destinations is None:
+            destinations = tuple(
+                i for i, matcher in enumerate(self._matchers)
+                if matcher is None or signal in matcher[0] or
+                (matcher[1] and matcher[1](signal)))
+            self._cache[signal] = destinations
+        return destinations
+
+
 class IPCList(IPC):
     """List of multiple IPC modules to use in parallel.
 
@@ -83,20 +152,40 @@ class IPCList(IPC):
     implement the FilenoIPC interface (essentially the fileno() method) for
     this purpose.  Modules without this method will only be able to send
     signals, not receive any.
+
+    An optional wrapper callable can be provided to wrap each module after it
+    has been loaded, for example to send signals from a separate thread for
+    each module.
+
+    Optional routes can also be provided, as a dictionary with a list of
+    signal patterns for each module name, to only send some signals to some
+    modules (see RoutingTable).
     """
 
-    def __init__(self, names):
+    def __init__(self, names, wrapper=None, routes=None, signal_to_num=None):
         self._list = list(load(name) for name in names)
+        if wrapper:
+            self._list = list(wrapper(i) for i in self._list)
         self._inputs = list(i for i in self._list if hasattr(i, 'fileno'))
         self._read = list()
+        self._routes = None
+        if routes:
+            self._routes = RoutingTable(names, routes, signal_to_num)
 
     def close(self):
         for i in self._list:
             i.close()
 
-    def send(self, *args, **kw):
-        for i in self._list:
-            i.send(*args, **kw)
+    def send(self, signal, value):
+        if self._routes is None:
+            for i in self._list:
+                i.send(signal, value)
+        else:
+            for i in self._routes.destinations(signal):
+                self._list[i].send(signal, value)
+
+    def stats(self):
+        return list(i.stats() for i in self._list if hasattr(i, 'stats'))
 
     def receive(self, *args, **kw):
         if not self._read:
@@ -0,0 +1,248 @@
+# Copyright (C) 2018 Jaguar Land Rover
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import collections
+import ipc
+import ipc.stream
+import os
+import selectors
+import socket
+import threading
+
+SOCKET_PATH_DEFAULT = '/tmp/vsm.sock'
+# (host, port) to also listen on with TCP, or None
+TCP_ADDRESS_DEFAULT = None
+
+SIGNAL_SUBSCRIBE = 'subscribe'
+SIGNAL_UNSUBSCRIBE = 'unsubscribe'
+
+RECV_SIZE = 65536
+# clients with more than this many bytes waiting to be sent are disconnected
+CLIENT_BUFFER_MAX = 1 << 20
+# as are clients sending a line longer than this many bytes
+CLIENT_INPUT_MAX = 1 << 20
+
+
+class _Client(object):
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.input = b''
+        self.output = bytearray()
+        # signal name prefixes the client subscribed to, or None for all
+        self.prefixes = None
+        # signal values of the frame being received, if any
+        self.frame = None
+
+    def wants(self, signal):
+        return self.prefixes is None or signal.startswith(self.prefixes)
+
+    def subscribe(self, prefix):
+        self.prefixes = (self.prefixes or ()) + (prefix,)
+
+    def unsubscribe(self, prefix):
+        if self.prefixes:
+            self.prefixes = tuple(p for p in self.prefixes if p != prefix)
+
+
+class ServerIPC(ipc.FilenoIPC):
+    """IPC module accepting connections from many clients.
+
+    The server listens on a Unix domain socket and optionally on a TCP port,
+    and uses the same text format as StreamIPC: `signal=value\\n`, with
+    frames of signals between `{` and `}` lines.  Signals are received from
+    all the clients.  Each sent signal is forwarded to the
+    clients which subscribed to it, with a `subscribe=PREFIX` line for each
+    signal name prefix they want.  Clients which haven't subscribed to
+    anything get all the signals, `unsubscribe=PREFIX` cancels a
+    subscription.
+
+    All the sockets are non-blocking and handled with a selector, whose file
+    descriptor is returned by fileno() so the module works in an IPCList.
+    Each call to receive() handles the events which are ready once, and
+    returns ipc.NO_SIGNAL if no complete signal was received, so a client
+    sending part of a line doesn't hold up the other modules.  Data which can't be
+    sent straight away is kept until the client is ready, and a client
+    falling more than CLIENT_BUFFER_MAX bytes behind is disconnected rather
+    than holding up VSM, as is a client sending a line longer than
+    CLIENT_INPUT_MAX bytes.
+    """
+
+    def __init__(self, path=SOCKET_PATH_DEFAULT,
+                 tcp_address=TCP_ADDRESS_DEFAULT):
+        self._selector = selectors.DefaultSelector()
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._received = collections.deque()
+        self._listeners = []
+        self._path = path
+
+        # written while signals are left to receive, to keep fileno() readable
+        self._wake_in, self._wake_out = os.pipe()
+        os.set_blocking(self._wake_in, False)
+        os.set_blocking(self._wake_out, False)
+        self._selector.register(self._wake_in, selectors.EVENT_READ)
+
+        if path:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self._listen(socket.socket(socket.AF_UNIX), path)
+
+        if tcp_address:
+            sock = socket.socket()
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self._listen(sock, tcp_address)
+
+    def _listen(self, sock, address):
+        sock.bind(address)
+        sock.listen()
+        sock.setblocking(False)
+        self._selector.register(sock, selectors.EVENT_READ)
+        self._listeners.append(sock)
+
+    def close(self):
+        with self._lock:
+            for client in list(self._clients.values()):
+                self._disconnect(client)
+        for sock in self._listeners:
+            self._selector.unregister(sock)
+            sock.close()
+        if self._path:
+            try:
+                os.remove(self._path)
+            except FileNotFoundError:
+                pass
+        self._selector.unregister(self._wake_in)
+        os.close(self._wake_in)
+        os.close(self._wake_out)
+        self._selector.close()
+
+    def fileno(self):
+        return self._selector.fileno()
+
+    def clients(self):
+        """Return the number of connected clients."""
+        return len(self._clients)
+
+    def send(self, signal, value):
+        data = '{}={}\n'.format(signal, value).encode('UTF-8')
+        with self._lock:
+            for client in list(self._clients.values()):
+                if client.wants(signal):
+                    self._write(client, data)
+
+    def receive(self):
+        with self._lock:
+            pending = bool(self._received)
+        if not pending:
+            for key, events in self._selector.select():
+                with self._lock:
+                    self._handle(key, events)
+
+        with self._lock:
+            self._drain()
+            if not self._received:
+                return ipc.NO_SIGNAL
+            message = self._received.popleft()
+            if self._received:
+                os.write(self._wake_out, b'\0')
+        return message
+
+    def _handle(self, key, events):
+        if key.fd == self._wake_in:
+            self._drain()
+            return
+
+        if key.fileobj in self._listeners:
+            try:
+                sock, _ = key.fileobj.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            sock.setblocking(False)
+            client = _Client(sock)
+            self._clients[sock] = client
+            self._selector.register(sock, selectors.EVENT_READ, client)
+            return
+
+        client = key.data
+        if client.sock not in self._clients:
+            return
+        if events & selectors.EVENT_WRITE:
+            self._write(client, b'')
+        if events & selectors.EVENT_READ and client.sock in self._clients:
+            self._read(client)
+
+    def _read(self, client):
+        try:
+            data = client.sock.recv(RECV_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self._disconnect(client)
+            return
+
+        lines = (client.input + data).split(b'\n')
+        client.input = lines.pop()
+        for line in lines:
+            signal, _, value = line.decode('UTF-8', 'replace').partition('=')
+            signal, value = signal.strip(), value.strip()
+            if not signal:
+                continue
+            if signal == ipc.stream.FRAME_BEGIN:
+                client.frame = {}
+            elif signal == ipc.stream.FRAME_END:
+                if client.frame is not None:
+                    self._received.append(client.frame)
+                client.frame = None
+            elif client.frame is not None:
+                client.frame[signal] = value
+            elif signal == SIGNAL_SUBSCRIBE:
+                client.subscribe(value)
+            elif signal == SIGNAL_UNSUBSCRIBE:
+                client.unsubscribe(value)
+            else:
+                self._received.append((signal, value))
+
+        if len(client.input) > CLIENT_INPUT_MAX:
+            self._disconnect(client)
+
+    def _write(self, client, data):
+        was_pending = bool(client.output)
+        client.output += data
+        if not client.output:
+            return
+        try:
+            sent = client.sock.send(client.output)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except OSError:
+            self._disconnect(client)
+            return
+        del client.output[:sent]
+
+        if len(client.output) > CLIENT_BUFFER_MAX:
+            self._disconnect(client)
+        elif bool(client.output) != was_pending:
+            events = selectors.EVENT_READ
+            if client.output:
+                events |= selectors.EVENT_WRITE
+            self._selector.modify(client.sock, events, client)
+
+    def _disconnect(self, client):
+        del self._clients[client.sock]
+        self._selector.unregister(client.sock)
+        client.sock.close()
+
+    def _drain(self):
+        try:
+            while os.read(self._wake_in, RECV_SIZE):
+                pass
+        except BlockingIOError:
+            pass
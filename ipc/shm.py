@@ -0,0 +1,264 @@
+# Copyright (C) 2018 Jaguar Land Rover
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import errno
+import ipc
+import mmap
+import os
+import select
+import struct
+import threading
+
+RING_PATH_DEFAULT = '/dev/shm/vsm-ring'
+SLOTS_DEFAULT = 1024
+
+MAGIC = b'VSMR'
+VERSION = 1
+
+# the write and read counters are kept on separate cache lines
+HEADER = struct.Struct('<4sB3xI')
+COUNTER = struct.Struct('<Q')
+HEAD_OFFSET = 64
+TAIL_OFFSET = 128
+RECORDS_OFFSET = 192
+
+NAME_SIZE = 60
+VALUE_SIZE = 64
+RECORD = struct.Struct('<HH{}s{}s'.format(NAME_SIZE, VALUE_SIZE))
+RECORD_SIZE = RECORD.size
+
+WAKE_SUFFIX = '.wake'
+WAKE_READ_SIZE = 4096
+# the counters are shared without memory barriers, so don't rely only on the
+# wake-ups when waiting
+WAIT_TIMEOUT_S = 0.1
+
+
+class ValueTooLongError(ValueError):
+    """Raised when a signal value doesn't fit in a record."""
+
+
+class SignalRing(object):
+    """Single-producer, single-consumer ring of signals in shared memory.
+
+    The ring is a file mapped in memory, usually in /dev/shm, with a header
+    and a fixed number of fixed-size records, each holding a signal name and
+    its value as text.  The producer only ever writes the head counter and
+    the consumer the tail one, so no lock is needed as long as there is only
+    one of each.
+
+    A named pipe next to the ring is used to wake up the consumer: its read
+    end is returned by fileno() so it can be used with select().  The
+    producer writes a byte to it when the consumer had taken all the previous
+    signals, and the consumer empties it before taking a signal and writes a
+    byte back when signals are left, so the pipe is readable whenever the
+    ring is not empty, and only then.
+    """
+
+    def __init__(self, path, slots=SLOTS_DEFAULT, create=False):
+        self._path = path
+        self._wake_path = path + WAKE_SUFFIX
+        if create:
+            self._create(slots)
+
+        self._file = open(path, 'r+b')
+        self._mmap = mmap.mmap(self._file.fileno(), 0)
+        magic, version, self._slots = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError("not a signal ring: '{}'".format(path))
+
+        self._wake_in = None
+        self._wake_out = None
+
+    def _create(self, slots):
+        size = RECORDS_OFFSET + slots * RECORD_SIZE
+        tmp_path = self._path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, slots))
+            f.truncate(size)
+        os.replace(tmp_path, self._path)
+
+        try:
+            os.remove(self._wake_path)
+        except FileNotFoundError:
+            pass
+        os.mkfifo(self._wake_path)
+
+    def close(self):
+        for fd in (self._wake_in, self._wake_out):
+            if fd is not None:
+                os.close(fd)
+        self._wake_in = self._wake_out = None
+        self._mmap.close()
+        self._file.close()
+
+    def fileno(self):
+        """Return the read end of the wake-up pipe, for the consumer."""
+        if self._wake_in is None:
+            # opened for writing too, so it never reaches EOF
+            self._wake_in = os.open(self._wake_path,
+                                    os.O_RDWR | os.O_NONBLOCK)
+            # the producer may have started before the pipe was opened
+            if len(self):
+                os.write(self._wake_in, b'\0')
+        return self._wake_in
+
+    def __len__(self):
+        return self._head() - self._tail()
+
+    def push(self, signal, value):
+        """Add a signal to the ring.
+
+        Return False if the ring is full.  A ValueError is raised if the
+        signal name doesn't fit in a record, and a ValueTooLongError if its
+        value doesn't.
+        """
+        name = signal.encode('UTF-8')
+        if len(name) > NAME_SIZE:
+            raise ValueError("signal name too long: {}".format(signal))
+        data = str(value).encode('UTF-8')
+        if len(data) > VALUE_SIZE:
+            raise ValueTooLongError("value of {} too long: {} bytes".format(
+                signal, len(data)))
+
+        head = self._head()
+        if head - self._tail() >= self._slots:
+            return False
+
+        RECORD.pack_into(self._mmap,
+                         RECORDS_OFFSET + (head % self._slots) * RECORD_SIZE,
+                         len(name), len(data), name, data)
+        COUNTER.pack_into(self._mmap, HEAD_OFFSET, head + 1)
+
+        # otherwise the consumer will see this signal after the previous ones
+        if self._tail() >= head:
+            self._wake()
+        return True
+
+    def pop(self):
+        """Take the oldest signal out of the ring, or return None if empty."""
+        tail = self._tail()
+        if tail == self._head():
+            return None
+
+        name_len, value_len, name, data = RECORD.unpack_from(
+            self._mmap, RECORDS_OFFSET + (tail % self._slots) * RECORD_SIZE)
+        COUNTER.pack_into(self._mmap, TAIL_OFFSET, tail + 1)
+        return (name[:name_len].decode('UTF-8'),
+                data[:value_len].decode('UTF-8', 'ignore'))
+
+    def poll(self):
+        """Take the oldest signal out of the ring, or return None if empty.
+
+        Unlike pop(), the wake-up pipe is emptied first, so it stays readable
+        afterwards only if signals are left.
+        """
+        self._drain()
+        item = self.pop()
+        # keep the pipe readable for select() while signals are left
+        if len(self):
+            os.write(self.fileno(), b'\0')
+        return item
+
+    def wait(self):
+        """Block until the ring has a signal, then return it."""
+        while True:
+            item = self.poll()
+            if item is not None:
+                return item
+            select.select([self.fileno()], [], [], WAIT_TIMEOUT_S)
+
+    def _head(self):
+        return COUNTER.unpack_from(self._mmap, HEAD_OFFSET)[0]
+
+    def _tail(self):
+        return COUNTER.unpack_from(self._mmap, TAIL_OFFSET)[0]
+
+    def _drain(self):
+        try:
+            while os.read(self.fileno(), WAKE_READ_SIZE):
+                pass
+        except BlockingIOError:
+            pass
+
+    def _wake(self):
+        if self._wake_out is None:
+            try:
+                self._wake_out = os.open(self._wake_path,
+                                         os.O_WRONLY | os.O_NONBLOCK)
+            except OSError as e:
+                # no consumer yet, it will find the signals when it starts
+                if e.errno in (errno.ENXIO, errno.ENOENT):
+                    return
+                raise
+        try:
+            os.write(self._wake_out, b'\0')
+        except BlockingIOError:
+            # the pipe is full of wake-ups already
+            pass
+
+
+class ShmRingIPC(ipc.FilenoIPC):
+    """IPC module based on a pair of shared-memory signal rings.
+
+    This is meant for processes on the same machine: signals are copied to
+    and from memory shared with the other process, without going through the
+    kernel except to wake up a waiting reader.  VSM creates the `<path>-in`
+    ring, to receive signals, and the `<path>-out` ring, to send them.  The
+    other process uses the same class with peer=True to attach to them the
+    other way round.
+
+    Signal names and values are passed as text, like with StreamIPC.
+    receive() returns ipc.NO_SIGNAL when woken up with the ring empty, so it
+    doesn't hold up the other modules of an IPCList.  When
+    the other process doesn't keep up and the ring is full, signals are
+    dropped and counted in the statistics, as are the signals whose value
+    doesn't fit in a record.  Each ring has a single producer, so sending is
+    serialized for the threads of VSM which emit signals.
+    """
+
+    def __init__(self, path=RING_PATH_DEFAULT, slots=SLOTS_DEFAULT,
+                 peer=False):
+        in_path, out_path = path + '-in', path + '-out'
+        if peer:
+            in_path, out_path = out_path, in_path
+        self._in = SignalRing(in_path, slots, create=not peer)
+        self._out = SignalRing(out_path, slots, create=not peer)
+        self._send_lock = threading.Lock()
+        self._stats = {'sent': 0, 'dropped': 0, 'too_long': 0,
+                       'received': 0}
+
+    def close(self):
+        self._in.close()
+        self._out.close()
+
+    def fileno(self):
+        return self._in.fileno()
+
+    def send(self, signal, value):
+        with self._send_lock:
+            try:
+                pushed = self._out.push(signal, value)
+            except ValueTooLongError:
+                self._stats['too_long'] += 1
+                return
+            if pushed:
+                self._stats['sent'] += 1
+            else:
+                self._stats['dropped'] += 1
+
+    def receive(self):
+        # returns straight away in an IPCList, which waited for the pipe
+        select.select([self._in], [], [], WAIT_TIMEOUT_S)
+        item = self._in.poll()
+        if item is None:
+            return ipc.NO_SIGNAL
+        self._stats['received'] += 1
+        return item
+
+    def stats(self):
+        return dict(self._stats)
@@ -11,12 +11,20 @@ import ipc
 import socket
 import sys
 
+# lines around the signals of a frame, which are received together
+FRAME_BEGIN = '{'
+FRAME_END = '}'
+
 
 class StreamIPC(ipc.FilenoIPC):
     """IPC module based on a generic communication stream.
 
     This class is to keep a pair of streams, for input and output, and
     implement a basic text-based API in the format `signal=value\n`.
+
+    Signals received between a `{` line and a `}` line form a frame, which
+    is returned as one dictionary of signal values, eg all the signals
+    decoded from a CAN frame.
     """
 
     def __init__(self, input_stream, output_stream):
@@ -37,7 +45,16 @@ class StreamIPC(ipc.FilenoIPC):
         line = self._readline()
         if line is None:
             return None
-        return tuple(s.strip() for s in line.split('='))
+        if line != FRAME_BEGIN:
+            return tuple(s.strip() for s in line.split('='))
+
+        frame = {}
+        while True:
+            line = self._readline()
+            if line is None or line == FRAME_END:
+                return frame
+            signal, _, value = line.partition('=')
+            frame[signal.strip()] = value.strip()
 
     def _write(self, data):
         """Write some text data to emit a signal."""
@@ -62,7 +79,8 @@ class StdioIPC(StreamIPC):
         super(StdioIPC, self).__init__(sys.stdin, sys.stdout, *args, **kwargs)
 
     def receive(self):
-        return super(StdioIPC, self).receive() or ('quit', None)
+        message = super(StdioIPC, self).receive()
+        return ('quit', None) if message is None else message
 
 
 class SocketIPC(StreamIPC):
@@ -0,0 +1,185 @@
+# Copyright (C) 2018 Jaguar Land Rover
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import atexit
+import collections
+import ipc
+import select
+import threading
+import time
+
+POLICY_BLOCK = 'block'
+POLICY_DROP_OLDEST = 'drop-oldest'
+POLICY_COALESCE = 'coalesce'
+POLICIES = (POLICY_BLOCK, POLICY_DROP_OLDEST, POLICY_COALESCE)
+
+QUEUE_SIZE_DEFAULT = 256
+
+
+class ThreadedIPC(ipc.IPC):
+    """Wrapper to send signals through another IPC module from a thread.
+
+    Each call to send() only puts the signal in a bounded queue and returns
+    straight away.  A dedicated worker thread then takes the signals out of
+    the queue and passes them to the send() method of the wrapped module, so a
+    slow sink doesn't hold up the rule evaluation.  Incoming signals are not
+    queued: receive() and fileno() are forwarded to the wrapped module.  As
+    most modules use the same handle to send and receive, the calls to its
+    receive() and send() methods are serialized.  receive() first waits for
+    the file descriptor of the wrapped module to be readable, like IPCList
+    does, so the worker keeps sending while VSM waits for input; modules
+    without a file descriptor can only be used to send signals.
+
+    The policy decides what happens when the queue is full:
+
+    * block:        wait until the worker has made some room in the queue
+    * drop-oldest:  discard the oldest pending signal
+    * coalesce:     block as well, but the queue never gets full with several
+                    values of the same signal: a signal which is still pending
+                    only gets its value replaced, whether or not the queue is
+                    full
+    """
+
+    def __init__(self, sink, queue_size=QUEUE_SIZE_DEFAULT,
+                 policy=POLICY_BLOCK):
+        if policy not in POLICIES:
+            raise ValueError("invalid send queue policy: {}".format(policy))
+        if queue_size < 1:
+            raise ValueError("invalid send queue size: {}".format(queue_size))
+
+        self._sink = sink
+        self._queue_size = queue_size
+        self._policy = policy
+        # signals are stored as [signal, value, enqueue time] lists so their
+        # value can be updated in place when coalescing
+        self._queue = collections.deque()
+        self._pending = dict()
+        self._cond = threading.Condition()
+        # held by the worker while sending and by receive()
+        self._sink_lock = threading.Lock()
+        self._closing = False
+        self._busy = False
+        self._stats = {
+            'sent': 0,
+            'dropped': 0,
+            'coalesced': 0,
+            'errors': 0,
+            'depth_max': 0,
+            'latency_total_ms': 0.0,
+            'latency_max_ms': 0.0,
+            'send_time_total_ms': 0.0,
+            'send_time_max_ms': 0.0,
+        }
+
+        if hasattr(sink, 'fileno'):
+            self.fileno = sink.fileno
+
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+        # don't lose pending signals if the process exits without closing
+        atexit.register(self.flush)
+
+    def close(self):
+        """Send all the pending signals, stop the worker and close the sink."""
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        self._worker.join()
+        self._sink.close()
+
+    def flush(self):
+        """Wait until all the pending signals have been sent."""
+        with self._cond:
+            while (self._queue or self._busy) and self._worker.is_alive():
+                self._cond.wait()
+
+    def send(self, signal, value):
+        with self._cond:
+            if self._policy == POLICY_COALESCE:
+                item = self._pending.get(signal)
+                if item is not None:
+                    item[1] = value
+                    self._stats['coalesced'] += 1
+                    return
+
+            if len(self._queue) >= self._queue_size:
+                if self._policy == POLICY_DROP_OLDEST:
+                    self._pop()
+                    self._stats['dropped'] += 1
+                else:
+                    while len(self._queue) >= self._queue_size:
+                        self._cond.wait()
+
+            item = [signal, value, time.perf_counter()]
+            self._queue.append(item)
+            if self._policy == POLICY_COALESCE:
+                self._pending[signal] = item
+            self._stats['depth_max'] = max(self._stats['depth_max'],
+                                           len(self._queue))
+            self._cond.notify_all()
+
+    def receive(self):
+        # without the lock, which the worker needs to send
+        select.select([self._sink], [], [])
+        with self._sink_lock:
+            return self._sink.receive()
+
+    def stats(self):
+        """Return a dictionary with the queue and send latency statistics.
+
+        The latency covers the time from the call to send() until the wrapped
+        module has sent the signal, while the send time only covers the call
+        to the wrapped module's send() method.  Both are in milliseconds.
+        """
+        with self._cond:
+            stats = dict(self._stats)
+            stats['depth'] = len(self._queue)
+        sent = max(stats['sent'], 1)
+        stats['latency_avg_ms'] = stats['latency_total_ms'] / sent
+        stats['send_time_avg_ms'] = stats['send_time_total_ms'] / sent
+        return stats
+
+    def _pop(self):
+        item = self._queue.popleft()
+        if self._pending.get(item[0]) is item:
+            del self._pending[item[0]]
+        return item
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._closing:
+                    self._cond.wait()
+                if not self._queue:
+                    break
+                signal, value, enqueue_time = self._pop()
+                self._busy = True
+                self._cond.notify_all()
+
+            start = time.perf_counter()
+            try:
+                with self._sink_lock:
+                    self._sink.send(signal, value)
+            except Exception:
+                with self._cond:
+                    self._stats['errors'] += 1
+                    self._busy = False
+                    self._cond.notify_all()
+                continue
+            end = time.perf_counter()
+
+            send_time_ms = (end - start) * 1000
+            latency_ms = (end - enqueue_time) * 1000
+            with self._cond:
+                self._busy = False
+                self._cond.notify_all()
+                self._stats['sent'] += 1
+                self._stats['send_time_total_ms'] += send_time_ms
+                self._stats['send_time_max_ms'] = max(
+                    self._stats['send_time_max_ms'], send_time_ms)
+                self._stats['latency_total_ms'] += latency_ms
+                self._stats['latency_max_ms'] = max(
+                    self._stats['latency_max_ms'], latency_ms)
@@ -14,13 +14,41 @@
 #  * Luis Araujo <luis.araujo@collabora.co.uk>
 #  * Guillaume Tucker <guillaume.tucker@collabora.com>
 
+import ast
+import contextlib
+import gzip
+import json
 import os
+import select
+import shutil
+import socket
+import tempfile
+import threading
+import time
 import unittest
 from subprocess import Popen, PIPE, TimeoutExpired
 import vsmlib.utils
 import zmq
 import ipc.zeromq
 import ipc.stream
+import ipc.server
+import ipc.shm
+import ipc.threaded
+import vsmlib.optimizer
+import vsmlib.expression
+import vsmlib.predicates
+import vsmlib.dependencies
+import vsmlib.windows
+import vsmlib.history
+import vsmlib.scheduler
+import vsmlib.signal_filter
+import vsmlib.temporal
+import vsmlib.staleness
+import vsmlib.binlog
+import vsmlib.logfile
+import vsmlib.logsinks
+import vsmlib.statetable
+import vsm
 
 
 RULES_PATH = os.path.abspath(os.path.join('.', 'sample_rules'))
@@ -325,7 +353,6 @@ moving,6,True
 State = {
 moving = True
 }
-condition: (moving != True and damage == True) => False
 damage,5,True
 State = {
 damage = True
@@ -337,6 +364,42 @@ damage,5,'True'
         '''
         self.run_vsm('simple2', input_data, expected_output.strip() + '\n')
 
+    def test_readiness(self):
+        '''
+        Conditions are only evaluated once all their signals are set, the
+        'readiness' signal logs the ones still waiting.
+        '''
+        input_data = 'moving = False\nreadiness = 1\ndamage = True\n' \
+                'readiness = 1'
+        expected_output = '''
+moving,6,False
+State = {
+moving = False
+}
+readiness: 0 of 1 condition(s) ready
+readiness: 1 condition(s) waiting for damage
+damage,5,True
+State = {
+damage = True
+moving = False
+}
+condition: (moving != True and damage == True) => True
+car.stop,4,'True'
+State = {
+car.stop = True
+damage = True
+moving = False
+}
+readiness: 1 of 1 condition(s) ready
+moving,6,'False'
+readiness,[SIGNUM],'1'
+damage,5,'True'
+car.stop,4,'True'
+readiness,[SIGNUM],'1'
+        '''
+        self.run_vsm('simple2', input_data, expected_output.strip() + '\n',
+                     False)
+
     def test_simple2_multiple_signals(self):
         input_data = 'moving = False\ndamage = True'
         expected_output = '''
@@ -721,7 +784,6 @@ ignition,10,True
 State = {
 ignition = True
 }
-changed value for signal 'ignition' ignored because prior conditions in its sequence block have not been met
 transmission.gear,9,'park'
 State = {
 ignition = True
@@ -748,6 +810,7 @@ ignition = True
 parked = True
 transmission.gear = park
 }
+sequence starting with (transmission.gear == 'park'): 1 signal update(s) ignored because prior conditions in the sequence had not been met
 ignition,10,'True'
 transmission.gear,9,'"park"'
 parked,11,'True'
@@ -756,6 +819,30 @@ ignited,12,'True'
         '''
         self.run_vsm('sequence', input_data, expected_output.strip() + '\n')
 
+    def test_sequence_not_met(self):
+        '''
+        A sequence only moves on to its next condition once the current one is
+        met.
+        '''
+        input_data = 'transmission.gear = "drive"\n' \
+                'ignition = True'
+        expected_output = '''
+transmission.gear,9,'drive'
+State = {
+transmission.gear = drive
+}
+condition: (transmission.gear == 'park') => False
+ignition,10,True
+State = {
+ignition = True
+transmission.gear = drive
+}
+sequence starting with (transmission.gear == 'park'): 1 signal update(s) ignored because prior conditions in the sequence had not been met
+transmission.gear,9,'"drive"'
+ignition,10,'True'
+        '''
+        self.run_vsm('sequence', input_data, expected_output.strip() + '\n')
+
     def test_unconditional_emit(self):
         input_data = ''
         expected_output = '''
@@ -804,13 +891,6 @@ State = {
 flux_capacitor.energy_generated = 1.1
 lights.external.time_travel_imminent = True
 }
-condition: (flux_capacitor.energy_generated >= 1.21 * 0.9 and not (flux_capacitor.energy_generated >= 1.21)
-) => True
-lights.external.time_travel_imminent,5032,'True'
-State = {
-flux_capacitor.energy_generated = 1.1
-lights.external.time_travel_imminent = True
-}
 speed.value,8,140
 State = {
 flux_capacitor.energy_generated = 1.1
@@ -826,20 +906,9 @@ lights.external.time_travel_imminent = True
 lights.internal.time_travel_imminent = True
 speed.value = 140
 }
-condition: (( speed.value >= (88 - 10) * 1.6 and speed.value <  88 * 1.6 ) or ( flux_capacitor.energy_generated >= 1.21 * 0.9 and flux_capacitor.energy_generated < 1.21 )
-) => True
-lights.internal.time_travel_imminent,5031,'True'
-State = {
-flux_capacitor.energy_generated = 1.1
-lights.external.time_travel_imminent = True
-lights.internal.time_travel_imminent = True
-speed.value = 140
-}
 flux_capacitor.energy_generated,5030,'1.1'
 lights.external.time_travel_imminent,5032,'True'
-lights.external.time_travel_imminent,5032,'True'
 speed.value,8,'140'
-lights.internal.time_travel_imminent,5031,'True'
 lights.internal.time_travel_imminent,5031,'True'
         '''
         self.run_vsm('subclauses_arithmetic_booleans', input_data,
@@ -847,7 +916,8 @@ lights.internal.time_travel_imminent,5031,'True'
 
     def test_nested_child_before_parent(self):
         '''
-        Ensure that we can safely set a nested condition before its parent.
+        Ensure that we can safely set a nested condition before its parent,
+        which isn't evaluated as long as its parents are not met.
 
         Originally, this caused a crash.
         '''
@@ -858,14 +928,69 @@ horn,20,True
 State = {
 horn = True
 }
-parent condition: parked == (unset)
-parent condition: car.stop == (unset)
-condition: (horn == True) => True
 horn,20,'true'
         '''
         self.run_vsm('nested_simple', input_data,
                 expected_output.strip() + '\n', wait_time_ms=1500)
 
+    def test_nested_gated(self):
+        '''
+        Ensure that a subcondition is only evaluated while its parent is met,
+        and catches up with the value of its signal when it becomes active.
+        '''
+
+        input_data = 'wipers = true\n' \
+                'ignition = true\n' \
+                'wipers = true\n' \
+                'ignition = false\n' \
+                'wipers = false'
+        expected_output = '''
+wipers,17,True
+State = {
+wipers = True
+}
+ignition,10,True
+State = {
+ignition = True
+wipers = True
+}
+condition: (ignition == True) => True
+wipers,17,True
+State = {
+ignition = True
+wipers = True
+}
+parent condition: ignition == True
+condition: (wipers == True) => True
+lights,18,'on'
+State = {
+ignition = True
+lights = on
+wipers = True
+}
+ignition,10,False
+State = {
+ignition = False
+lights = on
+wipers = True
+}
+condition: (ignition == True) => False
+wipers,17,False
+State = {
+ignition = False
+lights = on
+wipers = False
+}
+wipers,17,'true'
+ignition,10,'true'
+wipers,17,'true'
+lights,18,'on'
+ignition,10,'false'
+wipers,17,'false'
+        '''
+        self.run_vsm('nested_gated', input_data,
+                expected_output.strip() + '\n', False)
+
     def test_start_0_child_unmet(self):
         '''
         Ensure that we can use a start time of zero and meet its parent
@@ -898,8 +1023,6 @@ horn,20,True
 State = {
 horn = True
 }
-parent condition: parked == (unset)
-condition: (horn == True) => True
 parked,11,True
 State = {
 horn = True
@@ -913,9 +1036,71 @@ parked,11,'true'
                 expected_output.strip() + '\n', wait_time_ms=1200)
 
 
+    def test_filter_deadband(self):
+        '''
+        Ensure that values within the deadband of a filtered signal are not
+        processed.
+        '''
+
+        input_data = 'speed.value = 5.0\n' \
+                'speed.value = 5.5\n' \
+                'speed.value = 60.0'
+        expected_output = '''
+filter: speed.value processed 1 of 1 values
+speed.value,8,5.0
+State = {
+speed.value = 5.0
+}
+condition: (speed.value > 50) => False
+filter: speed.value processed 2 of 3 values
+speed.value,8,60.0
+State = {
+speed.value = 60.0
+}
+condition: (speed.value > 50) => True
+car.stop,4,'True'
+State = {
+car.stop = True
+speed.value = 60.0
+}
+speed.value,8,'5.0'
+speed.value,8,'5.5'
+speed.value,8,'60.0'
+car.stop,4,'True'
+        '''
+        self.run_vsm('filter', input_data, expected_output.strip() + '\n')
+
+
 class VSMStdTests(VSMTestCases):
     ipc_class = TestVSMDebug
 
+    def test_frame(self):
+        '''
+        The signals of a frame are all set before the condition using both of
+        them is evaluated, once.
+        '''
+        input_data = '{\nmoving = False\ndamage = True\n}'
+        expected_output = '''
+moving,6,False
+damage,5,True
+State = {
+damage = True
+moving = False
+}
+condition: (moving != True and damage == True) => True
+car.stop,4,'True'
+State = {
+car.stop = True
+damage = True
+moving = False
+}
+moving,6,'False'
+damage,5,'True'
+car.stop,4,'True'
+        '''
+        self.run_vsm('simple2', input_data, expected_output.strip() + '\n',
+                     False)
+
 
 class VSMZeroMQTests(VSMTestCases):
     ipc_class = TestVSMZeroMQ
@@ -943,7 +1128,1692 @@ car.backup=True
         self.run_vsm('simple0', input_data, expected_output.strip() + '\n')
 
 
+class BlockingSinkIPC(ipc.FilenoIPC):
+    '''
+    IPC module recording sent signals, which blocks until it is released, and
+    receiving the number of signals sent so far once input() is called
+    '''
+
+    def __init__(self):
+        self.sent = []
+        self.release = threading.Event()
+        self._in, self._out = os.pipe()
+
+    def close(self):
+        os.close(self._in)
+        os.close(self._out)
+
+    def fileno(self):
+        return self._in
+
+    def input(self):
+        os.write(self._out, b'\0')
+
+    def send(self, signal, value):
+        self.release.wait()
+        self.sent.append((signal, value))
+
+    def receive(self):
+        os.read(self._in, 1)
+        return 'sent', len(self.sent)
+
+
+class ThreadedIPCTests(unittest.TestCase):
+
+    def _run_policy(self, policy, signals, queue_size=2):
+        sink = BlockingSinkIPC()
+        threaded = ipc.threaded.ThreadedIPC(sink, queue_size, policy)
+        # first signal is held by the worker in the blocking sink
+        threaded.send('a', 0)
+        while threaded.stats()['depth']:
+            pass
+        for signal, value in signals:
+            threaded.send(signal, value)
+        stats = threaded.stats()
+        sink.release.set()
+        threaded.close()
+        return sink.sent, stats
+
+    def test_block(self):
+        sink = BlockingSinkIPC()
+        sink.release.set()
+        threaded = ipc.threaded.ThreadedIPC(sink, 1)
+        for value in range(10):
+            threaded.send('a', value)
+        threaded.close()
+        self.assertEqual(sink.sent, [('a', value) for value in range(10)])
+        self.assertEqual(threaded.stats()['sent'], 10)
+
+    def test_drop_oldest(self):
+        sent, stats = self._run_policy(ipc.threaded.POLICY_DROP_OLDEST,
+                                       [('b', 1), ('c', 2), ('d', 3)])
+        self.assertEqual(sent, [('a', 0), ('c', 2), ('d', 3)])
+        self.assertEqual(stats['dropped'], 1)
+        self.assertEqual(stats['depth'], 2)
+
+    def test_coalesce(self):
+        sent, stats = self._run_policy(ipc.threaded.POLICY_COALESCE,
+                                       [('b', 1), ('c', 2), ('b', 3)])
+        self.assertEqual(sent, [('a', 0), ('b', 3), ('c', 2)])
+        self.assertEqual(stats['coalesced'], 1)
+
+        # pending signals are coalesced even when the queue isn't full
+        sent, stats = self._run_policy(ipc.threaded.POLICY_COALESCE,
+                                       [('b', 1), ('b', 2), ('b', 3)], 4)
+        self.assertEqual(sent, [('a', 0), ('b', 3)])
+        self.assertEqual(stats['coalesced'], 2)
+
+    def test_receive_while_sending(self):
+        '''
+        The wrapped module isn't received from while the worker is sending a
+        signal through it.
+        '''
+        sink = BlockingSinkIPC()
+        threaded = ipc.threaded.ThreadedIPC(sink)
+        threaded.send('a', 0)
+        while threaded.stats()['depth']:
+            pass
+        received = []
+        receiver = threading.Thread(
+            target=lambda: received.append(threaded.receive()))
+        receiver.start()
+        sink.input()
+        receiver.join(0.1)
+        self.assertEqual(received, [])
+        sink.release.set()
+        receiver.join()
+        threaded.close()
+        self.assertEqual(received, [('sent', 1)])
+
+    def test_send_while_waiting(self):
+        '''
+        Signals are sent while waiting for input from the wrapped module.
+        '''
+        sink = BlockingSinkIPC()
+        sink.release.set()
+        threaded = ipc.threaded.ThreadedIPC(sink)
+        received = []
+        receiver = threading.Thread(
+            target=lambda: received.append(threaded.receive()))
+        receiver.start()
+        time.sleep(0.05)
+        threaded.send('a', 0)
+        threaded.flush()
+        self.assertEqual(sink.sent, [('a', 0)])
+        sink.input()
+        receiver.join()
+        threaded.close()
+        self.assertEqual(received, [('sent', 1)])
+
+
+class RecordingIPC(ipc.IPC):
+    '''
+    IPC module recording sent signals
+    '''
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, signal, value):
+        self.sent.append((signal, value))
+
+
+class OtherRecordingIPC(RecordingIPC):
+    pass
+
+
+class IPCRoutingTests(unittest.TestCase):
+
+    SIGNALS = {'car.backup': 3, 'transmission.gear': 9,
+               'lights.external.backup': 14, 'lights.external.headlights': 19}
+
+    def test_routing_table(self):
+        table = ipc.RoutingTable(
+            ['a', 'b', 'c'],
+            {'a': ['car.backup', 9], 'b': ['lights.*', 'speed.value']},
+            self.SIGNALS)
+        self.assertEqual(table.destinations('car.backup'), (0, 2))
+        self.assertEqual(table.destinations('transmission.gear'), (0, 2))
+        self.assertEqual(table.destinations('lights.external.backup'), (1, 2))
+        self.assertEqual(table.destinations('speed.value'), (1, 2))
+        self.assertEqual(table.destinations('lightsout'), (2,))
+
+        with self.assertRaises(ValueError):
+            ipc.RoutingTable(['a'], {'d': ['*']})
+
+    def test_ipc_list(self):
+        routed = '{}.RecordingIPC'.format(__name__)
+        other = '{}.OtherRecordingIPC'.format(__name__)
+        ipc_list = ipc.IPCList([routed, other], routes={routed: ['car.*']})
+        ipc_list.send('car.backup', True)
+        ipc_list.send('transmission.gear', 'reverse')
+
+        routed_ipc, other_ipc = ipc_list._list
+        self.assertEqual(routed_ipc.sent, [('car.backup', True)])
+        self.assertEqual(other_ipc.sent, [('car.backup', True),
+                                          ('transmission.gear', 'reverse')])
+
+
+class ShmRingIPCTests(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._path = os.path.join(self._dir, 'ring')
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_full_ring(self):
+        vsm_side = ipc.shm.ShmRingIPC(self._path, slots=4)
+        peer = ipc.shm.ShmRingIPC(self._path, peer=True)
+        for value in range(6):
+            vsm_side.send('speed.value', value)
+        self.assertEqual(vsm_side.stats(),
+                         {'sent': 4, 'dropped': 2, 'too_long': 0,
+                          'received': 0})
+
+        # the ring wraps around
+        for value in range(4):
+            self.assertEqual(peer.receive(), ('speed.value', str(value)))
+        # values which don't fit are counted rather than truncated
+        vsm_side.send('transmission.gear', 'x' * (ipc.shm.VALUE_SIZE + 1))
+        vsm_side.send('transmission.gear', 'x' * ipc.shm.VALUE_SIZE)
+        self.assertEqual(peer.receive(),
+                         ('transmission.gear', 'x' * ipc.shm.VALUE_SIZE))
+        self.assertEqual(vsm_side.stats()['too_long'], 1)
+        with self.assertRaises(ValueError):
+            vsm_side.send('s' * 100, 1)
+
+        vsm_side.close()
+        peer.close()
+
+    def test_wake_up(self):
+        '''
+        The file descriptor is readable while there are signals to receive, so
+        the module can be used in an IPCList.
+        '''
+        vsm_side = ipc.shm.ShmRingIPC(self._path)
+        peer = ipc.shm.ShmRingIPC(self._path, peer=True)
+        # signal sent before the descriptor is opened
+        peer.send('a', 1)
+        fd = vsm_side.fileno()
+
+        def send():
+            time.sleep(0.1)
+            for value in range(2, 5):
+                peer.send('a', value)
+
+        sender = threading.Thread(target=send)
+        sender.start()
+        received = []
+        while len(received) < 4:
+            readable, _, _ = select.select([fd], [], [], 5)
+            self.assertEqual(readable, [fd])
+            received.append(vsm_side.receive())
+        sender.join()
+
+        self.assertEqual(received, [('a', str(value)) for value in range(1, 5)])
+
+        # the descriptor isn't readable once the ring is empty, so the other
+        # modules of an IPCList aren't held up
+        readable, _, _ = select.select([fd], [], [], 0)
+        self.assertEqual(readable, [])
+        self.assertIs(vsm_side.receive(), ipc.NO_SIGNAL)
+        self.assertEqual(vsm_side.stats()['received'], 4)
+
+        vsm_side.close()
+        peer.close()
+
+
+class ServerIPCTests(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._path = os.path.join(self._dir, 'vsm.sock')
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def _connect(self, path=None):
+        client = socket.socket(socket.AF_UNIX)
+        self.addCleanup(client.close)
+        client.connect(path or self._path)
+        client.settimeout(5)
+        return client
+
+    def _receive(self, server):
+        # receive() returns NO_SIGNAL until a whole signal has been received
+        for _ in range(100):
+            message = server.receive()
+            if message is not ipc.NO_SIGNAL:
+                return message
+        self.fail("no signal received")
+
+    def test_subscriptions(self):
+        server = ipc.server.ServerIPC(self._path)
+        self.addCleanup(server.close)
+        everything = self._connect()
+        lights = self._connect()
+        lights.sendall(b'subscribe=lights.\nsubscribe = car.stop\n')
+        everything.sendall(b'transmission.gear = reverse\n')
+
+        # signals are received from all the clients
+        self.assertEqual(self._receive(server), ('transmission.gear', 'reverse'))
+        lights.sendall(b'speed.value=12\n')
+        self.assertEqual(self._receive(server), ('speed.value', '12'))
+
+        server.send('car.backup', True)
+        server.send('lights.external.backup', True)
+        server.send('car.stop', False)
+        self.assertEqual(lights.recv(100),
+                         b'lights.external.backup=True\ncar.stop=False\n')
+        received = b''
+        while received.count(b'\n') < 3:
+            received += everything.recv(100)
+        self.assertEqual(received, b'car.backup=True\n'
+                         b'lights.external.backup=True\ncar.stop=False\n')
+
+    def test_frames(self):
+        server = ipc.server.ServerIPC(self._path)
+        self.addCleanup(server.close)
+        client = self._connect()
+        client.sendall(b'{\nspeed.value=12\ngear = "drive"\n}\na=1\n')
+        self.assertEqual(self._receive(server),
+                         {'speed.value': '12', 'gear': '"drive"'})
+        self.assertEqual(self._receive(server), ('a', '1'))
+
+    def test_slow_client(self):
+        '''
+        A client which doesn't read what is sent to it gets disconnected.
+        '''
+        server = ipc.server.ServerIPC(self._path)
+        self.addCleanup(server.close)
+        slow = self._connect()
+        fast = self._connect()
+        fast.sendall(b'subscribe=none\na=1\n')
+        self.assertEqual(self._receive(server), ('a', '1'))
+        self.assertEqual(server.clients(), 2)
+
+        value = 'x' * 1000
+        for _ in range(ipc.server.CLIENT_BUFFER_MAX // 1000 * 2):
+            server.send('signal', value)
+        self.assertEqual(server.clients(), 1)
+
+    def test_partial_input(self):
+        '''
+        Receiving part of a line doesn't block, and a client sending too long
+        a line gets disconnected.
+        '''
+        server = ipc.server.ServerIPC(self._path)
+        self.addCleanup(server.close)
+        client = self._connect()
+        client.sendall(b'a=1\n')
+        self.assertEqual(self._receive(server), ('a', '1'))
+        client.sendall(b'b=')
+        self.assertIs(server.receive(), ipc.NO_SIGNAL)
+        client.sendall(b'2\n')
+        self.assertEqual(self._receive(server), ('b', '2'))
+
+        def send_long_line():
+            try:
+                client.sendall(b'c=' + b'x' * ipc.server.CLIENT_INPUT_MAX)
+            except OSError:
+                # disconnected before the whole line was sent
+                pass
+
+        sender = threading.Thread(target=send_long_line)
+        sender.start()
+        while server.clients():
+            self.assertIs(server.receive(), ipc.NO_SIGNAL)
+        sender.join()
+
+    def test_vsm_server(self):
+        sig_num_path = os.path.join(SIGNAL_NUMBER_PATH, SIGNAL_NUM_FILE)
+        cmd = ['./vsm.py', '--signal-number-file={}'.format(sig_num_path),
+               '--log-file={}'.format(os.path.join(self._dir, 'vsm.log')),
+               os.path.join(RULES_PATH, 'simple0.yaml'),
+               '--ipc-modules', 'ipc.server.ServerIPC']
+        process = Popen(cmd, stdout=PIPE)
+        self.addCleanup(process.stdout.close)
+        self.addCleanup(process.wait)
+        self.addCleanup(process.kill)
+
+        path = ipc.server.SOCKET_PATH_DEFAULT
+        for _ in range(50):
+            try:
+                car = self._connect(path)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                time.sleep(0.1)
+        gear = self._connect(path)
+        car.sendall(b'subscribe=car.\n')
+        gear.sendall(b'subscribe=nothing\n')
+        # let VSM handle the subscription first
+        time.sleep(0.2)
+        # a line received in two parts
+        gear.sendall(b'transmission.gear = ')
+        time.sleep(0.1)
+        gear.sendall(b'"reverse"\n')
+
+        self.assertEqual(car.recv(100), b'car.backup=True\n')
+        car.sendall(b'quit\n')
+        self.assertEqual(process.wait(5), 0)
+
+        # connections, subscriptions and partial lines aren't invalid messages
+        with open(os.path.join(self._dir, 'vsm.log')) as f:
+            self.assertNotIn("skipping invalid message", f.read())
+
+
+class ExpressionTests(unittest.TestCase):
+
+    def _compile(self, condition, names=None):
+        expr = ast.parse(condition, mode='eval').body
+        return vsmlib.expression.compile_expression(expr, names)
+
+    def test_operators(self):
+        variables = {'a': 3, 'b': 'x', 'c': True}
+        for condition, result in [('a > 2 and a <= 3', True),
+                                  ('a * 2 - 1 == 5', True),
+                                  ('a // 2 + a % 2 != 2', False),
+                                  ('-a < 0 or not c', True),
+                                  ("b == 'x' and c", True),
+                                  ('a / 2 == 1.5', True),
+                                  ('c != (a == 3)', False),
+                                  ('b is None', None)]:
+            if result is None:
+                self.assertRaises(ValueError, self._compile, condition)
+            else:
+                self.assertEqual(self._compile(condition)(variables), result,
+                                 condition)
+
+    def test_rejected(self):
+        for condition in ['len(a) > 2', 'a.__class__ == 1', 'a[0] == 1',
+                          'a ** 2 > 4', '(lambda: 1)() == 1',
+                          '[x for x in a] == []', '__import__ == 1 and f(1)',
+                          "a == b'x'"]:
+            with self.assertRaises(ValueError, msg=condition):
+                self._compile(condition)
+
+    def test_aggregates(self):
+        calls = []
+
+        def aggregate(function, signal, length_ms):
+            calls.append((function, signal, length_ms))
+            return lambda: len(calls)
+
+        expr = ast.parse('avg(a_b, 2000) > 1 and max(c, 5) == 2',
+                         mode='eval').body
+        expression = vsmlib.expression.compile_expression(
+                expr, {'a_b': 'a.b'}, aggregate)
+        self.assertTrue(expression({}))
+        self.assertEqual(calls, [('avg', 'a.b', 2000), ('max', 'c', 5)])
+
+        for condition in ['avg(a) > 1', 'avg(a, 0) > 1', "min(a, 'x') > 1",
+                          'count(1, 10) > 1', 'max(a, b=10) > 1']:
+            with self.assertRaises(ValueError, msg=condition):
+                vsmlib.expression.compile_expression(
+                        ast.parse(condition, mode='eval').body, {}, aggregate)
+        # aggregates need to be enabled
+        self.assertRaises(ValueError, self._compile, 'avg(a, 10) > 1')
+
+    def test_temporal(self):
+        calls = []
+
+        def temporal(function, expressions, signals, length_ms):
+            calls.append((function, [e({'a.b': 2, 'c': 0}) for e in
+                                     expressions], signals, length_ms))
+            return lambda: function == 'held'
+
+        expr = ast.parse('held(a_b > 1, 500) and not within(c, a_b + c, 10)',
+                         mode='eval').body
+        expression = vsmlib.expression.compile_expression(
+                expr, {'a_b': 'a.b'}, None, temporal)
+        self.assertTrue(expression({}))
+        self.assertEqual(calls, [('held', [True], ['a.b'], 500),
+                                 ('within', [0, 2], ['c', 'a.b'], 10)])
+
+        for condition in ['held(a > 1)', 'held(a > 1, 0)', 'held(a, b, 10)',
+                          'within(a, 10)', 'held(held(a, 10), 10)',
+                          'within(a, held(b, 10), 10)', 'held(len(a), 10)']:
+            with self.assertRaises(ValueError, msg=condition):
+                vsmlib.expression.compile_expression(
+                        ast.parse(condition, mode='eval').body, {}, None,
+                        temporal)
+        # temporal operators need to be enabled
+        self.assertRaises(ValueError, self._compile, 'held(a, 10)')
+
+    def test_constant_folding(self):
+        # the operators which aren't allowed are never evaluated
+        for condition in ['a == 9 ** 9 ** 9', 'a == 2 ** 3']:
+            expr = ast.parse(condition, mode='eval').body
+            self.assertRaises(ValueError, vsmlib.expression.check, expr)
+            folded = vsmlib.optimizer.ConstantFolder().visit(expr)
+            self.assertEqual(ast.unparse(folded), condition)
+
+        # nor are the results which would be too large
+        for condition, folded in [('a == 1000 * 1000', 'a == 1000000'),
+                                  ("a == 'ab' * 3", "a == 'ababab'"),
+                                  ("a == 'ab' * 100000", "a == 'ab' * 100000"),
+                                  ('a == {0} * {0}'.format(10 ** 1000),
+                                   'a == {0} * {0}'.format(10 ** 1000))]:
+            expr = ast.parse(condition, mode='eval').body
+            expr = vsmlib.optimizer.ConstantFolder().visit(expr)
+            self.assertEqual(ast.unparse(expr), folded)
+
+        # rejected when loading the rules, with or without the optimizer
+        sig_num_path = os.path.join(SIGNAL_NUMBER_PATH, SIGNAL_NUM_FILE)
+        with tempfile.NamedTemporaryFile('w', suffix='.yaml') as rules_file:
+            rules_file.write('- condition: transmission.gear == 9 ** 9 ** 9\n')
+            rules_file.flush()
+            for options in [[], ['--no-optimize-rules']]:
+                cmd = ['./vsm.py', '--signal-number-file={}'.format(
+                           sig_num_path),
+                       '--log-file={}'.format(VSM_LOG_FILE)] + options + \
+                      [rules_file.name]
+                process = Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE,
+                                universal_newlines=True)
+                _, errors = process.communicate('quit=\n', 10)
+                self.assertEqual(process.returncode, 1)
+                self.assertIn('unsupported Pow', errors)
+        if os.path.exists(VSM_LOG_FILE):
+            os.remove(VSM_LOG_FILE)
+
+    def test_no_builtins(self):
+        expression = self._compile('True == a')
+        self.assertTrue(expression({'a': True}))
+        self.assertRaises(KeyError, self._compile('len == 1'), {})
+
+    def test_unset(self):
+        expression = self._compile('a > 1 or b > 1')
+        self.assertTrue(expression({'a': 2}))
+        self.assertRaises(KeyError, expression, {'b': 2})
+
+    def test_names(self):
+        expression = self._compile('car_backup and car_speed > 10',
+                                   {'car_backup': 'car.backup',
+                                    'car_speed': 'car.speed'})
+        self.assertTrue(expression({'car.backup': True, 'car.speed': 20}))
+        self.assertFalse(expression({'car.backup': False}))
+
+    def test_invalid_rule(self):
+        sig_num_path = os.path.join(SIGNAL_NUMBER_PATH, SIGNAL_NUM_FILE)
+        with tempfile.NamedTemporaryFile('w', suffix='.yaml') as rules:
+            rules.write("- condition: transmission.gear[0] == 'r'\n"
+                        "  emit:\n"
+                        "    signal: car.backup\n"
+                        "    value: true\n")
+            rules.flush()
+            cmd = ['./vsm.py', '--signal-number-file={}'.format(sig_num_path),
+                   '--log-file={}'.format(VSM_LOG_FILE), rules.name]
+            process = Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE,
+                            universal_newlines=True)
+            _, stderr = process.communicate('quit=\n', timeout=10)
+        self.assertEqual(process.returncode, 1)
+        self.assertIn('invalid condition', stderr)
+
+
+class SignalFilterTests(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0
+        self.scheduler = vsmlib.scheduler.DeadlineScheduler(
+                lambda: self.now, threaded=False)
+        self.processed = []
+
+    def _push(self, signal_filter, time_ms, value):
+        self.now = time_ms
+        self.scheduler.run_due()
+        signal_filter.push(value)
+
+    def test_interval(self):
+        signal_filter = vsmlib.signal_filter.SignalFilter(
+                'speed.value', lambda *args: self.processed.append(args),
+                self.scheduler, interval_ms=100)
+        for time_ms, value in [(0, 1), (10, 2), (50, 3), (120, 4)]:
+            self._push(signal_filter, time_ms, value)
+        # the latest value is processed at the end of the interval, on the
+        # shared scheduler
+        self.assertEqual(self.processed, [('speed.value', 1),
+                                          ('speed.value', 3)])
+        self.assertEqual(len(self.scheduler), 1)
+        self.now = 220
+        self.assertEqual(self.scheduler.run_due(), 1)
+        self.assertEqual(self.processed[-1], ('speed.value', 4))
+        self.assertEqual(signal_filter.stats(),
+                         {'received': 4, 'processed': 3})
+
+        self._push(signal_filter, 230, 5)
+        self.assertEqual(len(self.scheduler), 1)
+        signal_filter.cancel()
+        self.assertEqual(len(self.scheduler), 0)
+
+
+class SignalWindowTests(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0
+        self.window = vsmlib.windows.SignalWindow(lambda: self.now,
+                                                  capacity=4)
+
+    def _append(self, time_ms, value):
+        self.now = time_ms
+        self.window.append(value)
+
+    def _aggregates(self, length_ms):
+        return [self.window.aggregate(function, length_ms)()
+                for function in vsmlib.windows.AGGREGATE_FUNCTIONS]
+
+    def test_aggregates(self):
+        self._append(0, 5)
+        # created after the first value, which is still taken into account
+        self.assertEqual(self._aggregates(100), [5, 5, 5, 0, 1])
+        for time_ms, value in [(10, 3), (20, 8), (30, 'x'), (40, 6)]:
+            self._append(time_ms, value)
+
+        # the first value was overwritten, strings are only counted
+        self.assertEqual(self._aggregates(100), [17 / 3, 3, 8, 3, 4])
+        self.assertEqual(self._aggregates(15), [6, 6, 6, 0, 2])
+
+        # expired, the aggregates of the current value
+        self.now = 125
+        self.assertEqual(self._aggregates(100), [6, 6, 6, 0, 2])
+        self.now = 200
+        self.assertEqual(self._aggregates(100), [6, 6, 6, 0, 0])
+
+    def test_min_max(self):
+        minimum = self.window.aggregate('min', 1000)
+        maximum = self.window.aggregate('max', 1000)
+        values = [4, 1, 3, 2, 5, 0, 3]
+        for i, value in enumerate(values):
+            self._append(i, value)
+            last = values[max(i - 3, 0):i + 1]
+            self.assertEqual((minimum(), maximum()), (min(last), max(last)))
+
+    def test_unset(self):
+        self.assertRaises(KeyError, self.window.aggregate('avg', 10))
+        self.assertRaises(ValueError, self.window.aggregate, 'sum', 10)
+
+    def test_rules(self):
+        sig_num_path = os.path.join(SIGNAL_NUMBER_PATH, SIGNAL_NUM_FILE)
+        cmd = ['./vsm.py', '--signal-number-file={}'.format(sig_num_path),
+               '--log-file={}'.format(VSM_LOG_FILE),
+               '--log-disable=condition-checks', '--log-disable=state',
+               os.path.join(RULES_PATH, 'aggregates.yaml')]
+        process = Popen(cmd, stdin=PIPE, stdout=PIPE, universal_newlines=True)
+        process.communicate('speed.value = 40\nspeed.value = 60\n'
+                            'speed.value = 70\nspeed.value = 10\nquit=\n', 2)
+        self.assertEqual(process.returncode, 0)
+
+        with open(VSM_LOG_FILE) as f:
+            log_output = _remove_timestamp(f.read())
+        os.remove(VSM_LOG_FILE)
+
+        # the average is only above 50 with the third value, the last one is
+        # 30 below the first
+        self.assertEqual(log_output, "speed.value,8,40\n"
+                                     "speed.value,8,60\n"
+                                     "speed.value,8,70\n"
+                                     "car.stop,4,'True'\n"
+                                     "speed.value,8,10\n"
+                                     "horn,20,'True'\n")
+
+
+class HistoryStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        self.history = vsmlib.history.HistoryStore(3, {'b': 1, 'c': 0})
+
+    def test_last(self):
+        for time_ms, value in enumerate([1, 2, 3, 4]):
+            self.history.record('a', value, time_ms)
+        # numbers are kept as doubles
+        self.assertEqual(self.history.last('a'), [(1, 2.0), (2, 3.0),
+                                                  (3, 4.0)])
+        self.assertEqual(self.history.last('a', 2), [(2, 3.0), (3, 4.0)])
+        self.assertEqual(self.history.last('a', 10), self.history.last('a'))
+        self.assertEqual(self.history.last('x'), [])
+
+    def test_range(self):
+        for time_ms, value in [(10, 1), (20, 2), (30, 3), (40, 4)]:
+            self.history.record('a', value, time_ms)
+        self.assertEqual(self.history.range('a', 20, 30), [(20, 2), (30, 3)])
+        self.assertEqual(self.history.range('a', 25), [(30, 3), (40, 4)])
+        self.assertEqual(self.history.range('a', end_ms=5), [])
+        self.assertEqual(self.history.range('a', 35, 31), [])
+        self.assertEqual(self.history.range('x', 0, 100), [])
+
+    def test_sizes(self):
+        for time_ms, value in enumerate([1, 2]):
+            for signal in ['a', 'b', 'c']:
+                self.history.record(signal, value, time_ms)
+        self.assertEqual(self.history.last('b'), [(1, 2)])
+        self.assertEqual(sorted(self.history.signals()), ['a', 'b'])
+        # 8 bytes per time and value
+        self.assertEqual(self.history.memory(), 48)
+
+    def test_values(self):
+        for time_ms, value in enumerate([1, 2, 'x', True]):
+            self.history.record('a', value, time_ms)
+            self.history.record('b', [value], time_ms)
+        self.assertEqual(self.history.last('a'), [(1, 2), (2, 'x'),
+                                                  (3, True)])
+        self.assertEqual(self.history.last('b'), [(3, [True])])
+
+    def test_query(self):
+        sig_num_path = os.path.join(SIGNAL_NUMBER_PATH, SIGNAL_NUM_FILE)
+        cmd = ['./vsm.py', '--signal-number-file={}'.format(sig_num_path),
+               '--log-file={}'.format(VSM_LOG_FILE),
+               '--ipc-modules=ipc.stream.StdioIPC', '--history=2',
+               '--history-signal=car.stop=0',
+               os.path.join(RULES_PATH, 'aggregates.yaml')]
+        process = Popen(cmd, stdin=PIPE, stdout=PIPE, universal_newlines=True)
+        output, _ = process.communicate(
+            'speed.value = 40\nspeed.value = 60\nspeed.value = 70\n'
+            'history = speed.value\nhistory = car.stop\n'
+            'history = speed.value,1\nhistory = speed.value,,\nquit=\n', 2)
+        self.assertEqual(process.returncode, 0)
+
+        replies = [json.loads(line.partition('=')[2])
+                   for line in output.splitlines()
+                   if line.startswith('history=')]
+        self.assertEqual([[value for _, value in reply['values']]
+                          for reply in replies],
+                         [[60, 70], [], [70], [60, 70]])
+        self.assertEqual(replies[0]['signal'], 'speed.value')
+
+
+class TemporalTests(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0
+        self.scheduler = vsmlib.scheduler.DeadlineScheduler(
+                lambda: self.now, threaded=False)
+        self.expired = []
+
+    def _run(self, time_ms):
+        self.now = time_ms
+        return self.scheduler.run_due()
+
+    def test_scheduler(self):
+        calls = []
+        for time_ms in [30, 10, 20, 10]:
+            self.scheduler.schedule(time_ms, calls.append, time_ms)
+        cancelled = self.scheduler.schedule(15, calls.append, 15)
+        self.scheduler.cancel(cancelled)
+        self.assertEqual(len(self.scheduler), 4)
+
+        self.assertEqual(self._run(5), 0)
+        self.assertEqual(self._run(20), 3)
+        self.assertEqual(calls, [10, 10, 20])
+        # already called
+        self.scheduler.cancel(cancelled)
+        self.assertEqual(len(self.scheduler), 1)
+        self.assertEqual(self._run(100), 1)
+        self.assertEqual(calls, [10, 10, 20, 30])
+
+    def test_compact(self):
+        deadlines = [self.scheduler.schedule(i, print) for i in range(100)]
+        for deadline in deadlines[:60]:
+            self.scheduler.cancel(deadline)
+        # the heap was rebuilt without the cancelled deadlines
+        self.assertEqual(len(self.scheduler._heap), 49)
+        self.assertEqual(len(self.scheduler), 40)
+
+    def test_thread(self):
+        called = threading.Event()
+        scheduler = vsmlib.scheduler.DeadlineScheduler(
+                lambda: time.perf_counter() * 1000)
+        scheduler.schedule(time.perf_counter() * 1000 + 50, called.set)
+        self.assertTrue(called.wait(2))
+
+    def test_thread_error(self):
+        '''
+        A function raising an exception doesn't stop the thread.
+        '''
+        called = threading.Event()
+        errors = []
+        scheduler = vsmlib.scheduler.DeadlineScheduler(
+                lambda: time.perf_counter() * 1000, error=errors.append)
+        now_ms = time.perf_counter() * 1000
+        scheduler.schedule(now_ms + 10, lambda: 1 / 0)
+        scheduler.schedule(now_ms + 50, called.set)
+        self.assertTrue(called.wait(2))
+        self.assertEqual([type(err) for err in errors], [ZeroDivisionError])
+
+    def _held(self, length_ms):
+        expression = vsmlib.expression.compile_expression(
+                ast.parse('a > 1', mode='eval').body)
+        return vsmlib.temporal.operator('held', [expression], ['a'],
+                                        length_ms, lambda: self.now,
+                                        self.scheduler, self.expired.append)
+
+    def test_held(self):
+        held = self._held(100)
+        held.update({})
+        self.assertFalse(held())
+
+        held.update({'a': 2})
+        self._run(50)
+        held.update({'a': 3})
+        self.assertFalse(held())
+        self.assertEqual(self._run(100), 1)
+        self.assertEqual(self.expired, [held])
+        self.assertTrue(held())
+
+        # the deadline is cancelled when the expression becomes false
+        held.update({'a': 0})
+        self.assertFalse(held())
+        held.update({'a': 2})
+        self._run(150)
+        held.update({'a': 0})
+        self.assertEqual(self._run(300), 0)
+        self.assertEqual(self.expired, [held])
+        self.assertFalse(held())
+
+    def test_within(self):
+        first, second = (vsmlib.expression.compile_expression(
+                ast.parse(expr, mode='eval').body) for expr in ['a', 'b'])
+        within = vsmlib.temporal.operator('within', [first, second],
+                                          ['a', 'b'], 100, lambda: self.now,
+                                          self.scheduler, None)
+        within.update({'a': False, 'b': False})
+        self.now = 10
+        within.update({'a': True, 'b': False})
+        self.now = 110
+        within.update({'a': True, 'b': True})
+        self.assertTrue(within())
+        within.update({'a': False, 'b': True})
+        self.assertTrue(within())
+        within.update({'a': False, 'b': False})
+        self.assertFalse(within())
+
+        # too late
+        self.now = 200
+        within.update({'a': True, 'b': False})
+        self.now = 301
+        within.update({'a': True, 'b': True})
+        self.assertFalse(within())
+        # already true before the first expression
+        self.now = 400
+        within.update({'a': False, 'b': True})
+        within.update({'a': True, 'b': True})
+        self.assertFalse(within())
+        self.assertEqual(len(self.scheduler), 0)
+
+    def test_rules(self):
+        sig_num_path = os.path.join(SIGNAL_NUMBER_PATH, SIGNAL_NUM_FILE)
+        cmd = ['./vsm.py', '--signal-number-file={}'.format(sig_num_path),
+               '--log-file={}'.format(VSM_LOG_FILE),
+               '--log-disable=condition-checks', '--log-disable=state',
+               os.path.join(RULES_PATH, 'temporal.yaml')]
+        process = Popen(cmd, stdin=PIPE, stdout=PIPE, universal_newlines=True)
+        process.stdin.write('speed.value = 0\nspeed.value = 120\n')
+        process.stdin.flush()
+        # the horn is emitted once the speed has been above 100 for 500ms,
+        # without any other signal
+        time.sleep(1)
+        process.communicate("transmission.gear = 'reverse'\n"
+                            "speed.value = 0\nspeed.value = 20\nquit=\n", 2)
+        self.assertEqual(process.returncode, 0)
+
+        with open(VSM_LOG_FILE) as f:
+            log_output = _remove_timestamp(f.read())
+        os.remove(VSM_LOG_FILE)
+
+        self.assertEqual(log_output, "speed.value,8,0\n"
+                                     "speed.value,8,120\n"
+                                     "horn,20,'True'\n"
+                                     "transmission.gear,9,'reverse'\n"
+                                     "speed.value,8,0\n"
+                                     "speed.value,8,20\n"
+                                     "car.stop,4,'True'\n")
+
+
+class StalenessTests(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0
+        self.scheduler = vsmlib.scheduler.DeadlineScheduler(
+                lambda: self.now, threaded=False)
+        self.timed_out = []
+        self.monitor = vsmlib.staleness.StalenessMonitor(
+                lambda: self.now, self.scheduler, self.timed_out.append)
+        self.monitor.set_timeouts({'a': 100, 'b': 50})
+
+    def _run(self, time_ms):
+        self.now = time_ms
+        self.scheduler.run_due()
+
+    def test_timeout(self):
+        # receiving a signal doesn't touch its deadline
+        for time_ms in range(0, 100, 10):
+            self.now = time_ms
+            self.assertFalse(self.monitor.received('a'))
+            self.assertFalse(self.monitor.received('x'))
+        self.assertEqual(len(self.scheduler), 2)
+
+        # never received
+        self._run(50)
+        self.assertEqual(self.timed_out, ['b'])
+        # moved to 100ms after the last time it was received
+        self._run(100)
+        self.assertEqual(self.timed_out, ['b'])
+        self._run(189)
+        self.assertEqual(self.timed_out, ['b'])
+        self._run(190)
+        self.assertEqual(self.timed_out, ['b', 'a'])
+        self.assertEqual(self.monitor.stale, {'a', 'b'})
+
+        # received again
+        self.assertTrue(self.monitor.received('a'))
+        self.assertFalse(self.monitor.received('a'))
+        self.assertEqual(self.monitor.stale, {'b'})
+        self._run(290)
+        self.assertEqual(self.timed_out, ['b', 'a', 'a'])
+
+    def test_set_timeouts(self):
+        self._run(10)
+        self.monitor.received('a')
+        self.monitor.set_timeouts({'a': 20, 'c': 30})
+        self._run(30)
+        self.assertEqual(self.timed_out, ['a'])
+        self._run(40)
+        self.assertEqual(self.timed_out, ['a', 'c'])
+        # removed
+        self._run(1000)
+        self.assertEqual(self.timed_out, ['a', 'c'])
+        self.assertEqual(len(self.scheduler), 0)
+
+    def test_signal_number_file(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.vsi') as vsi_file:
+            vsi_file.write('1.0\na 1 timeout=500\na_timeout 2\nb 3\n')
+            vsi_file.flush()
+            timeouts = {}
+            signal_to_num, _ = vsmlib.utils.parse_signal_num_file(
+                    vsi_file.name, timeouts)
+        self.assertEqual(signal_to_num, {'a': 1, 'a_timeout': 2, 'b': 3})
+        self.assertEqual(timeouts, {'a': 500})
+
+        for line in ['a 1 timeout=0', 'a 1 timeout=x', 'a 1 delay=10']:
+            with tempfile.NamedTemporaryFile('w', suffix='.vsi') as vsi_file:
+                vsi_file.write('1.0\n{}\n'.format(line))
+                vsi_file.flush()
+                with self.assertRaises(SystemExit, msg=line), \
+                        open(os.devnull, 'w') as devnull, \
+                        contextlib.redirect_stderr(devnull):
+                    vsmlib.utils.parse_signal_num_file(vsi_file.name)
+
+    def test_rules(self):
+        sig_num_path = os.path.join(SIGNAL_NUMBER_PATH, SIGNAL_NUM_FILE)
+        cmd = ['./vsm.py', '--signal-number-file={}'.format(sig_num_path),
+               '--log-file={}'.format(VSM_LOG_FILE),
+               '--log-disable=condition-checks', '--log-disable=state',
+               os.path.join(RULES_PATH, 'timeouts.yaml')]
+        process = Popen(cmd, stdin=PIPE, stdout=PIPE, universal_newlines=True)
+        process.stdin.write('sensor.heartbeat = 1\n')
+        process.stdin.flush()
+        time.sleep(0.1)
+        process.stdin.write('sensor.heartbeat = 2\n')
+        process.stdin.flush()
+        # times out 300ms after the last value
+        time.sleep(0.6)
+        process.communicate('sensor.heartbeat = 3\nquit=\n', 2)
+        self.assertEqual(process.returncode, 0)
+
+        with open(VSM_LOG_FILE) as f:
+            log_output = _remove_timestamp(f.read())
+        os.remove(VSM_LOG_FILE)
+
+        self.assertEqual(log_output, "sensor.heartbeat,5050,1\n"
+                                     "sensor.heartbeat,5050,2\n"
+                                     "sensor.heartbeat_timeout,5051,True\n"
+                                     "horn,20,'True'\n"
+                                     "sensor.heartbeat,5050,3\n"
+                                     "sensor.heartbeat_timeout,5051,False\n")
+
+
+class PredicateIndexTests(unittest.TestCase):
+
+    CONDITIONS = ['a > 3', 'a >= 3', 'a < 3', 'a <= 3', '5 > a', '2 <= a',
+                  'a == 3', 'a == 4', '3 == a', 'a > 1.5', 'a != 3',
+                  'a > 1 and a < 4', "a == 'x'"]
+
+    def _index(self, conditions):
+        rules = []
+        predicates = {}
+        expressions = {}
+        for condition in conditions:
+            expr = ast.parse(condition, mode='eval').body
+            rule = object()
+            rules.append(rule)
+            expressions[rule] = vsmlib.expression.compile_expression(expr)
+            predicate = vsmlib.predicates.match(expr)
+            if predicate:
+                predicates[rule] = predicate
+        index = vsmlib.predicates.PredicateIndex({'a': rules}, predicates)
+        return index, rules, expressions
+
+    def test_match(self):
+        for condition, predicate in [('a > 3', ('>', 3)),
+                                     ('3 > a', ('<', 3)),
+                                     ('a <= 2.5', ('<=', 2.5)),
+                                     ("a == 'x'", ('==', 'x')),
+                                     ("'x' == a", ('==', 'x')),
+                                     ('a != 3', None), ('a > b', None),
+                                     ("a > 'x'", None), ('1 < a < 3', None),
+                                     ('a > 1 and a < 3', None)]:
+            expr = ast.parse(condition, mode='eval').body
+            self.assertEqual(vsmlib.predicates.match(expr), predicate,
+                             condition)
+
+    def test_select(self):
+        index, rules, expressions = self._index(self.CONDITIONS[:-1])
+        self.assertEqual(index.indexed, 10)
+        values = [0, 1, 1.5, 2, 3, 3.0, 4, 5, True]
+        for old in values:
+            for new in values:
+                selected = index.select('a', rules, old, new)
+                # the conditions false for both values are the only ones
+                # skipped, and the order is kept
+                expected = [rule for rule in rules
+                            if expressions[rule]({'a': old}) or
+                            expressions[rule]({'a': new}) or
+                            rule in index._signals['a'].unindexed]
+                self.assertEqual(selected, expected, (old, new))
+
+    def test_fallback(self):
+        index, rules, _ = self._index(self.CONDITIONS)
+        unset = vsmlib.predicates.UNSET
+        self.assertIs(index.select('a', rules, unset, 3), rules)
+        self.assertIs(index.select('a', rules, 3, 'x'), rules)
+        self.assertIs(index.select('b', rules, 3, 4), rules)
+
+        index, rules, _ = self._index(['a == 3', "a == 'x'", 'a != 2'])
+        self.assertEqual(index.select('a', rules, 'y', 'x'),
+                         [rules[1], rules[2]])
+        self.assertEqual(index.select('a', rules, 3, 'x'), rules)
+
+
+class PropagationTests(unittest.TestCase):
+
+    def tearDown(self):
+        if os.path.exists(VSM_LOG_FILE):
+            os.remove(VSM_LOG_FILE)
+
+    def _run_vsm(self, rules_path, input_data):
+        sig_num_path = os.path.join(SIGNAL_NUMBER_PATH, SIGNAL_NUM_FILE)
+        cmd = ['./vsm.py', '--signal-number-file={}'.format(sig_num_path),
+               '--log-file={}'.format(VSM_LOG_FILE),
+               '--log-disable=state', '--propagate-emits', rules_path]
+        process = Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE,
+                        universal_newlines=True)
+        _, errors = process.communicate(input_data + 'quit=\n', 2)
+        return process.returncode, errors
+
+    def test_rank_signals(self):
+        ranks = vsmlib.dependencies.rank_signals({
+            'horn': {'car.stop', 'lights'},
+            'car.stop': {'ignition'},
+            'lights': {'ignition', 'car.stop'},
+        })
+        self.assertEqual(sorted(ranks, key=ranks.get),
+                         ['ignition', 'car.stop', 'lights', 'horn'])
+
+        with self.assertRaisesRegex(ValueError, 'b -> c -> b'):
+            vsmlib.dependencies.rank_signals({'b': {'a', 'c'}, 'c': {'b'}})
+
+    def test_propagate(self):
+        '''
+        The emitted signals are processed in the order of their dependencies,
+        so the last condition is only evaluated once both of its signals are
+        set.
+        '''
+        returncode, _ = self._run_vsm(
+                os.path.join(RULES_PATH, 'propagation.yaml'),
+                'ignition = true\n')
+        self.assertEqual(returncode, 0)
+
+        with open(VSM_LOG_FILE) as f:
+            log_output = _remove_timestamp(f.read())
+        self.assertEqual(log_output, """ignition,10,True
+condition: (ignition == True) => True
+car.stop,4,'True'
+condition: (ignition == True) => True
+lights.external.headlights,19,'True'
+condition: (car.stop == True and lights.external.headlights == True) => True
+horn,20,'True'
+""")
+
+    def test_cycle(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.yaml') as rules_file:
+            rules_file.write('- condition: ignition == true\n'
+                             '  emit:\n'
+                             '    signal: car.stop\n'
+                             '    value: true\n'
+                             '- condition: car.stop == true\n'
+                             '  emit:\n'
+                             '    signal: ignition\n'
+                             '    value: false\n')
+            rules_file.flush()
+            returncode, errors = self._run_vsm(rules_file.name, '')
+
+        self.assertEqual(returncode, 1)
+        self.assertIn("car.stop -> ignition -> car.stop", errors)
+
+
+class RuleOptimizerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.optimizer = vsmlib.optimizer.RuleOptimizer()
+
+    def _optimize(self, condition):
+        expr = ast.parse(condition, mode='eval').body
+        return self.optimizer.optimize(expr, condition)
+
+    def test_fold_constants(self):
+        expr = self._optimize('speed >= (88 - 10) * 2 and speed < 88 * 2')
+        self.assertEqual(ast.unparse(expr), 'speed >= 156 and speed < 176')
+
+    def test_simplify(self):
+        expr = self._optimize('a == 1 and (True and a == 1) or 1 > 2')
+        self.assertEqual(ast.unparse(expr), 'a == 1')
+
+    def test_operand_order(self):
+        '''
+        The operands of boolean operations are never reordered, as the first
+        ones may guard the evaluation of the next ones.
+        '''
+        expr = self._optimize('a * 2 + 1 > 3 or a > 1')
+        self.assertEqual(ast.unparse(expr), 'a * 2 + 1 > 3 or a > 1')
+        expr = self._optimize("not a == 'off' and a > 3")
+        self.assertEqual(ast.unparse(expr), "not a == 'off' and a > 3")
+        function = vsmlib.expression.compile_expression(expr)
+        self.assertFalse(function({'a': 'off'}))
+        self.assertTrue(function({'a': 5}))
+
+    def test_never_true(self):
+        for condition in ['a > 5 and a < 3', 'a == 1 and a == 2',
+                          'a >= 3 and 3 > a', "a == 'x' and a != 'x'",
+                          '1 > 2', '(a > 2 and a < 1) or 2 > 3']:
+            self.assertTrue(self.optimizer.never_true(
+                self._optimize(condition)), condition)
+        for condition in ['a > 3 and a < 5', 'a >= 3 and a <= 3',
+                          'a > 5 or a < 3', "a == 'x' and b == 'y'"]:
+            self.assertFalse(self.optimizer.never_true(
+                self._optimize(condition)), condition)
+
+    def test_share(self):
+        code1 = self.optimizer.compile(self._optimize('a > 2 * 2'), 'a')
+        code2 = self.optimizer.compile(self._optimize('a > 4'), 'b')
+        code3 = self.optimizer.compile(self._optimize('a > 5'), 'c')
+        self.assertIs(code1, code2)
+        self.assertIsNot(code1, code3)
+        self.assertTrue(code1({'a': 5}))
+        self.assertFalse(code3({'a': 5}))
+        code4 = self.optimizer.compile(self._optimize('a > 4'), 'd',
+                                       {'a': 'x.a'})
+        self.assertIsNot(code1, code4)
+        self.assertTrue(code4({'x.a': 5}))
+
+
+class RulesReloadTests(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._rules = os.path.join(self._dir, 'rules.yaml')
+        shutil.copy(os.path.join(RULES_PATH, 'simple0.yaml'), self._rules)
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_reload(self):
+        '''
+        Change the rules file while VSM is running and reload it with the
+        'reload' signal.
+        '''
+        sig_num_path = os.path.join(SIGNAL_NUMBER_PATH, SIGNAL_NUM_FILE)
+        cmd = ['./vsm.py', '--signal-number-file={}'.format(sig_num_path),
+               '--log-file={}'.format(VSM_LOG_FILE), self._rules]
+        process = Popen(cmd, stdin=PIPE, stdout=PIPE, universal_newlines=True)
+
+        def send(data):
+            process.stdin.write(data + '\n')
+            process.stdin.flush()
+            time.sleep(0.2)
+
+        send('transmission.gear = "reverse"')
+        with open(self._rules) as f:
+            rules = f.read()
+        with open(self._rules, 'w') as f:
+            f.write(rules.replace('car.backup', 'car.stop'))
+        send('reload = 1')
+        send('transmission.gear = "park"')
+        send('transmission.gear = "reverse"')
+        output, _ = process.communicate('quit=\n', 2)
+        self.assertEqual(process.returncode, 0)
+
+        with open(VSM_LOG_FILE) as f:
+            log_output = f.read()
+
+        self.assertIn("1 kept, 1 parsed, 1 removed", log_output)
+        self.assertEqual(_remove_timestamp(output).splitlines()[-3:],
+                         ['transmission.gear,9,\'"reverse"\'',
+                          'car.stop,4,\'True\'', 'quit,[SIGNUM],\'\''])
+
+
+class SnapshotTests(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._snapshot = os.path.join(self._dir, 'vsm.snapshot')
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+        if os.path.exists(VSM_LOG_FILE):
+            os.remove(VSM_LOG_FILE)
+
+    def _run_vsm(self, input_data, kill=False):
+        sig_num_path = os.path.join(SIGNAL_NUMBER_PATH, SIGNAL_NUM_FILE)
+        cmd = ['./vsm.py', '--signal-number-file={}'.format(sig_num_path),
+               '--log-file={}'.format(VSM_LOG_FILE),
+               '--ipc-modules={}'.format(TestVSMNoneSignal.module),
+               '--snapshot-file={}'.format(self._snapshot),
+               os.path.join(RULES_PATH, 'monitored_condition.yaml')]
+        process = Popen(cmd, stdin=PIPE, stdout=PIPE, universal_newlines=True)
+        if kill:
+            # VSM waits for the monitor timers before exiting after a quit,
+            # simulate a restart as soon as the snapshot is written instead
+            process.stdin.write(input_data + TestVSMNoneSignal.quit_command)
+            process.stdin.close()
+            while not os.path.exists(self._snapshot):
+                time.sleep(0.01)
+            process.kill()
+            process.wait()
+            process.stdout.close()
+            return None
+        process.communicate(input_data + TestVSMNoneSignal.quit_command)
+
+        with open(VSM_LOG_FILE) as f:
+            return f.read()
+
+    def test_restore_monitor(self):
+        '''
+        Restart VSM while a monitor is active and satisfy it after restoring
+        the snapshot.
+        '''
+        self._run_vsm('transmission.gear = "forward"\n'
+                      'transmission.gear = "reverse"', kill=True)
+        log_output = self._run_vsm('camera.backup.active = True')
+
+        self.assertIn("restored snapshot", log_output)
+        self.assertIn("parent condition: transmission.gear == reverse\n"
+                      "condition: (camera.backup.active == True) => True",
+                      log_output)
+        self.assertNotIn("condition not met", log_output)
+
+
+class SignalDiffTests(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def _write_log(self, name, signals):
+        path = os.path.join(self._dir, name)
+        with open(path, 'w') as f:
+            for time_ms, signal, value in signals:
+                f.write("> {},{},[SIGNUM],'{}'\n".format(time_ms, signal, value))
+                f.write("State = {{\n{} = {}\n}}\n".format(signal, value))
+        return path
+
+    def _run_signaldiff(self, *args):
+        process = Popen(['./signaldiff'] + list(args), stdout=PIPE,
+                        universal_newlines=True)
+        output, _ = process.communicate()
+        self.assertEqual(process.returncode, 0)
+        return output
+
+    def test_time_deviation(self):
+        log1 = os.path.join(LOGS_PATH, 'simple0-replay.log')
+        log2 = os.path.join(LOGS_PATH, 'simple0-slow.log')
+
+        self.assertEqual(self._run_signaldiff(log1, log2, '-t', '1000'),
+                         "Signal 2\n"
+                         "{}:5: < 2628,car.stop,[SIGNUM],'True'\n"
+                         "{}:5: < 4000,car.stop,[SIGNUM],'True'\n"
+                         .format(log1, log2))
+        self.assertEqual(self._run_signaldiff(log1, log2, '-t', '1500'), '')
+
+    def test_unordered_windows(self):
+        signals1 = [(i * 10, 'sig{}'.format(i % 3), i % 2)
+                    for i in range(200)]
+        # swap some signals, shift the others and drop one
+        signals2 = [(t + 2, s, v) for t, s, v in signals1]
+        signals2[10], signals2[11] = signals2[11], signals2[10]
+        del signals2[150]
+        log1 = self._write_log('1.log', signals1)
+        log2 = self._write_log('2.log', signals2)
+
+        output = self._run_signaldiff(log1, log2, '-u', '-t', '5')
+        self.assertEqual(output, "Only in {0}\n"
+                         "{0}:601: > 1500,sig0,[SIGNUM],'0'\n".format(log1))
+
+        # signals matched across windows boundaries must give the same result
+        for window in ('95', '100', '333'):
+            self.assertEqual(self._run_signaldiff(
+                log1, log2, '-u', '-t', '5', '-j', '2', '-w', window), output)
+
+        summary = self._run_signaldiff(log1, log2, '-u', '-t', '5', '-s')
+        self.assertIn("Matched: 199\n", summary)
+        self.assertIn("Only in {}: 1\n".format(log1), summary)
+        self.assertIn("Time deviation: 2.000 ms average", summary)
+
+    def test_ordered_jobs(self):
+        # the signals of the second log are late enough for some pairs to
+        # straddle the boundaries of the time windows
+        signals1 = [(i * 10, 'sig{}'.format(i % 3), i % 2)
+                    for i in range(200)]
+        signals2 = [(t + 6, s, v) for t, s, v in signals1]
+        signals2.insert(100, (1003, 'sig2', 1))
+        log1 = self._write_log('1.log', signals1)
+        log2 = self._write_log('2.log', signals2)
+
+        output = self._run_signaldiff(log1, log2, '-t', '10', '-j', '1')
+        self.assertEqual(output.count("Signal "), 101)
+        self.assertEqual(self._run_signaldiff(log1, log2, '-t', '10',
+                                              '-j', '4'), output)
+
+
+class BinaryLogTests(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._path = os.path.join(self._dir, 'signals.bin')
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_records(self):
+        values = [True, 12, -3.5, 'reverse', None, 'reverse']
+        writer = vsmlib.binlog.BinaryLogWriter(self._path)
+        for i in range(10000):
+            writer.write(i * 2, 'signal.{}'.format(i % 3),
+                         i % 3 if i % 3 else None, '<>'[i % 2],
+                         values[i % len(values)])
+        writer.close()
+
+        with vsmlib.binlog.BinaryLogReader(self._path) as reader:
+            self.assertEqual(len(reader), 10000)
+            self.assertEqual(reader.record(7),
+                             (14, 'signal.1', 1, '>', 12))
+            self.assertEqual(reader.record(9999),
+                             (19998, 'signal.0', None, '>', 'reverse'))
+            self.assertEqual([r.value for r in reader.records(0, 6)], values)
+
+            self.assertEqual(reader.find_time(8191), 4096)
+            self.assertEqual(reader.find_time(8192), 4096)
+            self.assertEqual(reader.find_time(30000), 10000)
+            self.assertEqual([r.time_ms for r in
+                              reader.records_between(8190, 8196)],
+                             [8190, 8192, 8194])
+
+        # a truncated file is read up to its last complete segment
+        with open(self._path, 'r+b') as f:
+            f.truncate(os.path.getsize(self._path) - 1)
+        with vsmlib.binlog.BinaryLogReader(self._path) as reader:
+            self.assertEqual(len(reader), 8192)
+
+    def test_text_conversion(self):
+        text_log = os.path.join(LOGS_PATH, 'simple0-replay.log')
+        text_copy = os.path.join(self._dir, 'signals.log')
+
+        self.assertEqual(vsmlib.binlog.text_to_binary(text_log, self._path),
+                         2)
+        self.assertTrue(vsmlib.binlog.is_binary_log(self._path))
+        vsmlib.binlog.binary_to_text(self._path, text_copy)
+
+        with open(text_log) as f:
+            signal_lines = [l for l in f if l[0] in '<>']
+        with open(text_copy) as f:
+            self.assertEqual(f.readlines(), signal_lines)
+
+
+class LogFileTests(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._path = os.path.join(self._dir, 'vsm.log')
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def _rotated(self):
+        return sorted(f for f in os.listdir(self._dir) if f != 'vsm.log')
+
+    def test_rotation(self):
+        log_file = vsmlib.logfile.RotatingLogFile(self._path, max_size=100,
+                                                  backups=2)
+        for i in range(10):
+            log_file.write('line {:03}\n'.format(i).encode() * 5)
+        log_file.close()
+
+        # 45 bytes are written each time, so 2 of them fit in a file
+        rotated = self._rotated()
+        self.assertEqual(len(rotated), 2)
+        with open(os.path.join(self._dir, rotated[-1]), 'rb') as f:
+            self.assertTrue(f.read().startswith(b'line 006\n'))
+        with open(self._path, 'rb') as f:
+            self.assertTrue(f.read().startswith(b'line 008\n'))
+
+    def test_compression(self):
+        log_file = vsmlib.logfile.RotatingLogFile(self._path, max_size=10,
+                                                  backups=0, compress=True)
+        for i in range(3):
+            log_file.write('line {:03}\n'.format(i).encode() * 2)
+        log_file.close()
+
+        rotated = self._rotated()
+        self.assertEqual(len(rotated), 2)
+        self.assertTrue(all(f.endswith('.gz') for f in rotated))
+        with gzip.open(os.path.join(self._dir, rotated[0])) as f:
+            self.assertEqual(f.read(), b'line 000\n' * 2)
+
+    def test_ring_buffer(self):
+        log_file = vsmlib.logfile.RotatingLogFile(self._path)
+        ring_buffer = vsmlib.logfile.RingBufferLog(log_file, 20)
+        ring_buffer.write(b'first\nsecond\n')
+        ring_buffer.write(b'third\n')
+        ring_buffer.flush()
+        self.assertEqual(os.path.getsize(self._path), 0)
+
+        ring_buffer.write(b'fourth\n')
+        ring_buffer.dump()
+        ring_buffer.write(b'fifth\n')
+        ring_buffer.close()
+
+        # only whole lines are kept, within the size of the ring buffer
+        with open(self._path, 'rb') as f:
+            self.assertEqual(f.read(), b'second\nthird\nfourth\n')
+
+    def test_vsm_ring_buffer(self):
+        '''
+        Only write the logs to the file on errors and dump requests.
+        '''
+        sig_num_path = os.path.join(SIGNAL_NUMBER_PATH, SIGNAL_NUM_FILE)
+        cmd = ['./vsm.py', '--signal-number-file={}'.format(sig_num_path),
+               '--log-file={}'.format(self._path), '--log-ring-buffer=1M',
+               os.path.join(RULES_PATH, 'simple0.yaml')]
+        process = Popen(cmd, stdin=PIPE, stdout=PIPE, universal_newlines=True)
+        process.communicate('transmission.gear = "reverse"\n'
+                            'transmission.gear = reverse\nquit=\n', 2)
+        self.assertEqual(process.returncode, 0)
+
+        with open(self._path) as f:
+            log_output = _remove_timestamp(f.read())
+        self.assertEqual(log_output.splitlines(),
+                         ["transmission.gear,9,'reverse'",
+                          'State = {',
+                          'transmission.gear = reverse',
+                          '}',
+                          "condition: (transmission.gear == 'reverse') => True",
+                          "car.backup,3,'True'",
+                          'State = {',
+                          'car.backup = True',
+                          'transmission.gear = reverse',
+                          '}',
+                          'incorrect value: reverse'])
+
+
+class SlowSink(vsmlib.logsinks.LogSink):
+
+    def __init__(self, queue_size):
+        self.batches = []
+        self.writing = threading.Event()
+        self.release = threading.Event()
+        super().__init__('slow', queue_size)
+
+    def write(self, data):
+        self.writing.set()
+        self.release.wait()
+        self.batches.append(data)
+
+
+class LogSinkTests(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_json_lines(self):
+        data = b"< 12,car.backup,3,True\n> 15,transmission.gear,9,'reverse'\n" \
+               b"condition: (transmission.gear == 'reverse') => True\n"
+        self.assertEqual(
+            [json.loads(line) for line in vsmlib.logsinks.to_json_lines(data).splitlines()],
+            [{'time': 12, 'direction': 'out', 'signal': 'car.backup',
+              'signum': 3, 'value': True},
+             {'time': 15, 'direction': 'in', 'signal': 'transmission.gear',
+              'signum': 9, 'value': 'reverse'},
+             {'message': "condition: (transmission.gear == 'reverse') => True"}])
+
+    def test_slow_sink(self):
+        '''
+        A slow sink drops batches instead of blocking the caller.
+        '''
+        sink = SlowSink(queue_size=2)
+        sink.put(b'0\n')
+        self.assertTrue(sink.writing.wait(5))
+        start = time.monotonic()
+        for i in range(1, 10):
+            sink.put('{}\n'.format(i).encode())
+        self.assertLess(time.monotonic() - start, 0.5)
+        sink.release.set()
+        sink.close()
+
+        # the first batch was taken by the worker, 2 were queued
+        self.assertEqual(sink.dropped, 7)
+        self.assertEqual(b''.join(sink.batches), b'0\n1\n2\n')
+
+    def test_vsm_sinks(self):
+        '''
+        Send the logs to a JSON-lines file and a Unix datagram socket.
+        '''
+        json_path = os.path.join(self._dir, 'vsm.json')
+        socket_path = os.path.join(self._dir, 'collector')
+        collector = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        collector.bind(socket_path)
+        collector.settimeout(5)
+        self.addCleanup(collector.close)
+
+        sig_num_path = os.path.join(SIGNAL_NUMBER_PATH, SIGNAL_NUM_FILE)
+        cmd = ['./vsm.py', '--signal-number-file={}'.format(sig_num_path),
+               '--log-file={}'.format(os.path.join(self._dir, 'vsm.log')),
+               '--log-sink=json:{}'.format(json_path),
+               '--log-sink=unix:{}'.format(socket_path),
+               os.path.join(RULES_PATH, 'simple0.yaml')]
+        process = Popen(cmd, stdin=PIPE, stdout=PIPE, universal_newlines=True)
+        process.communicate('transmission.gear = "reverse"\nquit=\n', 2)
+        self.assertEqual(process.returncode, 0)
+
+        received = b''
+        while b'car.backup' not in received:
+            received += collector.recv(vsmlib.logsinks.DATAGRAM_SIZE_MAX)
+
+        # the log processor may still be finishing after VSM exits
+        for _ in range(50):
+            with open(json_path) as f:
+                from_file = f.read()
+            if 'car.backup' in from_file:
+                break
+            time.sleep(0.1)
+
+        for output in (received.decode(), from_file):
+            signals = [(r['direction'], r['signal'], r['value'])
+                       for r in map(json.loads, output.splitlines())
+                       if 'signal' in r]
+            self.assertEqual(signals, [('in', 'transmission.gear', 'reverse'),
+                                       ('out', 'car.backup', 'True')])
+
+
+class StateTableTests(unittest.TestCase):
+
+    SIGNALS = {'car.backup': 3, 'transmission.gear': 9, 'speed.value': 8,
+               'damage': 5, 'moving': 6}
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._path = os.path.join(self._dir, 'state')
+        self.writer = vsmlib.statetable.StateTableWriter(self._path,
+                                                         self.SIGNALS)
+        self.reader = vsmlib.statetable.StateTableReader(self._path)
+
+    def tearDown(self):
+        self.reader.close()
+        self.writer.close()
+        shutil.rmtree(self._dir)
+
+    def test_values(self):
+        self.assertEqual(self.reader.values(), {})
+        self.writer.set('car.backup', True, 10)
+        self.writer.update({'transmission.gear': 'reverse',
+                            'speed.value': 12.5, 'moving': None}, 20)
+        self.writer.set('damage', 'x' * 100, 30)
+        self.assertFalse(self.writer.set('unknown', 1))
+
+        self.assertEqual(self.reader.read('car.backup'), (True, 10))
+        self.assertEqual(self.reader.get(9), 'reverse')
+        self.assertEqual(self.reader.get('unknown', 'default'), 'default')
+        self.assertEqual(self.reader.values(), {
+            'car.backup': True, 'transmission.gear': 'reverse',
+            'speed.value': 12.5, 'moving': None,
+            'damage': 'x' * vsmlib.statetable.VALUE_SIZE})
+        self.assertEqual(self.reader.generation, 5)
+
+    def test_consistent_reads(self):
+        '''
+        Values are never read while they are half written, even when they
+        are written from several threads.
+        '''
+        values = ['a' * vsmlib.statetable.VALUE_SIZE, 12345678, 'b']
+        done = threading.Event()
+
+        def write(i):
+            while not done.is_set():
+                self.writer.set('transmission.gear', values[i % 3])
+                i += 1
+
+        writers = [threading.Thread(target=write, args=(i,)) for i in (0, 1)]
+        for writer in writers:
+            writer.start()
+        try:
+            for _ in range(20000):
+                self.assertIn(self.reader.get('transmission.gear', 'b'),
+                              values)
+        finally:
+            done.set()
+            for writer in writers:
+                writer.join()
+        self.assertIn(self.reader.get('transmission.gear'), values)
+
+    def test_vsm_state_table(self):
+        path = os.path.join(self._dir, 'vsm-state')
+        sig_num_path = os.path.join(SIGNAL_NUMBER_PATH, SIGNAL_NUM_FILE)
+        cmd = ['./vsm.py', '--signal-number-file={}'.format(sig_num_path),
+               '--log-file={}'.format(os.path.join(self._dir, 'vsm.log')),
+               '--state-table={}'.format(path),
+               os.path.join(RULES_PATH, 'simple0.yaml')]
+        process = Popen(cmd, stdin=PIPE, stdout=PIPE, universal_newlines=True)
+        process.communicate('transmission.gear = "reverse"\nquit=\n', 2)
+        self.assertEqual(process.returncode, 0)
+
+        with vsmlib.statetable.StateTableReader(path) as table:
+            self.assertEqual(table.values(),
+                             {'transmission.gear': 'reverse',
+                              'car.backup': 'True'})
+
+
+class LoggerTests(unittest.TestCase):
+
+    def setUp(self):
+        self._pipein, pipeout = os.pipe()
+        self.logger = vsm.Logger(pipeout)
+
+    def tearDown(self):
+        os.close(self._pipein)
+        os.close(self.logger.pipeout_fd)
+
+    def _read(self):
+        os.write(self.logger.pipeout_fd, b'.')
+        return os.read(self._pipein, 4096).decode()[:-1]
+
+    def test_lazy_formatting(self):
+        def fail():
+            self.fail("disabled message formatted")
+
+        self.logger.i(fail, category=vsm.LOG_CAT_OPTIMIZER)
+        self.logger.d(fail)
+        self.logger.set_category(vsm.LOG_CAT_STATE, False)
+        self.logger.i(fail, category=vsm.LOG_CAT_STATE)
+        self.assertEqual(self._read(), '')
+
+        self.logger.i("{} == {}", 'a', 1, category=vsm.LOG_CAT_FILTERS)
+        self.logger.set_level(vsm.LOG_LEVEL_DEBUG)
+        self.logger.d(lambda: "debug")
+        self.logger.set_level(vsm.LOG_LEVEL_ERROR)
+        self.logger.i(fail)
+        self.logger.e("error {}", 2)
+        self.assertEqual(self._read(), 'a == 1\ndebug\nerror 2\n')
+
+    def test_ring_buffer_dump(self):
+        '''
+        Errors only request a ring buffer dump when there is a ring buffer.
+        '''
+        self.logger.e("error")
+        self.assertEqual(self._read(), 'error\n')
+
+        self.logger.ring_buffer = True
+        self.logger.e("error")
+        self.assertEqual(self._read(),
+                         'error\n' + vsm.LOG_CONTROL_DUMP.decode())
+
+    def test_runtime_toggling(self):
+        '''
+        Change the log level and categories with signals.
+        '''
+        sig_num_path = os.path.join(SIGNAL_NUMBER_PATH, SIGNAL_NUM_FILE)
+        cmd = ['./vsm.py', '--signal-number-file={}'.format(sig_num_path),
+               '--log-file={}'.format(VSM_LOG_FILE),
+               '--log-disable=condition-checks', '--log-disable=state',
+               os.path.join(RULES_PATH, 'simple0.yaml')]
+        process = Popen(cmd, stdin=PIPE, stdout=PIPE, universal_newlines=True)
+        process.communicate('transmission.gear = "park"\n'
+                            'log_enable = "state"\n'
+                            'transmission.gear = "reverse"\n'
+                            'log_level = "error"\n'
+                            'transmission.gear = "park"\n'
+                            'quit=\n', 2)
+        self.assertEqual(process.returncode, 0)
+
+        with open(VSM_LOG_FILE) as f:
+            log_output = _remove_timestamp(f.read())
+        os.remove(VSM_LOG_FILE)
+
+        self.assertNotIn("condition:", log_output)
+        self.assertEqual(log_output.count("State = {"), 2)
+
+
 if __name__ == '__main__':
-    for cls in [VSMStdTests, VSMZeroMQTests, VSMNoneSignalTests]:
+    for cls in [VSMStdTests, VSMZeroMQTests, VSMNoneSignalTests,
+                ThreadedIPCTests, IPCRoutingTests, ShmRingIPCTests,
+                ServerIPCTests, ExpressionTests, SignalFilterTests,
+                SignalWindowTests,
+                HistoryStoreTests, TemporalTests, StalenessTests,
+                PredicateIndexTests,
+                PropagationTests, RuleOptimizerTests, RulesReloadTests, SnapshotTests,
+                SignalDiffTests, BinaryLogTests, LogFileTests, LogSinkTests,
+                StateTableTests, LoggerTests]:
         suite = unittest.TestLoader().loadTestsFromTestCase(cls)
         unittest.TextTestRunner(verbosity=2).run(suite)
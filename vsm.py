@@ -16,14 +16,33 @@ import os
 import argparse
 import yaml
 import ast
+import functools
 import threading
 import time
 import json
 import ipc.stream
+import ipc.threaded
 import os
 import uuid
 import vsmlib.utils
+import vsmlib.signal_filter
+import vsmlib.optimizer
+import vsmlib.expression
+import vsmlib.predicates
+import vsmlib.dependencies
+import vsmlib.windows
+import vsmlib.temporal
+import vsmlib.scheduler
+import vsmlib.staleness
+import vsmlib.history
+import vsmlib.snapshot
+import vsmlib.binlog
+import vsmlib.logfile
+import vsmlib.logsinks
+import vsmlib.statetable
+import atexit
 import re
+import heapq
 
 LOGIC_REPLACE = {'\|\|': 'or',
                  '&&': 'and',
@@ -33,23 +52,63 @@ LOGIC_REPLACE = {'\|\|': 'or',
 
 LOG_FILE_PATH_DEFAULT = 'vsm.log'
 
+# sent through the log pipe to write the ring buffer to the log file
+LOG_CONTROL_DUMP = b'\0dump\n'
+LOG_READ_SIZE = 65536
+
+LOG_CAT_GENERAL = 'general'
 LOG_CAT_CONDITION_CHECKS = 'condition-checks'
+LOG_CAT_STATE = 'state'
+LOG_CAT_FILTERS = 'filters'
+LOG_CAT_RULES = 'rules'
+LOG_CAT_IPC = 'ipc'
+LOG_CAT_OPTIMIZER = 'optimizer'
+LOG_CATEGORIES = (LOG_CAT_GENERAL, LOG_CAT_CONDITION_CHECKS, LOG_CAT_STATE,
+                  LOG_CAT_FILTERS, LOG_CAT_RULES, LOG_CAT_IPC,
+                  LOG_CAT_OPTIMIZER)
+# categories which need to be enabled explicitly
+LOG_CATEGORIES_DISABLED_DEFAULT = (LOG_CAT_OPTIMIZER,)
+
+LOG_LEVEL_ERROR = 'error'
+LOG_LEVEL_INFO = 'info'
+LOG_LEVEL_DEBUG = 'debug'
+# most important first
+LOG_LEVELS = (LOG_LEVEL_ERROR, LOG_LEVEL_INFO, LOG_LEVEL_DEBUG)
 
 SIGNAL_PREFIX_OUTGOING = '<'
 SIGNAL_PREFIX_INCOMING = '>'
 SIGNAL_PREFIX_DELIM = ' '
 
+# IPC signal requesting to reload the rules file
+SIGNAL_RELOAD = 'reload'
+# IPC signal requesting to write the log ring buffer to the log file
+SIGNAL_LOG_DUMP = 'log_dump'
+# IPC signals changing the log level and enabling or disabling a log category
+SIGNAL_LOG_LEVEL = 'log_level'
+SIGNAL_LOG_ENABLE = 'log_enable'
+SIGNAL_LOG_DISABLE = 'log_disable'
+# IPC signal requesting to log the conditions waiting for unset signals
+SIGNAL_READINESS = 'readiness'
+# IPC signal querying the history of a signal, the reply has the same name
+SIGNAL_HISTORY = 'history'
+# values of each signal of a failed monitor to log from the history
+MONITOR_HISTORY_VALUES = 10
+
+SNAPSHOT_INTERVAL_MS_DEFAULT = 1000
+
 REPLAY_RATE_MIN = 1
 REPLAY_RATE_MAX = 10000
 
 NODE_CONDITION = 'condition'
-# position of condition node within a list in the rule file
-NODE_CONDITION_POS = 0
 NODE_EMIT = 'emit'
 NODE_START = 'start'
 NODE_STOP = 'stop'
 NODE_PARALLEL = 'parallel'
 NODE_SEQUENCE = 'sequence'
+# top-level keyword to reduce the rate of an input signal
+NODE_FILTER = 'filter'
+# top-level keyword to detect when an input signal stops being received
+NODE_TIMEOUT = 'timeout'
 # a special name for the rules document root node
 NODE_ROOT = 'root'
 # a special node to group YAML map elements together which otherwise would not
@@ -71,31 +130,61 @@ node_refs = {}
 state = None
 ipc_obj = None
 signal_to_num = {}
+# timeout of the signals from the signal number file, in ms
+signal_timeouts = {}
 args = None
 replayinglog = False
+snapshot_file = None
+# shared memory table of the signal values, for other processes to read
+state_table = None
+# recent values of the signals, for diagnostics
+history = None
+# set to stop writing snapshots once VSM is quitting
+snapshots_done = threading.Event()
 
 def start_logger(args):
     # fork separate process to handle logging so we don't block main process
     pipein_fd, pipeout_fd = os.pipe()
     if os.fork() == 0:
         os.close(pipeout_fd)
-        log_processor(pipein_fd, args.log_file)
+        log_processor(pipein_fd, args.log_file, **log_processor_options(args))
         sys.exit(0)
     else:
         os.close(pipein_fd)
 
         global logger
 
+        binary_log = None
+        if args.binary_log_file:
+            binary_log = vsmlib.binlog.BinaryLogWriter(args.binary_log_file)
+            atexit.register(binary_log.close)
+
+        ring_buffer = bool(args.log_ring_buffer)
         if args.log_format == 'catapult':
-            logger = Catapult(pipeout_fd)
+            logger = Catapult(pipeout_fd, binary_log, ring_buffer)
         else:
-            logger = Logger(pipeout_fd)
+            logger = Logger(pipeout_fd, binary_log, ring_buffer)
+
+        logger.set_level(args.log_level)
+        for category in args.log_enable:
+            logger.set_category(category, True)
+        for category in args.log_disable:
+            logger.set_category(category, False)
+        if not args.log_condition_checks:
+            logger.set_category(LOG_CAT_CONDITION_CHECKS, False)
+        if args.log_optimizer:
+            logger.set_category(LOG_CAT_OPTIMIZER, True)
 
 def set_up_globals(args):
     global signal_to_num
 
     signal_to_num, vsi_version = vsmlib.utils.parse_signal_num_file(
-        args.signal_number_file)
+        args.signal_number_file, signal_timeouts)
+    for signal in signal_timeouts:
+        if vsmlib.staleness.timeout_signal(signal) not in signal_to_num:
+            print("signal '{}' not in signal number mapping file".format(
+                vsmlib.staleness.timeout_signal(signal)), file=sys.stderr)
+            exit(1)
 
 def _format_signal_msg(signal, value, indicator):
     signum = "[SIGNUM]"
@@ -120,43 +209,117 @@ def _handle_xor_condition(condition):
 class Logger(object):
     '''
         Utility class for logging messages
+
+        Informative and debug messages belong to a category and are only
+        formatted if their category and level are enabled, so the arguments
+        should be passed separately:
+
+            logger.i("condition: {}", condition, category=...)
+
+        A callable can also be passed instead of the message, to only build
+        it when it is logged.  Errors are always logged.
     '''
 
-    def __init__(self, pipeout_fd):
+    _INFO = LOG_LEVELS.index(LOG_LEVEL_INFO)
+    _DEBUG = LOG_LEVELS.index(LOG_LEVEL_DEBUG)
+
+    def __init__(self, pipeout_fd, binary_log=None, ring_buffer=False):
         self.pipeout_fd = pipeout_fd
+        self.binary_log = binary_log
+        # whether the log processor keeps a ring buffer to dump on errors
+        self.ring_buffer = ring_buffer
+        self.level = self._INFO
+        self.disabled_categories = set(LOG_CATEGORIES_DISABLED_DEFAULT)
+
+    def set_level(self, level):
+        self.level = LOG_LEVELS.index(level)
+
+    def set_category(self, category, enabled):
+        if category not in LOG_CATEGORIES:
+            raise ValueError("unknown log category: {}".format(category))
+        if enabled:
+            self.disabled_categories.discard(category)
+        else:
+            self.disabled_categories.add(category)
+
+    def enabled(self, category=LOG_CAT_GENERAL, level=LOG_LEVEL_INFO):
+        '''
+            Check whether messages of a category and level are logged, eg to
+            skip the code preparing them
+        '''
+        return LOG_LEVELS.index(level) <= self.level and \
+            category not in self.disabled_categories
 
-    def i(self, msg, timestamp=True):
+    def i(self, msg, *args, category=LOG_CAT_GENERAL):
         '''
             Log an informative (non-error) message
         '''
-        os.write(self.pipeout_fd, (msg + '\n').encode('UTF-8'))
+        if self.level >= self._INFO and category not in self.disabled_categories:
+            self._write(msg, args)
+
+    def d(self, msg, *args, category=LOG_CAT_GENERAL):
+        '''
+            Log a debug message
+        '''
+        if self.level >= self._DEBUG and category not in self.disabled_categories:
+            self._write(msg, args)
 
-    def e(self, msg, timestamp=True):
+    def e(self, msg, *args, category=LOG_CAT_GENERAL):
         '''
             Log an error
         '''
+        self._write(msg, args)
+        if self.ring_buffer:
+            self.dump()
+
+    def _write(self, msg, args):
+        if callable(msg):
+            msg = msg()
+        elif args:
+            msg = msg.format(*args)
         os.write(self.pipeout_fd, (msg + '\n').encode('UTF-8'))
 
+    def dump(self):
+        '''
+            Write the log ring buffer (if any) to the log file
+        '''
+        os.write(self.pipeout_fd, LOG_CONTROL_DUMP)
+
     def signal(self, signal, value, indicator):
         '''
             Log signal emission/reception
         '''
         msg = _format_signal_msg(signal, value, indicator)
         os.write(self.pipeout_fd, (msg + '\n').encode('UTF-8'))
+        self.record_signal(signal, value, indicator)
+
+    def record_signal(self, signal, value, indicator):
+        '''
+            Record signal emission/reception in the binary log (if any)
+        '''
+        if self.binary_log:
+            self.binary_log.write(get_runtime(), signal,
+                                  signal_to_num.get(signal), indicator, value)
 
 class Catapult(Logger):
 
-    def __init__(self, pipeout_fd):
-        super().__init__(pipeout_fd)
+    def __init__(self, pipeout_fd, binary_log=None, ring_buffer=False):
+        super().__init__(pipeout_fd, binary_log, ring_buffer)
         self.pid = os.getpid()
 
         # Open the JSON Array file
         os.write(self.pipeout_fd, '[\n'.encode('UTF-8'))
 
-    def i(self, msg, timestamp=True):
+    def enabled(self, category=LOG_CAT_GENERAL, level=LOG_LEVEL_INFO):
+        return False
+
+    def i(self, msg, *args, category=LOG_CAT_GENERAL):
+        pass
+
+    def d(self, msg, *args, category=LOG_CAT_GENERAL):
         pass
 
-    def e(self, msg, timestamp=True):
+    def e(self, msg, *args, category=LOG_CAT_GENERAL):
         pass
 
     def signal(self, signal, value, indicator):
@@ -174,39 +337,109 @@ class Catapult(Logger):
             "args": { "value": value }
         }
         os.write(self.pipeout_fd, (json.dumps(event) + ',\n').encode('UTF-8'))
+        self.record_signal(signal, value, indicator)
 
 class State(object):
     '''
         Class to handle states
     '''
-    def __init__(self, initial_state, rules, log_categories):
+    def __init__(self, initial_state, rules, optimize=True,
+                 index_predicates=True, propagate_emits=False):
         class VariablesStorage(object):
             pass
         self.variables = VariablesStorage()
-        self.log_categories = log_categories
-
+        # incremented each time a variable changes
+        self.variables_version = 0
+        # recent values of the signals aggregated by the conditions
+        self.windows = {}
+        # deadlines of the temporal operators of the conditions, the temporal
+        # operators to update when each signal is set and the rules to execute
+        # when one becomes true on its own
+        self.scheduler = vsmlib.scheduler.DeadlineScheduler(
+                get_runtime, error=self._scheduled_call_failed)
+        self._temporal_signals = {}
+        self._temporal_rules = {}
+        # temporal operators of each compiled condition expression
+        self._expression_temporal_ops = {}
+        # held while evaluating rules and while swapping in reloaded rules
+        self.lock = threading.RLock()
+        # the input signals which stopped being received
+        self.staleness = vsmlib.staleness.StalenessMonitor(
+                get_runtime, self.scheduler, self._signal_timed_out, self.lock)
+
+        self.rules_path = rules
+        self.rules_digest = vsmlib.snapshot.file_digest(rules)
+        # rules of each signal, and the ones currently subscribed to it: the
+        # rules of the subconditions are only subscribed while all their
+        # ancestor conditions are met
+        self.all_rules = {}
         self.rules = {}
+        self.inactive_rules = set()
+        self._sequence_signals = {}
+        # conditions waiting for each signal which hasn't been set yet, they
+        # are only subscribed once all their signals are set
+        self._waiting_conditions = {}
+        # signals whose subscribed rules must be updated before processing them
+        self._stale_signals = set()
+        # signals being processed and their rules to execute, which the rules
+        # subscribed to them in the meantime are added to
+        self._pending_rules = None
+        # condition node of each rule, to avoid searching the tree for it
+        self.rule_conditions = {}
+        self.filters = {}
         self.exec_queue = []
+        # selects the rules to execute based on the old and new signal values,
+        # or None to always execute all the rules of a signal
+        self.predicate_index = None
+        self.index_predicates = index_predicates
+        # whether the emitted signals are processed like received ones, and
+        # the rank of each signal in the dependency graph of the emits
+        self.propagate_emits = propagate_emits
+        self.signal_ranks = {}
+        # emitted signals left to process for the current input signal: a heap
+        # of (rank, signal) and the value of each signal
+        self._emitted = None
+        self._emitted_values = {}
+        self.optimizer = None
+        if optimize:
+            self.optimizer = vsmlib.optimizer.RuleOptimizer()
+        self._reload_lock = threading.Lock()
 
         with open(rules) as rules_file:
             self.parse_rules(rules_file)
 
         if initial_state:
             with open(initial_state) as f:
-                data = yaml.load(f.read())
+                data = yaml.safe_load(f.read())
 
                 for item in data:
                     item = item.replace(" ", "").split("=")
                     vars(self.variables)[item[0]] = item[1]
 
+        self.all_rules, self.rule_conditions, self.filters, timeouts, \
+                self.exec_queue, self.predicate_index = \
+                self._index_rules(config_tree)
+        if propagate_emits:
+            try:
+                self.signal_ranks = self._rank_signals(self.rule_conditions)
+            except ValueError as err:
+                self._exit_invalid_rules(err)
+        self._subscribe_rules()
+
+        if self.optimizer:
+            for change in self.optimizer.changes:
+                logger.i("optimizer: {}", change, category=LOG_CAT_OPTIMIZER)
+
         # inject this object into the globals dictionary so it will be available
         # to the function we're executing (since it won't really be filled in
         # until after this constructor completes)
         global_vars = globals()
         global_vars["state"] = self
 
+        self.staleness.set_timeouts(timeouts)
+
         for rule in self.exec_queue:
-            exec(rule, global_vars, self._undot_variables(vars(self.variables)))
+            rule()
 
     def handle_emit(self, data, parent):
         signal = data[NODE_EMIT]["signal"]
@@ -229,24 +462,41 @@ class State(object):
         if signal not in signal_to_num:
             self._exit_signal_num_missing(signal)
 
+        # signals and values are emitted as strings, as written in the rules
         if "delay" in data[NODE_EMIT].keys():
-            action = "threading.Thread(target=delayed_emit, args=( \
-                            \'{}\', \'{}\', {})).start()".format(signal,
-                            value, data[NODE_EMIT]["delay"])
+            rule = functools.partial(self._delayed_emit, str(signal),
+                                     str(value), data[NODE_EMIT]["delay"])
         else:
-            action = "emit(\'{}\', \'{}\')".format(signal, value)
+            rule = functools.partial(emit, str(signal), str(value))
 
-        ast_node = ast.parse(action)
+        emit_node = TreeNode(NODE_EMIT, data[NODE_EMIT])
+        emit_node.rule = rule
+        parent.add_child(emit_node)
 
-        parent.add_child(TreeNode(NODE_EMIT, ast_node))
+    def _delayed_emit(self, signal, value, delay_ms):
+        # a heap entry on the shared scheduler rather than a thread per emit
+        self.scheduler.schedule(get_runtime() + delay_ms, emit, signal, value)
 
-        return ast_node
+    def _scheduled_call_failed(self, err):
+        # eg, a delayed emit failing to send its signal, the scheduler then
+        # carries on with the other deadlines
+        logger.e("scheduled call failed: {}".format(err))
 
     def _exit_signal_num_missing(self, signal):
         print("signal '{}' not in signal number mapping file".format(signal),
               file=sys.stderr)
         exit(1)
 
+    def _exit_invalid_rules(self, err):
+        print("invalid rules file '{}': {}".format(self.rules_path, err),
+              file=sys.stderr)
+        exit(1)
+
+    def _exit_invalid_condition(self, condition, err):
+        print("invalid condition '{}': {}".format(condition.strip(), err),
+              file=sys.stderr)
+        exit(1)
+
     def handle_condition(self, data, parent):
         orig_condition = data[NODE_CONDITION]
         # Handle XOR operator (if it is found)
@@ -290,35 +540,158 @@ class State(object):
                 signals=parser.identifiers)
         parent.add_child(condition_node)
 
+        # the compiled expression looks the signals up by their real name
+        names = {ident.replace('.', '_'): ident
+                 for ident in parser.identifiers}
+        test_expr = eval_condition_expr.value
+        temporal_ops = []
+        temporal = functools.partial(self._temporal, temporal_ops)
+        try:
+            # before the optimizer evaluates any constant sub-expression
+            vsmlib.expression.check(test_expr)
+            if self.optimizer:
+                label = "condition '{}'".format(orig_condition.strip())
+                test_expr = self.optimizer.optimize(test_expr, label)
+                if self.optimizer.never_true(test_expr):
+                    logger.e("{} can never be true".format(label))
+                expression = self.optimizer.compile(test_expr, label, names,
+                                                    self._aggregate, temporal)
+            else:
+                expression = vsmlib.expression.compile_expression(
+                        test_expr, names, self._aggregate, temporal)
+        except ValueError as err:
+            self._exit_invalid_condition(orig_condition, err)
+        # an identical condition compiled before has the same operators
+        if temporal_ops:
+            self._expression_temporal_ops[expression] = temporal_ops
+        # whether the condition only compares its signal to a constant
+        predicate = vsmlib.predicates.match(test_expr)
+
         emit_signal = None
         emit_value = None
-        actions_true = []
-        actions_false = []
         if NODE_EMIT in data:
-            emit_signal = data[NODE_EMIT]["signal"]
-            emit_value = data[NODE_EMIT]["value"]
+            emit_signal = str(data[NODE_EMIT]["signal"])
+            emit_value = str(data[NODE_EMIT]["value"])
+
+        # the condition expression is evaluated separately so its result can
+        # be shared between identical conditions, the rule is then called with
+        # the result
+        node_ref = repr(condition_node)
+        node_refs[node_ref] = condition_node
+        rule = functools.partial(State.condition_changed, orig_condition,
+                node_ref=node_ref, emit_signal=emit_signal,
+                emit_value=emit_value)
+        condition_node.rule = rule
+        condition_node.expression = expression
+        condition_node.temporal_ops = \
+                self._expression_temporal_ops.get(expression, [])
+        condition_node.predicate = predicate
+        condition_node.emit_signal = emit_signal
 
-        if self.log_categories[LOG_CAT_CONDITION_CHECKS]:
-            action_true_2_code = self.generate_condition_code(orig_condition,
-                    True, condition_node, emit_signal, emit_value)
-            action_true_2 = ast.parse(action_true_2_code)
+        return [condition_expr, rule, parser.identifiers]
 
-            action_false_code = self.generate_condition_code(orig_condition,
-                    False, condition_node, None, None)
-            action_false = ast.parse(action_false_code)
+    def _aggregate(self, function, signal, length_ms):
+        '''
+            Return the function computing an aggregate of the recent values of
+            a signal, which are only kept for the aggregated signals.
+        '''
+        if signal not in self.windows:
+            self.windows[signal] = vsmlib.windows.SignalWindow(get_runtime)
+        return self.windows[signal].aggregate(function, length_ms)
 
-            actions_true.append(action_true_2.body[0])
-            actions_false.append(action_false.body[0])
+    def _temporal(self, temporal_ops, function, expressions, signals,
+                  length_ms):
+        '''
+            Return the object computing a temporal operator of a condition,
+            adding it to the temporal operators of the condition.
+        '''
+        op = vsmlib.temporal.operator(function, expressions, signals,
+                                      length_ms, get_runtime, self.scheduler,
+                                      self._temporal_expired)
+        temporal_ops.append(op)
+        return op
 
-        ifnode = ast.If(eval_condition_expr.value, actions_true, actions_false)
-        ast_module = ast.Module([ifnode])
+    def _temporal_expired(self, op):
+        '''
+            Execute the rules using a temporal operator which just became
+            true on its own, once its time elapsed.
+        '''
+        with self.lock:
+            rules = [rule for rule in self._temporal_rules.get(op, ())
+                     if rule not in self.inactive_rules]
+            if not rules:
+                return
+            if self.propagate_emits:
+                self._propagating(self._run_rules, set(op.signals), rules)
+            else:
+                self._run_rules(set(op.signals), rules)
 
-        ast.fix_missing_locations(ast_module)
+    def handle_filter(self, data, parent):
+        signal = data[NODE_FILTER].get("signal")
+        interval_ms = data[NODE_FILTER].get("interval", 0)
+        deadband = data[NODE_FILTER].get("deadband")
 
-        rule = compile(ast_module, '<string>', 'exec')
-        condition_node.rule = rule
+        if signal not in signal_to_num:
+            self._exit_signal_num_missing(signal)
 
-        return [condition_expr, rule, parser.identifiers]
+        if not interval_ms and deadband is None:
+            logger.e("'{}' for signal '{}' has neither 'interval' nor " \
+                    "'deadband'".format(NODE_FILTER, signal))
+            return
+
+        filter_node = TreeNode(NODE_FILTER, signal)
+        filter_node.signal_filter = vsmlib.signal_filter.SignalFilter(signal,
+                self._got_filtered_signal, self.scheduler, interval_ms,
+                deadband)
+        parent.add_child(filter_node)
+
+    def _got_filtered_signal(self, signal, value):
+        # the filter may have just been removed by reloading the rules
+        signal_filter = self.filters.get(signal)
+        if signal_filter:
+            # the raw stream is not logged, only how much of it got filtered
+            # out
+            logger.i("filter: {} processed {} of {} values", signal,
+                signal_filter.processed, signal_filter.received,
+                category=LOG_CAT_FILTERS)
+        self.got_signal(signal, value)
+
+    def handle_timeout(self, data, parent):
+        signal = data[NODE_TIMEOUT].get("signal")
+        interval_ms = data[NODE_TIMEOUT].get("interval")
+
+        if signal not in signal_to_num:
+            self._exit_signal_num_missing(signal)
+        timeout_signal = vsmlib.staleness.timeout_signal(signal)
+        if timeout_signal not in signal_to_num:
+            self._exit_signal_num_missing(timeout_signal)
+
+        if isinstance(interval_ms, bool) or \
+                not isinstance(interval_ms, (int, float)) or interval_ms <= 0:
+            logger.e("'{}' for signal '{}' has no valid 'interval'".format(
+                NODE_TIMEOUT, signal))
+            return
+
+        timeout_node = TreeNode(NODE_TIMEOUT, signal)
+        timeout_node.timeout_ms = interval_ms
+        parent.add_child(timeout_node)
+
+    def _signal_timed_out(self, signal):
+        # called by the staleness monitor, with the lock held
+        if self.propagate_emits:
+            self._propagating(self._raise_timeout, signal, True)
+        else:
+            self._raise_timeout(signal, True)
+
+    def _raise_timeout(self, signal, timed_out):
+        '''
+            Send and process the timeout signal of a signal which just timed
+            out, or was received again after timing out.
+        '''
+        timeout_signal = vsmlib.staleness.timeout_signal(signal)
+        logger.signal(timeout_signal, timed_out, SIGNAL_PREFIX_OUTGOING)
+        ipc_obj.send(timeout_signal, timed_out)
+        self._got_signal(timeout_signal, timed_out, record=False)
 
     def handle_children(self, data, child_type, parent):
         # Build a dict, the key is the keyword used to decide how they are run
@@ -357,67 +730,52 @@ class State(object):
         node = node_refs[node_ref]
         node.notify_condition(result)
 
+        log_checks = logger.enabled(LOG_CAT_CONDITION_CHECKS)
         all_ancestor_conditions_met = True
         for ancestor in node.get_ancestor_conditions():
             if not ancestor.condition_met:
                 all_ancestor_conditions_met = False
 
-            if ancestor.signals:
+            if log_checks and ancestor.signals:
                 for signal in ancestor.signals:
                     ancestor_value = "(unset)"
                     if signal in vars(state.variables):
                         ancestor_value = vars(state.variables)[signal]
 
-                    logger.i("parent condition: {} == {}".format(signal,
-                        ancestor_value))
+                    logger.i("parent condition: {} == {}", signal,
+                        ancestor_value, category=LOG_CAT_CONDITION_CHECKS)
 
-        logger.i("condition: ({}) => {}".format(condition, str(result)))
+        logger.i("condition: ({}) => {}", condition, result,
+                 category=LOG_CAT_CONDITION_CHECKS)
 
         # emit the corresponding signal if all ancestor conditions have been met
         if all_ancestor_conditions_met and result and emit_signal:
             emit(emit_signal, emit_value)
 
-    def generate_condition_code(self, condition, result, node, emit_signal,
-            emit_value):
-        node_ref = repr(node)
-        node_refs[node_ref] = node
-
-        if emit_signal:
-            return "State.condition_changed({}, {}, \'{}\', \'{}\', " \
-                    "\'{}\')".format(repr(condition), result, node_ref,
-                            emit_signal, emit_value)
-        else:
-            return "State.condition_changed({}, {}, \'{}\')".format(
-                    repr(condition), result, node_ref)
-
     def __parse_items(self, item, parent):
         conditions_rules = None
 
+        if NODE_FILTER in item:
+            self.handle_filter(item, parent)
+        if NODE_TIMEOUT in item:
+            self.handle_timeout(item, parent)
+
         if NODE_PARALLEL in item:
             conditions_rules = self.handle_children(item, NODE_PARALLEL, parent)
         if NODE_SEQUENCE in item:
             conditions_rules = self.handle_children(item, NODE_SEQUENCE, parent)
         if NODE_CONDITION in item:
-            condition, rule, identifiers = self.handle_condition(item, parent)
-            self.add_rule(identifiers, rule)
+            self.handle_condition(item, parent)
         elif NODE_EMIT in item:
-            module = self.handle_emit(item, parent)
-            rule = None
-            if module != None:
-                rule = compile(module, '<string>', 'exec')
-
-            if rule != None:
-                # queue up rules to execute until after this class has finished
-                # initializing
-                self.exec_queue.append(rule)
+            # the rules of unconditional emits are queued up by
+            # _index_rules() to execute after this class has finished
+            # initializing
+            self.handle_emit(item, parent)
 
         if conditions_rules:
             return conditions_rules
 
-    def parse_rules(self, rules_file):
-        '''
-            Parse YAML rules for policy manager and return ast code.
-        '''
+    def _load_rules_data(self, rules_file):
         data = rules_file.read()
 
         # Translate logical operations to Python, so that they
@@ -429,64 +787,627 @@ class State(object):
 
         # Currently we support only lists in yaml at base level
         if issubclass(type(data), list):
-            for item in data:
-                # this empty node serves to group its child(ren) together just
-                # as the list item in the YAML file groups its child(ren)
-                # together
-                block_node = TreeNode(NODE_BLOCK, None)
-                config_tree.add_child(block_node)
+            return data
+
+        return []
 
-                rules = self.__parse_items(item, block_node)
+    def _parse_block(self, item):
+        # this empty node serves to group its child(ren) together just as the
+        # list item in the YAML file groups its child(ren) together
+        block_node = TreeNode(NODE_BLOCK, None)
+        # used to find the unchanged items when reloading the rules
+        block_node.item_key = json.dumps(item, sort_keys=True, default=str)
+        self.__parse_items(item, block_node)
 
-    def add_rule(self, identifiers, rule):
-        for signal_name in identifiers:
-            if not signal_name in self.rules:
-                self.rules[signal_name] = []
-            self.rules[signal_name].append(rule)
+        return block_node
+
+    def parse_rules(self, rules_file):
+        '''
+            Parse YAML rules for policy manager and add them to the tree.
+        '''
+        for item in self._load_rules_data(rules_file):
+            config_tree.add_child(self._parse_block(item))
+
+    def _index_rules(self, root):
+        '''
+            Return the rules, rule conditions, filters, signal timeouts,
+            unconditional emits and predicate index found in a tree.  The
+            timeouts of the rules override those of the signal number file.
+        '''
+        rules = {}
+        rule_conditions = {}
+        filters = {}
+        timeouts = dict(signal_timeouts)
+        exec_queue = []
+        predicates = {}
+
+        for node in root.walk():
+            if node.node_type == NODE_CONDITION:
+                self.add_rule(rules, node.signals, node.rule)
+                rule_conditions[node.rule] = node
+                node.gated = []
+                node.met_changed = self._condition_met_changed
+            elif node.node_type == NODE_SEQUENCE:
+                node.compile_sequence(self._sequence_step_changed)
+            elif node.node_type == NODE_FILTER:
+                filters[node.value] = node.signal_filter
+            elif node.node_type == NODE_TIMEOUT:
+                timeouts[node.value] = node.timeout_ms
+            elif node.node_type == NODE_EMIT and node.rule:
+                exec_queue.append(node.rule)
+
+        for rule, node in rule_conditions.items():
+            ancestors = node.get_ancestor_conditions()
+            node.gate = ancestors[0] if ancestors else None
+            if node.gate:
+                node.gate.gated.append(node)
+            # monitored, sequence and gated conditions must be executed even
+            # when they stay false
+            elif node.predicate and node.start_time_ms < 0 and \
+                    not node.sequence:
+                predicates[rule] = node.predicate
+
+        predicate_index = None
+        if self.index_predicates:
+            predicate_index = vsmlib.predicates.PredicateIndex(rules,
+                                                               predicates)
+
+        return rules, rule_conditions, filters, timeouts, exec_queue, \
+                predicate_index
+
+    def _rank_signals(self, rule_conditions):
+        '''
+            Return the rank of each signal in the dependency graph of the
+            emitted signals, raising a ValueError if it has a cycle.
+        '''
+        dependencies = {}
+        for node in rule_conditions.values():
+            if not node.emit_signal:
+                continue
+            # the subconditions are gated by the signals of their ancestors
+            signals = dependencies.setdefault(node.emit_signal, set())
+            signals.update(node.signals)
+            for ancestor in node.get_ancestor_conditions():
+                signals.update(ancestor.signals)
+        return vsmlib.dependencies.rank_signals(dependencies)
+
+    def _subscribe_rules(self):
+        '''
+            Subscribe the rules whose ancestor conditions are all met and
+            whose signals are all set to their signals, and only those.
+        '''
+        self._track_readiness()
+        self._index_temporal()
+        self.inactive_rules = set()
+        # the signals of each sequence with the index of the steps using them
+        sequence_steps = {}
+        for rule, node in self.rule_conditions.items():
+            if not self._is_subscribed(node):
+                self.inactive_rules.add(rule)
+            if node.sequence:
+                for signal in node.signals:
+                    sequence_steps.setdefault(signal, {}).setdefault(
+                            node.sequence, set()).add(node.step)
+
+        self._sequence_signals = {signal: list(sequences.items())
+                                  for signal, sequences in
+                                  sequence_steps.items()}
+        self.rules = {}
+        self._stale_signals = set()
+        for signal in self.all_rules:
+            self._update_subscriptions(signal)
+
+    def _track_readiness(self):
+        '''
+            Count the signals of each condition which haven't been set yet.
+        '''
+        variables = vars(self.variables)
+        self._waiting_conditions = {}
+        for node in self.rule_conditions.values():
+            unset = [signal for signal in dict.fromkeys(node.signals)
+                     if signal not in variables]
+            node.unset = len(unset)
+            for signal in unset:
+                self._waiting_conditions.setdefault(signal, []).append(node)
+
+    def _index_temporal(self):
+        '''
+            Find the temporal operators to update when each signal is set and
+            the rules using each of them, and catch up with the current
+            values.
+        '''
+        variables = vars(self.variables)
+        self._temporal_signals = {}
+        self._temporal_rules = {}
+        for rule, node in self.rule_conditions.items():
+            for op in node.temporal_ops:
+                if op not in self._temporal_rules:
+                    self._temporal_rules[op] = []
+                    for signal in op.signals:
+                        self._temporal_signals.setdefault(signal,
+                                                          []).append(op)
+                    op.update(variables)
+                self._temporal_rules[op].append(rule)
+
+    def _signal_set(self, signal):
+        '''
+            Subscribe the conditions whose last unset signal was just set.
+        '''
+        for node in self._waiting_conditions.pop(signal, ()):
+            node.unset -= 1
+            if node.unset:
+                continue
+            self._stale_signals.update(node.signals)
+            # eg, when the signal is emitted by a rule of the signal being
+            # processed
+            if self._is_pending(node) and \
+                    node.rule not in self.inactive_rules:
+                self._pending_rules[1].append(node.rule)
+
+    def readiness(self):
+        '''
+            Return the number of conditions whose signals are all set, and the
+            number of conditions waiting for each signal which isn't set.
+        '''
+        with self.lock:
+            waiting = {signal: len(nodes) for signal, nodes in
+                       self._waiting_conditions.items()}
+            ready = sum(1 for node in self.rule_conditions.values()
+                        if not node.unset)
+        return ready, waiting
+
+    def log_readiness(self):
+        ready, waiting = self.readiness()
+        logger.i("readiness: {} of {} condition(s) ready", ready,
+                 len(self.rule_conditions), category=LOG_CAT_RULES)
+        for signal, count in sorted(waiting.items()):
+            logger.i("readiness: {} condition(s) waiting for {}", count,
+                     signal, category=LOG_CAT_RULES)
+
+    def _is_subscribed(self, node):
+        if node.condition_is_sequence_blocked():
+            return False
+        return all(ancestor.condition_met
+                   for ancestor in node.get_ancestor_conditions())
+
+    def _update_subscriptions(self, signal):
+        self.rules[signal] = [rule for rule in self.all_rules[signal]
+                              if rule not in self.inactive_rules and
+                              not self.rule_conditions[rule].unset]
+        if self.predicate_index:
+            self.predicate_index.subscribe(signal, self.rules[signal])
+
+    def _condition_met_changed(self, node):
+        '''
+            Subscribe or unsubscribe the rules of the subconditions of a
+            condition which was just met or stopped being met.
+        '''
+        if node.rule in self.inactive_rules:
+            return
+
+        # the subscriptions are updated once, when the signals are processed
+        if node.condition_met:
+            self._activate(node, self._stale_signals)
+        else:
+            self._deactivate(node, self._stale_signals)
+
+    def _activate(self, node, signals):
+        variables = vars(self.variables)
+        for child in node.gated:
+            if child.condition_is_sequence_blocked():
+                continue
+            self.inactive_rules.discard(child.rule)
+            signals.update(child.signals)
+
+            # the subcondition wasn't evaluated while inactive, catch up with
+            # the current values before its monitor is set up
+            child.condition_met = not child.unset and \
+                    bool(child.expression(variables))
+
+            if self._is_pending(child):
+                self._pending_rules[1].append(child.rule)
+            if child.condition_met:
+                self._activate(child, signals)
+
+    def _is_pending(self, node):
+        '''
+            Return whether a condition uses one of the signals being processed.
+        '''
+        return self._pending_rules is not None and \
+                not self._pending_rules[0].isdisjoint(node.signals)
+
+    def _deactivate(self, node, signals):
+        for child in node.gated:
+            if child.rule not in self.inactive_rules:
+                self.inactive_rules.add(child.rule)
+                signals.update(child.signals)
+                self._deactivate(child, signals)
+
+    def _sequence_step_changed(self, previous, current):
+        '''
+            Subscribe the rule of the new current step of a sequence instead
+            of the previous one.
+        '''
+        if previous is current:
+            return
+
+        self.inactive_rules.add(previous.rule)
+        self._stale_signals.update(previous.signals)
+        if current and self._is_subscribed(current):
+            self.inactive_rules.discard(current.rule)
+            self._stale_signals.update(current.signals)
+            if self._is_pending(current):
+                self._pending_rules[1].append(current.rule)
+
+    def log_sequence_stats(self):
+        '''
+            Log how many signal updates each sequence ignored because they
+            were not for its current step
+        '''
+        for node in config_tree.walk():
+            if node.node_type == NODE_SEQUENCE and node.blocked:
+                first = node.steps[0] if node.steps else None
+                logger.i("sequence starting with ({}): {} signal update(s) "
+                        "ignored because prior conditions in the sequence "
+                        "had not been met",
+                        ast.unparse(first.value) if first else None,
+                        node.blocked, category=LOG_CAT_RULES)
+
+    def add_rule(self, rules, identifiers, rule):
+        # identifiers may be repeated in a condition but each rule must only be
+        # executed once per signal
+        for signal_name in dict.fromkeys(identifiers):
+            if not signal_name in rules:
+                rules[signal_name] = []
+            rules[signal_name].append(rule)
+
+    def reload_rules(self):
+        '''
+            Reload the rules file while keeping the current signal state.
+
+            Only the top-level items of the rules file which have changed are
+            parsed again, the unchanged ones keep their tree nodes along with
+            their conditions, monitors and sequence state.  The new rules are
+            swapped in atomically with regards to the rules evaluation.
+        '''
+        global config_tree
+
+        with self._reload_lock:
+            old_blocks = {}
+            for block in config_tree.children:
+                old_blocks.setdefault(block.item_key, []).append(block)
+
+            new_root = TreeNode(NODE_ROOT, None)
+            parsed_blocks = []
+            try:
+                with open(self.rules_path) as rules_file:
+                    data = self._load_rules_data(rules_file)
+
+                for item in data:
+                    key = json.dumps(item, sort_keys=True, default=str)
+                    if old_blocks.get(key):
+                        block = old_blocks[key].pop(0)
+                    else:
+                        block = self._parse_block(item)
+                        parsed_blocks.append(block)
+                    new_root.add_child(block)
+            except (Exception, SystemExit) as err:
+                logger.e("failed to reload rules file '{}': {}".format(
+                    self.rules_path, err))
+                return False
+
+            removed = [b for blocks in old_blocks.values() for b in blocks]
+
+            # indexing the rules links the kept nodes to the new tree
+            with self.lock:
+                rules, rule_conditions, filters, timeouts, _, \
+                        predicate_index = self._index_rules(new_root)
+                signal_ranks = {}
+                if self.propagate_emits:
+                    try:
+                        signal_ranks = self._rank_signals(rule_conditions)
+                    except ValueError as err:
+                        logger.e("failed to reload rules file '{}': {}"
+                                 .format(self.rules_path, err))
+                        # link the kept nodes back to the current tree
+                        self._index_rules(config_tree)
+                        return False
+
+                config_tree = new_root
+                self.all_rules = rules
+                self.rule_conditions = rule_conditions
+                self.filters = filters
+                self.predicate_index = predicate_index
+                self.signal_ranks = signal_ranks
+                self._subscribe_rules()
+                self.staleness.set_timeouts(timeouts)
+                self.rules_digest = vsmlib.snapshot.file_digest(
+                        self.rules_path)
+
+                logger.i("reloaded rules file '{}': {} kept, {} parsed, {} " \
+                        "removed", self.rules_path,
+                        len(new_root.children) - len(parsed_blocks),
+                        len(parsed_blocks), len(removed),
+                        category=LOG_CAT_RULES)
+
+                # unconditional emits of the new items, as when starting up,
+                # before any other signal is processed with the new rules
+                for block in parsed_blocks:
+                    for node in block.walk():
+                        if node.node_type == NODE_EMIT and node.rule:
+                            node.rule()
+
+            for block in removed:
+                block.release()
+
+            return True
+
+    def snapshot(self):
+        '''
+            Return a snapshot of the signal values along with the state of the
+            conditions, sequences and monitors.
+        '''
+        conditions = []
+        sequences = []
+
+        with self.lock:
+            runtime = get_runtime()
+            for path, node in config_tree.walk_paths():
+                if node.node_type == NODE_CONDITION:
+                    # time elapsed since the monitor started, if it's active
+                    monitor_ms = None
+                    if node.start_timer or node.stop_timer:
+                        monitor_ms = runtime - node.monitor_init_time_ms
+                    conditions.append((path, node.condition_met, monitor_ms))
+                elif node.node_type == NODE_SEQUENCE:
+                    sequences.append((path, node.next_grandchild_index))
+
+            return {
+                'time': time.time(),
+                'rules': self.rules_digest,
+                'variables': dict(vars(self.variables)),
+                'conditions': conditions,
+                'sequences': sequences,
+            }
+
+    def write_snapshot(self, filename):
+        try:
+            vsmlib.snapshot.write(filename, self.snapshot())
+        except (OSError, ValueError) as err:
+            logger.e("failed to write snapshot '{}': {}".format(filename, err))
+
+    def restore_snapshot(self, filename):
+        '''
+            Restore the state from a snapshot file, if it exists.
+
+            The signal values are always restored.  The conditions, sequences
+            and monitors are only restored if the rules file hasn't changed
+            since the snapshot was written.  Monitors carry on with the time
+            elapsed since the snapshot taken into account.
+        '''
+        snapshot = vsmlib.snapshot.read(filename)
+        if snapshot is None:
+            return False
+
+        elapsed_ms = max(time.time() - snapshot['time'], 0) * 1000
+
+        with self.lock:
+            vars(self.variables).update(snapshot['variables'])
+            self.variables_version += 1
+            if state_table:
+                state_table.update(snapshot['variables'], get_runtime())
+
+            if snapshot['rules'] != self.rules_digest:
+                logger.e("rules file has changed since snapshot '{}' was " \
+                        "written, only restoring signal values".format(
+                            filename))
+                self._subscribe_rules()
+                return True
+
+            nodes = dict(config_tree.walk_paths())
+            for path, condition_met, monitor_ms in snapshot['conditions']:
+                node = nodes[path]
+                node.condition_met = condition_met
+                if monitor_ms is not None:
+                    node.restore_monitor(monitor_ms + elapsed_ms)
+
+            for path, next_grandchild_index in snapshot['sequences']:
+                nodes[path].next_grandchild_index = next_grandchild_index
+
+            self._subscribe_rules()
+
+        logger.i("restored snapshot '{}' from {}ms ago", filename,
+            round(elapsed_ms), category=LOG_CAT_RULES)
+
+        return True
 
     def got_signal(self, signal, value):
-        self.got_signal_record(signal, value)
+        with self.lock:
+            if self.propagate_emits:
+                self._propagating(self._got_signal, signal, value)
+            else:
+                self._got_signal(signal, value)
+
+    def got_frame(self, values):
+        '''
+            Process the signals of a frame, a dictionary of signal values, as
+            one update: all the values are set before the rules using any of
+            them are executed, once each.
+        '''
+        with self.lock:
+            if self.propagate_emits:
+                self._propagating(self._got_frame, values)
+            else:
+                self._got_frame(values)
+
+    def emitted(self, signal, value):
+        '''
+            Process a signal emitted by a rule like a received one, once the
+            rules of the signal being processed have been executed.
+        '''
+        # the emitted values are strings, as written in the rules
+        try:
+            value = parse_value(value)
+        except ValueError:
+            pass
+
+        with self.lock:
+            if self._emitted is not None:
+                if signal not in self._emitted_values:
+                    heapq.heappush(self._emitted,
+                                   (self.signal_ranks.get(signal, 0), signal))
+                self._emitted_values[signal] = value
+                return
+
+            # eg, delayed or unconditional emits
+            self._propagating(self._got_signal, signal, value, False)
+
+    def _propagating(self, got_signals, *args):
+        self._emitted = []
+        self._emitted_values = {}
+        try:
+            got_signals(*args)
+            self._propagate()
+        finally:
+            self._emitted = None
+            self._emitted_values = {}
+
+    def _propagate(self):
+        # the signals an emitted signal depends on are all processed before
+        # it, so each one is processed at most once
+        while self._emitted:
+            _, signal = heapq.heappop(self._emitted)
+            value = self._emitted_values.pop(signal)
+            self._got_signal(signal, value, record=False)
+
+    def _got_signal(self, signal, value, record=True):
+        old_value = vars(self.variables).get(signal, vsmlib.predicates.UNSET)
+        if record:
+            self.got_signal_record(signal, value)
+        else:
+            # the emitted signal has already been logged
+            self._update_report_state(signal, value)
+
+        rules = self._select_rules(signal, old_value, value)
+        if rules:
+            self._run_rules({signal}, rules)
+
+    def _got_frame(self, values):
+        variables = vars(self.variables)
+        old_values = {signal: variables.get(signal, vsmlib.predicates.UNSET)
+                      for signal in values}
+        for signal, value in values.items():
+            logger.signal(signal, value, SIGNAL_PREFIX_INCOMING)
+            self._set_variable(signal, value)
+        logger.i(self._format_state, category=LOG_CAT_STATE)
+        for signal in values:
+            if self.staleness.received(signal):
+                self._raise_timeout(signal, False)
+
+        # the rules using several signals of the frame are only executed once
+        rules = {}
+        for signal, value in values.items():
+            rules.update(dict.fromkeys(
+                self._select_rules(signal, old_values[signal], value)))
+        if rules:
+            self._run_rules(set(values), rules)
+
+    def _select_rules(self, signal, old_value, value):
+        '''
+            Return the rules to execute after a signal changed.
+        '''
+        if signal in self._stale_signals:
+            self._stale_signals.discard(signal)
+            self._update_subscriptions(signal)
+
+        for sequence, steps in self._sequence_signals.get(signal, ()):
+            if sequence.next_grandchild_index not in steps:
+                sequence.blocked += 1
 
         # No conditions based on the signal that was emitted,
         # nothing to be done.
         if not signal in self.rules:
-            return
-
-        elif signal in self.rules:
-            for rule in self.rules[signal]:
-                exec_rule = True
-
-                condition_node_matches = config_tree.get_conditions_by_rule(
-                        rule)
-                for condition in condition_node_matches:
-                    if condition.condition_is_sequence_blocked():
-                        logger.e("changed value for signal '{}' ignored " \
-                                "because prior conditions in its sequence " \
-                                "block have not been met".format(signal))
-                        exec_rule = False
-                        break
-
-                if exec_rule:
-                    try:
-                        exec(rule, globals(),
-                                self._undot_variables(vars(self.variables)))
-                    except NameError:
-                        # Names used in rules are not always present
-                        # in the state.
-                        pass
+            return ()
+
+        rules = self.rules[signal]
+        if self.predicate_index:
+            # skip the conditions which stay false
+            rules = self.predicate_index.select(signal, rules, old_value,
+                                                value)
+        return rules
+
+    def _run_rules(self, signals, rules):
+        # lists are iterated by index, so the subconditions on these signals
+        # activated by their rules are appended to be executed as well
+        pending_rules = (signals, list(rules))
+        parent_pending_rules = self._pending_rules
+        self._pending_rules = pending_rules
+        try:
+            self._execute_rules(pending_rules[1])
+        finally:
+            self._pending_rules = parent_pending_rules
+
+    def _execute_rules(self, rules):
+        variables = None
+        variables_version = None
+        # results of the expressions already evaluated for this signal, valid
+        # until a variable changes (eg, by emitting a signal)
+        results = {}
+
+        for rule in rules:
+            condition = self.rule_conditions[rule]
+            # the step of a sequence may have changed since it was selected,
+            # and subconditions activated in the meantime may not be ready
+            if condition.condition_is_sequence_blocked() or condition.unset:
+                continue
+
+            if variables_version != self.variables_version:
+                variables = vars(self.variables)
+                variables_version = self.variables_version
+                results = {}
+
+            expression = condition.expression
+            result = results.get(id(expression), results)
+            if result is results:
+                result = expression(variables)
+                results[id(expression)] = result
+
+            rule(result)
 
     def got_signal_record(self, signal, value):
         # Record received signal in logs.
         logger.signal(signal, value, SIGNAL_PREFIX_INCOMING)
         self._update_report_state(signal, value)
+        if self.staleness.received(signal):
+            self._raise_timeout(signal, False)
 
     def _update_report_state(self, signal, value):
-        vars(self.variables)[signal] = value
-
-        logger.i("State = {")
+        self._set_variable(signal, value)
+        logger.i(self._format_state, category=LOG_CAT_STATE)
+
+    def _set_variable(self, signal, value):
+        variables = vars(self.variables)
+        is_new = signal not in variables
+        variables[signal] = value
+        self.variables_version += 1
+        if is_new and signal in self._waiting_conditions:
+            self._signal_set(signal)
+        window = self.windows.get(signal)
+        if window:
+            window.append(value)
+        for op in self._temporal_signals.get(signal, ()):
+            op.update(variables)
+        if state_table:
+            state_table.set(signal, value, get_runtime())
+        if history:
+            history.record(signal, value, get_runtime())
+
+    def _format_state(self):
+        lines = ["State = {"]
         for k, v in sorted(vars(self.variables).items()):
-            logger.i("{} = {}".format(k, v))
-        logger.i("}")
+            lines.append("{} = {}".format(k, v))
+        lines.append("}")
+        return "\n".join(lines)
 
     def _undot_identifiers(self, condition, identifiers):
         for ident in identifiers:
@@ -495,10 +1416,6 @@ class State(object):
                 condition = condition.replace(ident, ident.replace('.', '_'))
         return condition
 
-    def _undot_variables(self, variables):
-        # Replace '.' by '_' in variables names (identifiers)
-        return { k.replace('.', '_'): v for k, v in variables.items() }
-
 class ParseIdentifiers(ast.NodeVisitor):
     '''
         Class to parse identifiers (signals and attributes names)
@@ -526,6 +1443,16 @@ class ParseIdentifiers(ast.NodeVisitor):
         self._attributes.append(node.attr)
         super().generic_visit(node)
 
+    def visit_Call(self, node):
+        # the name of an aggregate function or temporal operator isn't a signal
+        if isinstance(node.func, ast.Name) and \
+                (node.func.id in vsmlib.windows.AGGREGATE_FUNCTIONS or
+                 node.func.id in vsmlib.temporal.TEMPORAL_FUNCTIONS):
+            for arg in node.args:
+                self.visit(arg)
+        else:
+            super().generic_visit(node)
+
 class LogReplayer(object):
     '''
         Class to enact log file replaying (signals only)
@@ -534,10 +1461,13 @@ class LogReplayer(object):
     signals = []
 
     def __init__(self, state, replay_log, replay_rate):
-        with open(replay_log) as f:
-            content = f.readlines()
-            for line in content:
-                self.__parse_replay_log_line(line)
+        if vsmlib.binlog.is_binary_log(replay_log):
+            self.__read_binary_log(replay_log)
+        else:
+            with open(replay_log) as f:
+                content = f.readlines()
+                for line in content:
+                    self.__parse_replay_log_line(line)
 
         for signal in self.signals:
             # by default, don't adjust time scale (ie, 100%)
@@ -556,6 +1486,17 @@ class LogReplayer(object):
                 delayed_emit(signal.name, signal.value, remaining_delay_ms,
                         state)
 
+    def __read_binary_log(self, replay_log):
+        # binary logs keep the value types, so they don't need to be parsed
+        with vsmlib.binlog.BinaryLogReader(replay_log) as reader:
+            for record in reader.records():
+                if record.indicator == SIGNAL_PREFIX_INCOMING:
+                    direction = self.Signal.DIRECTION_IN
+                else:
+                    direction = self.Signal.DIRECTION_OUT
+                self.signals.append(self.Signal(direction, record.time_ms,
+                    record.signal, record.value))
+
     def __parse_replay_log_line(self, line):
         if SIGNAL_PREFIX_DELIM not in line:
             return
@@ -572,13 +1513,14 @@ class LogReplayer(object):
             try:
                 time_ms, name, signum, value = remainder.split(',')
                 time_ms = int(time_ms)
-                # eval() the value to effectively reverse the excessive repr()
-                # which will be applied before printing this value (which would
-                # result in values like "'True'\n" instead of 'True'
-                value = eval(value)
+                # literal_eval() the value to effectively reverse the excessive
+                # repr() which will be applied before printing this value
+                # (which would result in values like "'True'\n" instead of
+                # 'True'
+                value = ast.literal_eval(value)
                 self.signals.append(self.Signal(direction, time_ms, name,
                     value))
-            except ValueError as err:
+            except (ValueError, SyntaxError) as err:
                 logger.e('failed to parse line (invalid number of elements): ' +
                         '{}; line was:\n{}'.format(err, line))
 
@@ -609,6 +1551,7 @@ class TreeNode:
         self.value = value
         self.children = []
         self.rule = None
+        self.item_key = None
 
         if node_type == NODE_CONDITION:
             self.monitor_init_time_ms = -1
@@ -618,9 +1561,28 @@ class TreeNode:
             self.start_time_ms = start
             self.stop_time_ms = stop
             self.signals = signals
+            self.predicate = None
+            self.temporal_ops = []
+            self.emit_signal = None
+            # closest ancestor condition and subconditions it is the closest
+            # ancestor of, and the function to call when condition_met changes
+            self.gate = None
+            self.gated = []
+            self.met_changed = None
+            # sequence node this condition is a step of, and its index
+            self.sequence = None
+            self.step = None
+            # number of its signals which haven't been set yet
+            self.unset = 0
 
         elif node_type == NODE_SEQUENCE:
+            # state machine: the condition of each block is a step, met one
+            # after the other
             self.next_grandchild_index = 0
+            self.steps = []
+            self.step_changed = None
+            # signal updates ignored because they are not for the current step
+            self.blocked = 0
 
     def __str__(self):
         return self.__str_indent("")
@@ -636,6 +1598,35 @@ class TreeNode:
         self.children.append(child)
         child.parent = self
 
+    def walk_paths(self, path=()):
+        '''
+        Like walk() but also provide the path of each node in the tree as a
+        tuple of child indices.
+        '''
+        yield path, self
+        for index, child in enumerate(self.children):
+            yield from child.walk_paths(path + (index,))
+
+    def walk(self):
+        '''
+        Iterate over this node and all the nodes below it, in depth-first order.
+        '''
+        yield self
+        for child in self.children:
+            yield from child.walk()
+
+    def release(self):
+        '''
+        Cancel the timers of this node and the nodes below it once they have
+        been removed from the tree.
+        '''
+        for node in self.walk():
+            if node.node_type == NODE_CONDITION:
+                node._monitor_completed(True, "")
+                node_refs.pop(repr(node), None)
+            elif node.node_type == NODE_FILTER:
+                node.signal_filter.cancel()
+
     def find(self, value):
         '''
         Find the given value in the tree, starting at this node and searching
@@ -743,10 +1734,26 @@ class TreeNode:
             # parent condition is no longer true so cancel monitor
             self._monitor_completed(True, "")
 
+    def restore_monitor(self, elapsed_ms):
+        '''
+        Set up the monitor again, as if it had been started elapsed_ms ago.
+        '''
+        self.monitor_init_time_ms = get_runtime() - elapsed_ms
+        self.start_timer = threading.Timer(
+                max(self.start_time_ms - elapsed_ms, 0) / 1000,
+                self.start_timeout_func)
+        self.stop_timer = threading.Timer(
+                max(self.stop_time_ms - elapsed_ms, 0) / 1000,
+                self.stop_timeout_func)
+        self.start_timer.start()
+        if self.stop_timer:
+            self.stop_timer.start()
+
     def notify_condition(self, state):
         start_max_ms = self.monitor_init_time_ms + self.start_time_ms
         stop_min_ms = self.monitor_init_time_ms + self.stop_time_ms
         runtime = get_runtime()
+        was_met = self.condition_met
 
         if state:
             # only allow the node's condition_met change from False to True if
@@ -765,12 +1772,15 @@ class TreeNode:
                                 "{}ms and 'stop' time of {}ms".format(
                             self.start_time_ms, self.stop_time_ms))
 
+        # before the monitors of the subconditions are set up
+        if self.condition_met != was_met and self.met_changed:
+            self.met_changed(self)
 
         for subcondition in self.find_subconditions():
             subcondition.notify_ancestor_condition(self.condition_met)
 
-        if self.parent and self.parent.parent:
-            self.parent.parent._sequence_iterate_safe(self)
+        if self.sequence and self.condition_met:
+            self.sequence.sequence_step_met(self)
 
     def _monitor_completed(self, succeeded, failure_message):
         if self.start_timer:
@@ -784,6 +1794,10 @@ class TreeNode:
         if not succeeded:
             self.condition_met = False
             logger.e(failure_message)
+            if history:
+                for signal in dict.fromkeys(self.signals):
+                    logger.e("history of {}: {}", signal, history.last(
+                        signal, MONITOR_HISTORY_VALUES))
 
     def start_timeout_func(self):
         if not self.condition_met:
@@ -794,57 +1808,43 @@ class TreeNode:
     def stop_timeout_func(self):
         self._monitor_completed(True, "")
 
-    def _sequence_iterate_safe(self, condition_grandchild):
-        if self.node_type != NODE_SEQUENCE:
-            return
-
-        if condition_grandchild.condition_is_sequence_next():
-            self.next_grandchild_index += 1
-            # there will be exactly one condition per child node
-            if self.next_grandchild_index >= len(self.children):
-                self.next_grandchild_index = 0
-        else:
-            pass
-
-    def condition_is_sequence_next(self):
-        grandparent = self.condition_get_sequence_grandparent()
-        if not grandparent:
-            return False
-
-        next_seq_condition = grandparent.children[
-                grandparent.next_grandchild_index].children[NODE_CONDITION_POS]
-
-        if next_seq_condition is self:
-            return True
-
-        return False
+    def compile_sequence(self, step_changed):
+        '''
+        Set up the state machine of a sequence node, whose steps are the
+        condition of each of its blocks, and the function to call with the
+        previous and the new current step when it moves on.
+        '''
+        self.steps = []
+        for index, block in enumerate(self.children):
+            step = None
+            for child in block.children:
+                if child.node_type == NODE_CONDITION:
+                    step = child
+                    step.sequence = self
+                    step.step = index
+                    break
+            self.steps.append(step)
+        self.step_changed = step_changed
+        if self.next_grandchild_index >= len(self.steps):
+            self.next_grandchild_index = 0
 
-    def condition_get_sequence_grandparent(self):
-        if self.node_type == NODE_CONDITION:
-            grandparent = None
-            if self.parent:
-                grandparent = self.parent.parent
-                if grandparent and grandparent.node_type == NODE_SEQUENCE:
-                    return grandparent
+    def sequence_step_met(self, step):
+        '''
+        Move a sequence on to its next step if the given one is its current
+        step.
+        '''
+        if self.steps[self.next_grandchild_index] is not step:
+            return
 
-        return None
+        self.next_grandchild_index += 1
+        if self.next_grandchild_index >= len(self.steps):
+            self.next_grandchild_index = 0
+        if self.step_changed:
+            self.step_changed(step, self.steps[self.next_grandchild_index])
 
     def condition_is_sequence_blocked(self):
-        seq_grandparent = self.condition_get_sequence_grandparent()
-        if seq_grandparent and not self.condition_is_sequence_next():
-            return True
-
-        return False
-
-    def get_conditions_by_rule(self, rule):
-        conditions_matched = []
-        for child in self.children:
-            conditions_matched.extend(child.get_conditions_by_rule(rule))
-
-        if self.node_type == NODE_CONDITION and self.rule is rule:
-            conditions_matched.append(self)
-
-        return conditions_matched
+        return self.sequence is not None and \
+            self.sequence.steps[self.sequence.next_grandchild_index] is not self
 
 def show(signal, value, indicator):
     '''
@@ -860,7 +1860,10 @@ class DebugIPC(ipc.stream.StdioIPC):
 
     def receive(self):
         message = super(DebugIPC, self).receive()
-        if message is not None:
+        if isinstance(message, dict):
+            for signal, value in message.items():
+                show(signal, value, SIGNAL_PREFIX_INCOMING)
+        elif message is not None:
             signal, value = message
             show(signal, value, SIGNAL_PREFIX_INCOMING)
         return message
@@ -882,16 +1885,22 @@ def emit(signal, value):
     # Record sent signal in logs.
     logger.signal(signal, value, SIGNAL_PREFIX_OUTGOING)
     ipc_obj.send(signal, value)
-    state._update_report_state(signal, value)
+    if state.propagate_emits:
+        state.emitted(signal, value)
+    else:
+        # eg, delayed emits from the thread of the scheduler
+        with state.lock:
+            state._update_report_state(signal, value)
 
 def delayed_got_signal(signal, value, delay, state):
     time.sleep(delay/1000)
     show(signal, value, SIGNAL_PREFIX_INCOMING)
     state.got_signal_record(signal, value)
 
-def process(state, signal, value):
+def parse_value(value):
     '''
-        Handle the emitting of signals and adding values to state
+        Convert a signal value to the types: string, bool, float or int,
+        raising a ValueError if it has none of them
     '''
     def is_string(value):
         if not isinstance(value, str) or len(value) <= 2:
@@ -904,60 +1913,171 @@ def process(state, signal, value):
         # eg, "trUe"
         return value in ('true', 'True') or value in ('false', 'False')
 
-    # Check and convert value to the types: string, bool, float or int
+    if value == None:
+        raise ValueError
+    if is_string(value):
+        return value[1:-1]
+    if is_bool(value):
+        return value in ('true', 'True') or False
+    if value.find('.') >= 0:
+        return float(value)
+    if value.isnumeric():
+        return int(value)
+    raise ValueError
+
+def process(state, signal, value):
+    '''
+        Handle the emitting of signals and adding values to state
+    '''
     try:
-        if value == None:
-            raise ValueError
-        if is_string(value):
-            value = value[1:-1]
-        elif is_bool(value):
-            value = value in ('true', 'True') or False
-        elif value.find('.') >= 0:
-            value = float(value)
-        elif value.isnumeric():
-            value = int(value)
-        else:
-            raise ValueError
+        value = parse_value(value)
     except ValueError:
         logger.e('incorrect value: {}'.format(value))
         return
 
-    state.got_signal(signal, value)
+    if signal in state.filters:
+        state.filters[signal].push(value)
+    else:
+        state.got_signal(signal, value)
 
-def log_processor(pipein_fd, log_file_path):
-    pipein = os.fdopen(pipein_fd)
-    log_file = sys.stdout
+def process_frame(state, message):
+    '''
+        Handle a dictionary of signals received together, which are added to
+        the state at once
+    '''
+    values = {}
+    for signal, value in message.items():
+        try:
+            value = parse_value(value)
+        except ValueError:
+            logger.e('incorrect value: {}'.format(value))
+            continue
+
+        # the filtered signals are processed at their own rate
+        if signal in state.filters:
+            state.filters[signal].push(value)
+        else:
+            values[signal] = value
+
+    if values:
+        state.got_frame(values)
+
+def log_processor(pipein_fd, log_file_path, max_size=0, rotate_interval=0,
+                  backups=vsmlib.logfile.BACKUPS_DEFAULT, compress=False,
+                  ring_buffer_size=0, sinks=(),
+                  sink_queue_size=vsmlib.logsinks.QUEUE_SIZE_DEFAULT):
+    log_file = sys.stdout.buffer
 
     if log_file_path == None or log_file_path == '':
         log_file_path = LOG_FILE_PATH_DEFAULT
 
     if log_file_path != '-':
         try:
-            log_file = open(log_file_path, 'w')
+            log_file = vsmlib.logfile.RotatingLogFile(log_file_path, max_size,
+                                                      rotate_interval, backups,
+                                                      compress)
         except Exception as e:
             log_file.write("failed to open log file '{}': {}\n".format(
-                log_file_path, e))
+                log_file_path, e).encode('UTF-8'))
 
-    for line in pipein:
-        log_file.write(line)
-        log_file.flush()
+    ring_buffer = None
+    if ring_buffer_size:
+        ring_buffer = vsmlib.logfile.RingBufferLog(log_file, ring_buffer_size)
+    output = ring_buffer or log_file
 
-    if log_file_path:
-        log_file.close()
+    # the other sinks get all the lines, even with a ring buffer
+    log_sinks = []
+    for spec in sinks:
+        try:
+            log_sinks.append(vsmlib.logsinks.create(spec, sink_queue_size))
+        except (OSError, ValueError) as e:
+            output.write("failed to open log sink '{}': {}\n".format(
+                spec, e).encode('UTF-8'))
+
+    # write whatever has been received at once and only flush then, rather
+    # than after each line
+    pending = b''
+    while True:
+        data = os.read(pipein_fd, LOG_READ_SIZE)
+        if not data:
+            break
+
+        data = pending + data
+        cut = data.rfind(b'\n') + 1
+        data, pending = data[:cut], data[cut:]
+
+        if LOG_CONTROL_DUMP in data:
+            lines = data.splitlines(keepends=True)
+            for line in lines:
+                if line != LOG_CONTROL_DUMP:
+                    output.write(line)
+                elif ring_buffer:
+                    ring_buffer.dump()
+            data = b''.join(line for line in lines if line != LOG_CONTROL_DUMP)
+        elif data:
+            output.write(data)
+        output.flush()
+
+        if data:
+            for sink in log_sinks:
+                sink.put(data)
+
+    if pending:
+        output.write(pending)
+        for sink in log_sinks:
+            sink.put(pending)
+
+    for sink in log_sinks:
+        sink.close()
+        if sink.dropped or sink.errors:
+            output.write("log sink '{}': {} batches dropped, {} errors\n".format(
+                sink.name, sink.dropped, sink.errors).encode('UTF-8'))
+    output.close()
+
+    os.close(pipein_fd)
+
+def log_processor_options(args):
+    return {
+        'max_size': args.log_max_size,
+        'rotate_interval': args.log_rotate_interval,
+        'backups': args.log_backups,
+        'compress': args.log_compress,
+        'ring_buffer_size': args.log_ring_buffer,
+        'sinks': args.log_sink,
+        'sink_queue_size': args.log_sink_queue,
+    }
+
+def log_sink_spec(spec):
+    try:
+        vsmlib.logsinks.parse_spec(spec)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+    return spec
 
-    pipein.close()
+def parse_size(size):
+    '''
+        Parse a size in bytes, with an optional k, M or G suffix
+    '''
+    units = {'k': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+    try:
+        if size and size[-1] in units:
+            return int(float(size[:-1]) * units[size[-1]])
+        return int(size)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid size: '{}'".format(size))
 
 def run(state):
     try:
         while True:
             message = ipc_obj.receive()
+            # eg, a client connecting or sending part of a line
+            if message is ipc.NO_SIGNAL:
+                continue
 
-            #If received object is a dictionary process each signal, value pair separately
-            if isinstance(message,dict):
-              for signal in message:
-                    value = message[signal]
-                    process(state, signal, value)
-            else :
+            # the signals of a dictionary are processed as one frame
+            if isinstance(message, dict):
+                process_frame(state, message)
+            else:
                 if message is None:
                     logger.i("skipping invalid message")
                     continue
@@ -966,23 +2086,178 @@ def run(state):
 
                 # 'quit' signal to close VSM endpoint.
                 if signal == 'quit':
+                    if snapshot_file:
+                        snapshots_done.set()
+                        state.write_snapshot(snapshot_file)
                     ipc_obj.close()
+                    log_ipc_stats()
                     break
 
+                # parse the new rules without blocking the incoming signals
+                if signal == SIGNAL_RELOAD:
+                    threading.Thread(target=state.reload_rules).start()
+                    continue
+
+                if signal == SIGNAL_LOG_DUMP:
+                    logger.dump()
+                    continue
+
+                if signal == SIGNAL_READINESS:
+                    state.log_readiness()
+                    continue
+
+                if signal in (SIGNAL_LOG_LEVEL, SIGNAL_LOG_ENABLE,
+                              SIGNAL_LOG_DISABLE):
+                    set_log_option(signal, value)
+                    continue
+
+                if signal == SIGNAL_HISTORY:
+                    query_history(value)
+                    continue
+
                 # process (signal, value) 2-tuple strings
                 process(state, signal, value)
     except KeyboardInterrupt:
         exit(0)
+    finally:
+        # also when the IPC module exits on its own
+        state.log_sequence_stats()
+
+def unquote(value):
+    if isinstance(value, str) and len(value) >= 2 and \
+            value[0] == value[-1] and value[0] in ('"', "'"):
+        return value[1:-1]
+    return value
+
+def set_log_option(signal, value):
+    '''
+        Change the log level or a log category from an IPC signal
+    '''
+    value = unquote(value)
+
+    try:
+        if signal == SIGNAL_LOG_LEVEL:
+            if value not in LOG_LEVELS:
+                raise ValueError("unknown log level: {}".format(value))
+            logger.set_level(value)
+        else:
+            logger.set_category(value, signal == SIGNAL_LOG_ENABLE)
+    except ValueError as err:
+        logger.e("invalid '{}' signal: {}", signal, err)
+
+def query_history(value):
+    '''
+        Send the history of a signal requested by an IPC signal: 'signal' for
+        all of it, 'signal,count' for its last values or 'signal,start,end'
+        for the values set between two times in ms, either of which may be
+        left empty
+    '''
+    if not history:
+        logger.e("no history to query, use --history to keep one")
+        return
+
+    try:
+        fields = [field.strip() for field in str(unquote(value)).split(',')]
+        signal = fields[0]
+        if len(fields) == 1:
+            values = history.last(signal)
+        elif len(fields) == 2:
+            values = history.last(signal, int(fields[1]))
+        elif len(fields) == 3:
+            start_ms, end_ms = (float(field) if field else None
+                                for field in fields[1:])
+            values = history.range(signal, start_ms, end_ms)
+        else:
+            raise ValueError("expected 'signal', 'signal,count' or " \
+                             "'signal,start,end'")
+    except ValueError as err:
+        logger.e("invalid '{}' signal: {}", SIGNAL_HISTORY, err)
+        return
+
+    ipc_obj.send(SIGNAL_HISTORY, json.dumps({'signal': signal,
+                                             'values': values}))
+
+def parse_history_size(spec):
+    '''
+        Parse a SIGNAL=SIZE history size of a signal
+    '''
+    signal, _, size = spec.partition('=')
+    try:
+        size = int(size)
+        if not signal or size < 0:
+            raise ValueError
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "expected SIGNAL=SIZE: '{}'".format(spec))
+    return signal, size
+
+def watch_rules(state, interval_ms):
+    '''
+        Reload the rules each time the rules file gets modified
+    '''
+    def get_mtime():
+        try:
+            return os.stat(state.rules_path).st_mtime_ns
+        except OSError:
+            return None
+
+    mtime = get_mtime()
+    while True:
+        time.sleep(interval_ms / 1000)
+        new_mtime = get_mtime()
+        if new_mtime is not None and new_mtime != mtime:
+            mtime = new_mtime
+            state.reload_rules()
+
+def write_snapshots(state, filename, interval_ms):
+    '''
+        Write a snapshot of the state every interval_ms
+    '''
+    while not snapshots_done.wait(interval_ms / 1000):
+        state.write_snapshot(filename)
+
+def load_ipc_routes(filename):
+    '''
+        Load the IPC routing table: a dictionary with a list of signal names,
+        numbers or glob patterns for each IPC module name
+    '''
+    with open(filename) as f:
+        routes = yaml.safe_load(f)
+
+    if not isinstance(routes, dict):
+        raise ValueError("expected a dictionary of IPC module names")
+    for name, patterns in routes.items():
+        if not isinstance(patterns, list) or \
+                not all(isinstance(p, (str, int)) for p in patterns):
+            raise ValueError("expected a list of signal names, numbers or " \
+                             "patterns for '{}'".format(name))
+    return routes
+
+def log_ipc_stats():
+    '''
+        Log the send queue statistics of the threaded IPC modules (if any)
+    '''
+    if not hasattr(ipc_obj, 'stats'):
+        return
+
+    stats = ipc_obj.stats()
+    if not isinstance(stats, list):
+        stats = [stats]
+
+    for sink_stats in stats:
+        logger.i(lambda: "IPC send stats: {}".format(
+            ", ".join("{}={}".format(k, round(v, 3))
+                for k, v in sorted(sink_stats.items()))), category=LOG_CAT_IPC)
 
 def get_runtime():
     return round(time.perf_counter() * 1000 - program_start_time_ms)
 
 def start_state_machine(args):
     global config_tree
-    log_categories = {LOG_CAT_CONDITION_CHECKS: args.log_condition_checks}
     replaying = True if args.replay_log_file else False
     config_tree = TreeNode(NODE_ROOT, None)
-    state = State(args.initial_state, args.rules, log_categories)
+    state = State(args.initial_state, args.rules, args.optimize_rules,
+                  args.index_predicates, args.propagate_emits)
 
     run(state)
 
@@ -998,12 +2273,57 @@ if __name__ == "__main__":
                         help="List of IPC modules to load")
     parser.add_argument('--log-file', type=str,
             help='Write extra (non-signal emission) output to this file')
+    parser.add_argument('--log-max-size', type=parse_size, default=0,
+            metavar='SIZE',
+            help='Rotate the log file when it reaches this size, eg 10M ' +
+            '(default: no size limit)')
+    parser.add_argument('--log-rotate-interval', type=int, default=0,
+            metavar='SECONDS',
+            help='Rotate the log file after this many seconds (default: ' +
+            'no time limit)')
+    parser.add_argument('--log-backups', type=int,
+            default=vsmlib.logfile.BACKUPS_DEFAULT,
+            help='Number of rotated log files to keep, 0 to keep all of ' +
+            'them (default: {})'.format(vsmlib.logfile.BACKUPS_DEFAULT))
+    parser.add_argument('--log-compress', action='store_true',
+            help='Compress the rotated log files with gzip')
+    parser.add_argument('--log-ring-buffer', type=parse_size, default=0,
+            metavar='SIZE',
+            help='Only keep the last SIZE of logs in memory and write them ' +
+            'to the log file after an error or when receiving a "' +
+            SIGNAL_LOG_DUMP + '" signal')
+    parser.add_argument('--log-sink', type=log_sink_spec, action='append',
+            default=[], metavar='KIND:TARGET',
+            help='Also send the logs to this sink (may be repeated): ' +
+            'file:PATH, json:PATH (JSON lines), unix:PATH (Unix datagram ' +
+            'socket) or udp:[HOST:]PORT, the last two sending JSON lines')
+    parser.add_argument('--log-sink-queue', type=int,
+            default=vsmlib.logsinks.QUEUE_SIZE_DEFAULT, metavar='BATCHES',
+            help='Number of batches of lines queued for each log sink, ' +
+            'beyond which they are dropped (default: {})'.format(
+                vsmlib.logsinks.QUEUE_SIZE_DEFAULT))
+    parser.add_argument('--log-level', choices=LOG_LEVELS,
+            default=LOG_LEVEL_INFO,
+            help='Only log the messages up to this level (default: ' +
+            LOG_LEVEL_INFO + ')')
+    parser.add_argument('--log-enable', choices=LOG_CATEGORIES,
+            action='append', default=[], metavar='CATEGORY',
+            help='Log category to enable (may be repeated), among: ' +
+            ', '.join(LOG_CATEGORIES) + ' (default: all except ' +
+            ', '.join(LOG_CATEGORIES_DISABLED_DEFAULT) + ')')
+    parser.add_argument('--log-disable', choices=LOG_CATEGORIES,
+            action='append', default=[], metavar='CATEGORY',
+            help='Log category to disable (may be repeated)')
     parser.add_argument('--no-log-condition-checks',
             dest='log_condition_checks', action='store_false',
-            help='Do not log condition checks (default: log them)')
+            help='Do not log condition checks (default: log them), same ' +
+            'as --log-disable ' + LOG_CAT_CONDITION_CHECKS)
     parser.add_argument('--replay-log-file', type=str,
             help='Use a log file to replay signal emission in real or scaled ' +
-            'time')
+            'time (either a text or a binary log)')
+    parser.add_argument('--binary-log-file', type=str,
+            help='Also record the signals to this file in the compact ' +
+            'binary log format')
     parser.add_argument('--replay-rate', type=float,
             help='The rate at which to play back the replay log. This value ' +
             'is a percentage of originally-recorded timing, specified as a ' +
@@ -1011,18 +2331,66 @@ if __name__ == "__main__":
             str(REPLAY_RATE_MAX) + '. A value of 20 signifies playback at ' +
             '20%% of the original rate (ie, it will take 5 times as long to ' +
             'complete playback vs 100%%)')
+    parser.add_argument('--watch-rules', type=int, metavar='INTERVAL_MS',
+            help='Check every INTERVAL_MS whether the rules file has been ' +
+            'modified and reload it if so (a "' + SIGNAL_RELOAD + '" signal ' +
+            'received via IPC reloads it too)')
+    parser.add_argument('--snapshot-file', type=str,
+            help='Periodically save the state to this file and restore it ' +
+            'from there when starting')
+    parser.add_argument('--snapshot-interval', type=int,
+            default=SNAPSHOT_INTERVAL_MS_DEFAULT, metavar='INTERVAL_MS',
+            help='How often to save the state to the snapshot file ' +
+            '(default: {}ms)'.format(SNAPSHOT_INTERVAL_MS_DEFAULT))
+    parser.add_argument('--state-table', type=str, metavar='PATH',
+            help='Publish the signal values to this file mapped in shared ' +
+            'memory (eg in /dev/shm) for other processes to read')
+    parser.add_argument('--history', type=int, default=0, metavar='SIZE',
+            help='Keep the last SIZE values of each signal in memory, to ' +
+            'query with the \'{}\' IPC signal and log when a monitor '.format(
+                SIGNAL_HISTORY) +
+            'fails (default: 0, no history)')
+    parser.add_argument('--history-signal', type=parse_history_size,
+            action='append', default=[], metavar='SIGNAL=SIZE',
+            help='Keep the last SIZE values of this signal instead, 0 for ' +
+            'none (may be given several times, with or without --history)')
+    parser.add_argument('--log-optimizer', action='store_true',
+            help='Log the changes made by the rules optimizer')
+    parser.add_argument('--no-optimize-rules',
+            dest='optimize_rules', action='store_false',
+            help='Do not optimize the rule conditions (default: optimize them)')
+    parser.add_argument('--no-index-predicates',
+            dest='index_predicates', action='store_false',
+            help='Evaluate all the conditions on a signal when it changes, ' +
+                 'instead of skipping the comparisons to constants which ' +
+                 'stay false (default: skip them)')
+    parser.add_argument('--propagate-emits', action='store_true',
+            help='Process the signals emitted by the rules like received ' +
+                 'ones, in the order of their dependencies, instead of ' +
+                 'only sending them (default: only send them)')
     parser.set_defaults(log_condition_checks=True)
     parser.add_argument('--log-format', choices=['catapult'],
                         help='Write log file in specified format')
     parser.add_argument('--signal-number-file', type=str,
                         help='.vsi file which maps all signal names to numbers',
                         required=True)
+    parser.add_argument('--ipc-routes', type=str, metavar='FILE',
+            help='YAML file with the signals to send to each IPC module, ' +
+            'as a list of signal names, numbers or glob patterns for each ' +
+            'module name (default: send all the signals to all the modules)')
+    parser.add_argument('--ipc-send-queue', type=int, default=0,
+            help='Send signals to each IPC module from a separate thread ' +
+            'with a queue of this size (default: 0, send synchronously)')
+    parser.add_argument('--ipc-send-policy', choices=ipc.threaded.POLICIES,
+            default=ipc.threaded.POLICY_BLOCK,
+            help='What to do when an IPC send queue is full (default: ' +
+            ipc.threaded.POLICY_BLOCK + ')')
     args = parser.parse_args()
 
     set_up_globals(args)
 
-    log_categories = {LOG_CAT_CONDITION_CHECKS: args.log_condition_checks}
     replayinglog =  args.replay_log_file
+    snapshot_file = args.snapshot_file
 
     if args.replay_rate and \
             (args.replay_rate < REPLAY_RATE_MIN or \
@@ -1031,28 +2399,70 @@ if __name__ == "__main__":
             REPLAY_RATE_MIN, REPLAY_RATE_MAX), file=sys.stderr)
         exit(1)
 
-    # fork separate process to handle logging so we don't block main process
-    pipein_fd, pipeout_fd = os.pipe()
-    if os.fork() == 0:
-        os.close(pipeout_fd)
-        log_processor(pipein_fd, args.log_file)
+    start_logger(args)
+
+    ipc_wrapper = None
+    if args.ipc_send_queue > 0:
+        def ipc_wrapper(sink):
+            return ipc.threaded.ThreadedIPC(sink, args.ipc_send_queue,
+                                            args.ipc_send_policy)
+
+    ipc_routes = None
+    if args.ipc_routes:
+        try:
+            ipc_routes = load_ipc_routes(args.ipc_routes)
+        except (OSError, ValueError, yaml.YAMLError) as e:
+            print("invalid IPC routes file '{}': {}".format(
+                args.ipc_routes, e), file=sys.stderr)
+            exit(1)
+
+    if not args.ipc_modules:
+        ipc_obj = DebugIPC()
+    elif len(args.ipc_modules) == 1 and not ipc_routes:
+        ipc_obj = ipc.load(args.ipc_modules[0])
     else:
-        os.close(pipein_fd)
+        try:
+            ipc_obj = ipc.IPCList(args.ipc_modules, ipc_wrapper, ipc_routes,
+                                  signal_to_num)
+        except ValueError as e:
+            print("invalid IPC routes: {}".format(e), file=sys.stderr)
+            exit(1)
+
+    if ipc_wrapper and not isinstance(ipc_obj, ipc.IPCList):
+        # it couldn't receive signals while sending them from its thread
+        if not hasattr(ipc_obj, 'fileno'):
+            print("--ipc-send-queue needs an IPC module with a file " \
+                  "descriptor to receive signals from", file=sys.stderr)
+            exit(1)
+        ipc_obj = ipc_wrapper(ipc_obj)
 
-        start_logger(args)
+    config_tree = TreeNode(NODE_ROOT, None)
 
-        if not args.ipc_modules:
-            ipc_obj = DebugIPC()
-        elif len(args.ipc_modules) == 1:
-            ipc_obj = ipc.load(args.ipc_modules[0])
-        else:
-            ipc_obj = ipc.IPCList(args.ipc_modules)
+    if args.history or args.history_signal:
+        history = vsmlib.history.HistoryStore(args.history,
+                                              dict(args.history_signal))
+
+    state = State(args.initial_state, args.rules, args.optimize_rules,
+                  args.index_predicates, args.propagate_emits)
 
-        config_tree = TreeNode(NODE_ROOT, None)
+    if args.state_table:
+        state_table = vsmlib.statetable.StateTableWriter(args.state_table,
+                                                         signal_to_num)
+        with state.lock:
+            state_table.update(vars(state.variables), get_runtime())
 
-        state = State(args.initial_state, args.rules, log_categories)
+    if args.snapshot_file:
+        state.restore_snapshot(args.snapshot_file)
+        threading.Thread(target=write_snapshots,
+                         args=(state, args.snapshot_file,
+                               args.snapshot_interval),
+                         daemon=True).start()
 
-        if args.replay_log_file:
-            LogReplayer(state, args.replay_log_file, args.replay_rate)
+    if args.watch_rules:
+        threading.Thread(target=watch_rules, args=(state, args.watch_rules),
+                         daemon=True).start()
 
-        run(state)
+    if args.replay_log_file:
+        LogReplayer(state, args.replay_log_file, args.replay_rate)
+
+    run(state)
@@ -0,0 +1,409 @@
+# Copyright (C) 2018 Jaguar Land Rover
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+'''
+Compact binary format for signal recordings.
+
+A binary signal log starts with a file header followed by blocks, each with a
+(tag, payload size, entry count) header:
+
+* NAME:  signal names, with the id used for them in the records; the id is the
+         signal number, or UNNUMBERED_BASE and up for signals without one
+* STRS:  string values, numbered in the order they appear in the file
+* RECS:  a segment of fixed-size records, starting with the time of its first
+         and last record so readers can find a given time without reading the
+         records of the other segments
+
+Each record holds its time in milliseconds, the signal id, the direction, the
+value type and the value itself (an integer, a float or a string number).
+Name and string blocks are always written before the records using them.
+'''
+
+import ast
+import bisect
+import collections
+import mmap
+import os
+import re
+import struct
+import threading
+
+MAGIC = b'VSMB'
+VERSION = 1
+
+FILE_HEADER = struct.Struct('<4sB3x')
+BLOCK_HEADER = struct.Struct('<4sII')
+SEGMENT_HEADER = struct.Struct('<II')
+RECORD = struct.Struct('<IIBBxx8s')
+RECORD_TIME = struct.Struct('<I')
+NAME_ENTRY = struct.Struct('<IH')
+STRING_ENTRY = struct.Struct('<I')
+INT_VALUE = struct.Struct('<q')
+FLOAT_VALUE = struct.Struct('<d')
+
+BLOCK_NAMES = b'NAME'
+BLOCK_STRINGS = b'STRS'
+BLOCK_RECORDS = b'RECS'
+
+TYPE_NONE = 0
+TYPE_BOOL = 1
+TYPE_INT = 2
+TYPE_FLOAT = 3
+TYPE_STRING = 4
+
+# signal prefixes of the text logs, in the order of their direction number
+INDICATORS = ('>', '<')
+
+# ids of the signals missing from the signal number file
+UNNUMBERED_BASE = 1 << 31
+
+RECORDS_PER_SEGMENT = 4096
+
+SIGNUM_UNKNOWN = '[SIGNUM]'
+TEXT_SIGNAL_PATTERN = re.compile(
+    r'^(?P<indicator>[<>]) (?P<time>[\d\.]+),(?P<signal>[^,]+),'
+    r'(?P<signum>\[SIGNUM\]|\d+),(?P<value>.*)$')
+
+Record = collections.namedtuple('Record',
+                                'time_ms signal signum indicator value')
+
+
+def is_binary_log(filename):
+    '''
+    Check whether a file is a binary signal log, rather than a text log.
+    '''
+    with open(filename, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def format_record(record):
+    '''
+    Format a record like the signal lines of the text logs.
+    '''
+    signum = SIGNUM_UNKNOWN if record.signum is None else record.signum
+    return '{} {},{},{},{}'.format(record.indicator, record.time_ms,
+                                   record.signal, signum, repr(record.value))
+
+
+def parse_text_line(line):
+    '''
+    Parse a signal line of a text log into a record, or return None if the
+    line is not a signal line.
+    '''
+    match = TEXT_SIGNAL_PATTERN.match(line.strip())
+    if not match:
+        return None
+
+    signum = match.group('signum')
+    try:
+        value = ast.literal_eval(match.group('value'))
+    except (ValueError, SyntaxError):
+        return None
+
+    return Record(round(float(match.group('time'))), match.group('signal'),
+                  None if signum == SIGNUM_UNKNOWN else int(signum),
+                  match.group('indicator'), value)
+
+
+class BinaryLogWriter(object):
+    '''
+    Write signal records to a binary log file.
+
+    Records are buffered and written a segment at a time, or when flush() is
+    called.  Signals may be written from several threads.
+    '''
+
+    def __init__(self, filename):
+        self._file = open(filename, 'wb')
+        self._file.write(FILE_HEADER.pack(MAGIC, VERSION))
+        self._lock = threading.Lock()
+        self._ids = {}
+        self._strings = {}
+        self._next_unnumbered = UNNUMBERED_BASE
+        self._new_names = []
+        self._new_strings = []
+        self._records = bytearray()
+        self._count = 0
+        self._first_time = None
+        self._last_time = None
+
+    def write(self, time_ms, signal, signum, indicator, value):
+        with self._lock:
+            signal_id = self._ids.get(signal)
+            if signal_id is None:
+                if signum is None:
+                    signal_id = self._next_unnumbered
+                    self._next_unnumbered += 1
+                else:
+                    signal_id = signum
+                self._ids[signal] = signal_id
+                self._new_names.append((signal_id, signal))
+
+            value_type, raw = self._pack_value(value)
+            self._records += RECORD.pack(time_ms, signal_id,
+                                         INDICATORS.index(indicator),
+                                         value_type, raw)
+            self._count += 1
+            if self._first_time is None:
+                self._first_time = time_ms
+            self._last_time = time_ms
+
+            if self._count >= RECORDS_PER_SEGMENT:
+                self._write_blocks()
+
+    def flush(self):
+        with self._lock:
+            self._write_blocks()
+            self._file.flush()
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+    def _pack_value(self, value):
+        if value is None:
+            return TYPE_NONE, bytes(8)
+        if isinstance(value, bool):
+            return TYPE_BOOL, INT_VALUE.pack(value)
+        if isinstance(value, int) and -(1 << 63) <= value < (1 << 63):
+            return TYPE_INT, INT_VALUE.pack(value)
+        if isinstance(value, (int, float)):
+            return TYPE_FLOAT, FLOAT_VALUE.pack(value)
+
+        value = str(value)
+        string_id = self._strings.get(value)
+        if string_id is None:
+            string_id = len(self._strings)
+            self._strings[value] = string_id
+            self._new_strings.append(value)
+        return TYPE_STRING, INT_VALUE.pack(string_id)
+
+    def _write_block(self, tag, count, payload):
+        self._file.write(BLOCK_HEADER.pack(tag, len(payload), count))
+        self._file.write(payload)
+
+    def _write_blocks(self):
+        if self._new_names:
+            payload = bytearray()
+            for signal_id, signal in self._new_names:
+                name = signal.encode('UTF-8')
+                payload += NAME_ENTRY.pack(signal_id, len(name)) + name
+            self._write_block(BLOCK_NAMES, len(self._new_names), payload)
+            self._new_names = []
+
+        if self._new_strings:
+            payload = bytearray()
+            for string in self._new_strings:
+                data = string.encode('UTF-8')
+                payload += STRING_ENTRY.pack(len(data)) + data
+            self._write_block(BLOCK_STRINGS, len(self._new_strings), payload)
+            self._new_strings = []
+
+        if self._count:
+            self._write_block(BLOCK_RECORDS, self._count,
+                              SEGMENT_HEADER.pack(self._first_time,
+                                                  self._last_time) +
+                              self._records)
+            self._records = bytearray()
+            self._count = 0
+            self._first_time = self._last_time = None
+
+
+class BinaryLogReader(object):
+    '''
+    Read the records of a binary log file, which is memory-mapped.
+
+    Records are numbered from 0 across all the segments of the file.  Their
+    times are expected to be sorted, as they are when logged by VSM, so a given
+    time can be found with a binary search.  A truncated last block, eg if VSM
+    was killed while writing it, is ignored.
+    '''
+
+    def __init__(self, filename):
+        self._file = open(filename, 'rb')
+        size = os.fstat(self._file.fileno()).st_size
+        self._map = b''
+        if size:
+            self._map = mmap.mmap(self._file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+
+        if size < FILE_HEADER.size or \
+                FILE_HEADER.unpack_from(self._map) != (MAGIC, VERSION):
+            self.close()
+            raise ValueError("'{}' is not a binary signal log".format(
+                filename))
+
+        self.names = {}
+        self._strings = []
+        # offset of the first record, number of the first record, number of
+        # records and time of the last record of each segment
+        self._segment_offsets = []
+        self._segment_starts = []
+        self._segment_counts = []
+        self._segment_last_times = []
+        self._count = 0
+        self._read_blocks(size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self._count
+
+    def close(self):
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+        self._file.close()
+
+    def record(self, index):
+        segment, offset = self._locate(index)
+        return self._decode(*RECORD.unpack_from(self._map, offset))
+
+    def records(self, start=0, end=None):
+        '''
+        Iterate over the records from number start up to number end.
+        '''
+        if end is None or end > self._count:
+            end = self._count
+        if start >= end:
+            return
+
+        segment, offset = self._locate(start)
+        remaining = end - start
+        while remaining > 0:
+            available = self._segment_starts[segment] + \
+                self._segment_counts[segment] - start
+            count = min(available, remaining)
+            data = self._map[offset:offset + count * RECORD.size]
+            for fields in RECORD.iter_unpack(data):
+                yield self._decode(*fields)
+
+            remaining -= count
+            start += count
+            segment += 1
+            if segment < len(self._segment_offsets):
+                offset = self._segment_offsets[segment]
+
+    def find_time(self, time_ms):
+        '''
+        Return the number of the first record logged at or after time_ms.
+        '''
+        segment = bisect.bisect_left(self._segment_last_times, time_ms)
+        if segment == len(self._segment_offsets):
+            return self._count
+
+        offset = self._segment_offsets[segment]
+        low, high = 0, self._segment_counts[segment]
+        while low < high:
+            middle = (low + high) // 2
+            record_time, = RECORD_TIME.unpack_from(
+                self._map, offset + middle * RECORD.size)
+            if record_time < time_ms:
+                low = middle + 1
+            else:
+                high = middle
+        return self._segment_starts[segment] + low
+
+    def records_between(self, start_ms=None, end_ms=None):
+        '''
+        Iterate over the records logged from start_ms until before end_ms.
+        '''
+        start = 0 if start_ms is None else self.find_time(start_ms)
+        end = None if end_ms is None else self.find_time(end_ms)
+        return self.records(start, end)
+
+    def _locate(self, index):
+        if not 0 <= index < self._count:
+            raise IndexError('record number out of range')
+        segment = bisect.bisect_right(self._segment_starts, index) - 1
+        offset = self._segment_offsets[segment] + \
+            (index - self._segment_starts[segment]) * RECORD.size
+        return segment, offset
+
+    def _decode(self, time_ms, signal_id, direction, value_type, raw):
+        if value_type == TYPE_STRING:
+            value = self._strings[INT_VALUE.unpack(raw)[0]]
+        elif value_type == TYPE_INT:
+            value = INT_VALUE.unpack(raw)[0]
+        elif value_type == TYPE_FLOAT:
+            value = FLOAT_VALUE.unpack(raw)[0]
+        elif value_type == TYPE_BOOL:
+            value = raw != bytes(8)
+        else:
+            value = None
+
+        signum = signal_id if signal_id < UNNUMBERED_BASE else None
+        return Record(time_ms, self.names[signal_id], signum,
+                      INDICATORS[direction], value)
+
+    def _read_blocks(self, size):
+        offset = FILE_HEADER.size
+        while offset + BLOCK_HEADER.size <= size:
+            tag, payload_size, count = BLOCK_HEADER.unpack_from(self._map,
+                                                                offset)
+            offset += BLOCK_HEADER.size
+            if offset + payload_size > size:
+                break
+
+            if tag == BLOCK_NAMES:
+                pos = offset
+                for _ in range(count):
+                    signal_id, length = NAME_ENTRY.unpack_from(self._map, pos)
+                    pos += NAME_ENTRY.size
+                    self.names[signal_id] = \
+                        bytes(self._map[pos:pos + length]).decode('UTF-8')
+                    pos += length
+            elif tag == BLOCK_STRINGS:
+                pos = offset
+                for _ in range(count):
+                    length, = STRING_ENTRY.unpack_from(self._map, pos)
+                    pos += STRING_ENTRY.size
+                    self._strings.append(
+                        bytes(self._map[pos:pos + length]).decode('UTF-8'))
+                    pos += length
+            elif tag == BLOCK_RECORDS:
+                _, last_time = SEGMENT_HEADER.unpack_from(self._map, offset)
+                self._segment_offsets.append(offset + SEGMENT_HEADER.size)
+                self._segment_starts.append(self._count)
+                self._segment_counts.append(count)
+                self._segment_last_times.append(last_time)
+                self._count += count
+
+            offset += payload_size
+
+
+def text_to_binary(text_filename, binary_filename):
+    '''
+    Convert the signal lines of a text log into a binary log and return the
+    number of converted signals.  Other lines, eg state dumps, are dropped.
+    '''
+    writer = BinaryLogWriter(binary_filename)
+    count = 0
+    with open(text_filename) as f:
+        for line in f:
+            record = parse_text_line(line)
+            if record:
+                writer.write(*record)
+                count += 1
+    writer.close()
+    return count
+
+
+def binary_to_text(binary_filename, text_filename):
+    '''
+    Convert a binary log into the signal lines of a text log and return the
+    number of converted signals.
+    '''
+    count = 0
+    with BinaryLogReader(binary_filename) as reader, \
+            open(text_filename, 'w') as f:
+        for record in reader.records():
+            f.write(format_record(record) + '\n')
+            count += 1
+    return count
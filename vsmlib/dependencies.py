@@ -0,0 +1,71 @@
+# Copyright (C) 2018 Jaguar Land Rover
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+'''
+Dependency graph of the signals emitted by the rules.
+
+A rule whose condition uses signal `a` and which emits signal `b` makes `b`
+depend on `a`.  When the emitted signals are processed by VSM itself rather
+than sent back by another process, they are processed in topological order of
+this graph: a signal is only processed once all the signals it depends on
+have been, so each signal is processed at most once per input signal.  This
+requires the graph to have no cycles, which are reported when the rules are
+loaded.
+'''
+
+import collections
+
+
+def rank_signals(dependencies):
+    '''
+    Return a dictionary with the topological rank of each signal of a graph,
+    given as a dictionary of the signals each signal depends on.  Lower
+    ranks are processed first.
+
+    Raise a ValueError naming the signals involved if the graph has a cycle.
+    '''
+    dependents = collections.defaultdict(set)
+    remaining = {}
+    for signal, signal_dependencies in dependencies.items():
+        remaining.setdefault(signal, 0)
+        for dependency in signal_dependencies:
+            remaining.setdefault(dependency, 0)
+            if signal not in dependents[dependency]:
+                dependents[dependency].add(signal)
+                remaining[signal] += 1
+
+    ranks = {}
+    ready = collections.deque(sorted(signal for signal, count in
+                                     remaining.items() if not count))
+    while ready:
+        signal = ready.popleft()
+        ranks[signal] = len(ranks)
+        for dependent in sorted(dependents[signal]):
+            remaining[dependent] -= 1
+            if not remaining[dependent]:
+                ready.append(dependent)
+
+    if len(ranks) < len(remaining):
+        cycle = _find_cycle({signal: dependents[signal] - ranks.keys()
+                             for signal in remaining if signal not in ranks})
+        raise ValueError("emitted signals depend on themselves: {}".format(
+            " -> ".join(cycle)))
+    return ranks
+
+
+def _find_cycle(dependents):
+    # every signal left has a dependency left, so following the dependencies
+    # backwards from any of them ends up going round a cycle
+    dependencies = collections.defaultdict(set)
+    for signal, signal_dependents in dependents.items():
+        for dependent in signal_dependents:
+            dependencies[dependent].add(signal)
+
+    path = [min(dependents)]
+    while path.count(path[-1]) < 2:
+        path.append(min(dependencies[path[-1]]))
+    start = path.index(path[-1])
+    return list(reversed(path[start:]))
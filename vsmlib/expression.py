@@ -0,0 +1,197 @@
+# Copyright (C) 2018 Jaguar Land Rover
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+'''
+Restricted compilation of the condition expressions.
+
+The condition expressions of the rules files, once translated to Python, are
+checked to only use the operators documented in rules.md: comparisons,
+arithmetic, `not`, `and`, `or` (`^^` is turned into `!=` beforehand), signal
+names, constants, the aggregate functions of vsmlib.windows and the temporal
+operators of vsmlib.temporal.  Anything else, like other function calls,
+attributes or subscripts, is rejected.
+
+The checked expression is then compiled into a function taking the dictionary
+of signal values, with each signal name turned into a lookup in it and no
+access to any global or built-in name.  Calling this function is much cheaper
+than eval() with a namespace built for each evaluation.  Each aggregate
+function call and each temporal operator is turned into a call to the
+function computing it, without arguments; the sub-expressions of the temporal
+operators are compiled separately.
+'''
+
+import ast
+import copy
+import vsmlib.temporal
+import vsmlib.windows
+
+ALLOWED_NODES = (
+    ast.Expression, ast.Name, ast.Load, ast.Constant,
+    ast.BoolOp, ast.And, ast.Or,
+    ast.UnaryOp, ast.Not, ast.USub, ast.UAdd,
+    ast.BinOp, ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod,
+    ast.Compare, ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE,
+    ast.Call,
+)
+CONSTANT_TYPES = (bool, int, float, str, type(None))
+
+# name of the argument of the compiled functions
+VARIABLES_ARG = 'variables'
+# prefix of the global names of the aggregate functions in compiled functions
+AGGREGATE_PREFIX = '_aggregate_'
+# prefix of the global names of the temporal operators in compiled functions
+TEMPORAL_PREFIX = '_temporal_'
+
+
+def aggregate_call(node):
+    '''
+    Return a (function name, signal name, window length in ms) tuple if an AST
+    node is a call to an aggregate function, eg `avg(speed, 2000)`, or None.
+    Raise a ValueError if it is another call or has invalid arguments.
+    '''
+    if not isinstance(node, ast.Call):
+        return None
+
+    if not isinstance(node.func, ast.Name) or \
+            node.func.id not in vsmlib.windows.AGGREGATE_FUNCTIONS:
+        raise ValueError("unsupported call in expression '{}'".format(
+            ast.unparse(node)))
+    if len(node.args) != 2 or node.keywords or \
+            not isinstance(node.args[0], ast.Name) or \
+            not isinstance(node.args[1], ast.Constant) or \
+            isinstance(node.args[1].value, bool) or \
+            not isinstance(node.args[1].value, (int, float)) or \
+            node.args[1].value <= 0:
+        raise ValueError("expected a signal and a window length in ms in "
+                         "'{}'".format(ast.unparse(node)))
+    return node.func.id, node.args[0].id, node.args[1].value
+
+
+def temporal_call(node):
+    '''
+    Return a (function name, sub-expression AST nodes, time in ms) tuple if
+    an AST node is a call to a temporal operator, eg `held(speed > 50, 2000)`,
+    or None.  Raise a ValueError if its arguments are invalid.
+    '''
+    if not isinstance(node, ast.Call) or \
+            not isinstance(node.func, ast.Name) or \
+            node.func.id not in vsmlib.temporal.TEMPORAL_FUNCTIONS:
+        return None
+
+    count = vsmlib.temporal.TEMPORAL_FUNCTIONS[node.func.id]
+    if len(node.args) != count + 1 or node.keywords or \
+            not isinstance(node.args[-1], ast.Constant) or \
+            isinstance(node.args[-1].value, bool) or \
+            not isinstance(node.args[-1].value, (int, float)) or \
+            node.args[-1].value <= 0:
+        raise ValueError("expected {} expression(s) and a time in ms in "
+                         "'{}'".format(count, ast.unparse(node)))
+    for child in ast.walk(ast.Tuple(node.args[:-1], ast.Load())):
+        if isinstance(child, ast.Call) and \
+                isinstance(child.func, ast.Name) and \
+                child.func.id in vsmlib.temporal.TEMPORAL_FUNCTIONS:
+            raise ValueError("temporal operators can't be nested in "
+                             "'{}'".format(ast.unparse(node)))
+    return node.func.id, node.args[:-1], node.args[-1].value
+
+
+def signal_names(expr):
+    '''
+    Return the signal names used in an expression AST node, in order.
+    '''
+    functions = set()
+    names = []
+    for node in ast.walk(expr):
+        if isinstance(node, ast.Call):
+            functions.add(node.func)
+        elif isinstance(node, ast.Name) and node not in functions:
+            names.append(node.id)
+    return list(dict.fromkeys(names))
+
+
+def check(expr):
+    '''
+    Raise a ValueError if an expression AST node uses anything else than the
+    operators, signal names and constants supported in conditions.
+    '''
+    for node in ast.walk(expr):
+        if not isinstance(node, ALLOWED_NODES):
+            raise ValueError("unsupported {} in expression '{}'".format(
+                type(node).__name__, ast.unparse(expr)))
+        if temporal_call(node) is None:
+            aggregate_call(node)
+        if isinstance(node, ast.Constant) and \
+                not isinstance(node.value, CONSTANT_TYPES):
+            raise ValueError("unsupported constant {!r} in expression "
+                             "'{}'".format(node.value, ast.unparse(expr)))
+
+
+class _NameLookup(ast.NodeTransformer):
+
+    def __init__(self, names, aggregate, temporal):
+        self.names = names
+        self.aggregate = aggregate
+        self.temporal = temporal
+        self.functions = {}
+
+    def _temporal_call(self, node, function, args, length_ms):
+        if self.temporal is None:
+            raise ValueError("temporal operators are not supported in "
+                             "expression '{}'".format(ast.unparse(node)))
+        expressions = [compile_expression(arg, self.names, self.aggregate)
+                       for arg in args]
+        signals = [self.names.get(name, name)
+                   for name in signal_names(ast.Tuple(args, ast.Load()))]
+        name = TEMPORAL_PREFIX + str(len(self.functions))
+        self.functions[name] = self.temporal(function, expressions, signals,
+                                             length_ms)
+        call = ast.Call(ast.Name(name, ast.Load()), [], [])
+        return ast.copy_location(call, node)
+
+    def visit_Call(self, node):
+        temporal = temporal_call(node)
+        if temporal:
+            return self._temporal_call(node, *temporal)
+
+        function, signal, length_ms = aggregate_call(node)
+        if self.aggregate is None:
+            raise ValueError("aggregate functions are not supported in "
+                             "expression '{}'".format(ast.unparse(node)))
+        name = AGGREGATE_PREFIX + str(len(self.functions))
+        self.functions[name] = self.aggregate(
+            function, self.names.get(signal, signal), length_ms)
+        call = ast.Call(ast.Name(name, ast.Load()), [], [])
+        return ast.copy_location(call, node)
+
+    def visit_Name(self, node):
+        key = ast.Constant(self.names.get(node.id, node.id))
+        lookup = ast.Subscript(ast.Name(VARIABLES_ARG, ast.Load()), key,
+                               ast.Load())
+        return ast.copy_location(lookup, node)
+
+
+def compile_expression(expr, names=None, aggregate=None, temporal=None):
+    '''
+    Compile an expression AST node into a function returning its value for a
+    dictionary of signal values, and raising KeyError if a signal it uses
+    isn't set.
+
+    The optional `names` dictionary maps the names used in the expression to
+    the keys of the signal values, eg 'car_backup' to 'car.backup'.  The
+    `aggregate` function is called with the function name, signal name and
+    window length of each aggregate function call, and returns the function
+    to call instead.  Likewise, the `temporal` function is called with the
+    operator name, the compiled sub-expressions, the signals they use and the
+    time of each temporal operator (see vsmlib.temporal.operator()).
+    '''
+    check(expr)
+    lookup = _NameLookup(names or {}, aggregate, temporal)
+    body = lookup.visit(copy.deepcopy(expr))
+    args = ast.arguments(posonlyargs=[], args=[ast.arg(VARIABLES_ARG)],
+                         kwonlyargs=[], kw_defaults=[], defaults=[])
+    tree = ast.fix_missing_locations(ast.Expression(ast.Lambda(args, body)))
+    code = compile(tree, '<condition>', 'eval')
+    return eval(code, dict(lookup.functions, __builtins__={}))
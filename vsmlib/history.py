@@ -0,0 +1,164 @@
+# Copyright (C) 2018 Jaguar Land Rover
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+'''
+In-memory history of the signal values.
+
+The history keeps the last values of each signal along with the time they were
+set at, up to a maximum number of values per signal, so its memory use is
+bounded.  The values of a signal are kept in a ring buffer which only grows up
+to that size: numbers are stored in arrays of doubles, 8 bytes per value and
+as many per time, and the values of signals which have been set to anything
+else than a number in lists.
+
+The history can be queried for the last values of a signal or for the values
+set during a range of time.  The times are in ms, from the same clock as the
+logs, and are expected not to go backwards.
+'''
+
+import array
+import bisect
+
+SIZE_DEFAULT = 1000
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+class _Ring(object):
+    '''
+    Values and times of a signal, the oldest one at `start` once full.
+    '''
+
+    def __init__(self, size, numeric):
+        self.size = size
+        self.start = 0
+        self.times = array.array('d')
+        self.values = array.array('d') if numeric else []
+
+    @property
+    def numeric(self):
+        return isinstance(self.values, array.array)
+
+    def __len__(self):
+        return len(self.times)
+
+    def append(self, time_ms, value):
+        if self.numeric and not _is_number(value):
+            # keep the numbers read so far, as floats
+            self.values = list(self.values)
+
+        if len(self.times) < self.size:
+            self.times.append(time_ms)
+            self.values.append(value)
+        else:
+            self.times[self.start] = time_ms
+            self.values[self.start] = value
+            self.start = (self.start + 1) % self.size
+
+    def time(self, position):
+        '''
+        Return the time of a value, from position 0 for the oldest one.
+        '''
+        return self.times[(self.start + position) % len(self.times)]
+
+    def slice(self, begin, end):
+        '''
+        Return the (time, value) tuples between two positions.
+        '''
+        count = len(self.times)
+        return [(self.times[(self.start + i) % count],
+                 self.values[(self.start + i) % count])
+                for i in range(begin, end)]
+
+
+class _Times(object):
+    # sequence of the times of a ring, from the oldest, for bisect
+
+    def __init__(self, ring):
+        self._ring = ring
+
+    def __len__(self):
+        return len(self._ring)
+
+    def __getitem__(self, position):
+        return self._ring.time(position)
+
+
+class HistoryStore(object):
+    '''
+    History of the values of the signals, keeping up to `size` values for each
+    signal.  The `sizes` dictionary overrides it for some signals, 0 meaning
+    that the history of a signal isn't kept.
+    '''
+
+    def __init__(self, size=SIZE_DEFAULT, sizes=None):
+        self.size = size
+        self.sizes = dict(sizes or {})
+        self._rings = {}
+
+    def record(self, signal, value, time_ms):
+        '''
+        Add a value of a signal to the history.
+        '''
+        ring = self._rings.get(signal)
+        if ring is None:
+            size = self.sizes.get(signal, self.size)
+            if not size:
+                return
+            ring = _Ring(size, _is_number(value))
+            self._rings[signal] = ring
+        ring.append(time_ms, value)
+
+    def signals(self):
+        '''
+        Return the names of the signals with a history.
+        '''
+        return list(self._rings)
+
+    def last(self, signal, count=None):
+        '''
+        Return the last `count` (time, value) tuples of a signal, or all of
+        them, oldest first.
+        '''
+        ring = self._rings.get(signal)
+        if ring is None:
+            return []
+        if count is None or count > len(ring):
+            count = len(ring)
+        return ring.slice(len(ring) - count, len(ring))
+
+    def range(self, signal, start_ms=None, end_ms=None):
+        '''
+        Return the (time, value) tuples of a signal set between two times,
+        included, oldest first.  Either may be None for no limit.
+        '''
+        ring = self._rings.get(signal)
+        if ring is None:
+            return []
+        times = _Times(ring)
+        begin = 0
+        end = len(ring)
+        if start_ms is not None:
+            begin = bisect.bisect_left(times, start_ms)
+        if end_ms is not None:
+            end = bisect.bisect_right(times, end_ms)
+        return ring.slice(begin, max(begin, end))
+
+    def memory(self):
+        '''
+        Return the approximate number of bytes used by the values and times.
+        '''
+        total = 0
+        for ring in self._rings.values():
+            total += ring.times.itemsize * len(ring.times)
+            if ring.numeric:
+                total += ring.values.itemsize * len(ring.values)
+            else:
+                # only the references, the values may be shared
+                total += 8 * len(ring.values)
+        return total
@@ -0,0 +1,163 @@
+# Copyright (C) 2018 Jaguar Land Rover
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import collections
+import datetime
+import glob
+import gzip
+import os
+import queue
+import re
+import shutil
+import threading
+import time
+
+BACKUPS_DEFAULT = 5
+
+# suffix of the rotated log files, which sorts them by age
+ROTATED_SUFFIX_FORMAT = '%Y%m%d-%H%M%S-%f'
+ROTATED_SUFFIX_PATTERN = re.compile(r'\.\d{8}-\d{6}-\d{6}(\.gz)?$')
+
+
+class RotatingLogFile(object):
+    '''
+    Log file which is rotated when it reaches a size or an age.
+
+    The current log is always written to `path`.  When it is rotated, it is
+    renamed with a timestamp suffix and, if `compress` is set, compressed with
+    gzip in a background thread.  Only the `backups` most recent rotated files
+    are kept (all of them if it is 0).
+
+    Data is expected to be written in complete lines, so a line is never split
+    across two files.
+    '''
+
+    def __init__(self, path, max_size=0, interval_s=0,
+                 backups=BACKUPS_DEFAULT, compress=False):
+        self.path = path
+        self.max_size = max_size
+        self.interval_s = interval_s
+        self.backups = backups
+        self._compress_queue = None
+        self._compress_thread = None
+        if compress:
+            self._compress_queue = queue.Queue()
+            self._compress_thread = threading.Thread(target=self._compress_run)
+            self._compress_thread.start()
+        self._open()
+
+    def write(self, data):
+        if self._size and self._should_rotate(len(data)):
+            self._rotate()
+        self._file.write(data)
+        self._size += len(data)
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+        if self._compress_thread:
+            self._compress_queue.put(None)
+            self._compress_thread.join()
+
+    def _open(self):
+        self._file = open(self.path, 'wb')
+        self._size = 0
+        self._open_time = time.monotonic()
+
+    def _should_rotate(self, length):
+        if self.max_size and self._size + length > self.max_size:
+            return True
+        return self.interval_s and \
+            time.monotonic() - self._open_time >= self.interval_s
+
+    def _rotate(self):
+        self._file.close()
+        rotated = '{}.{}'.format(
+            self.path, datetime.datetime.now().strftime(ROTATED_SUFFIX_FORMAT))
+        os.replace(self.path, rotated)
+        self._open()
+
+        if self._compress_queue:
+            self._compress_queue.put(rotated)
+        else:
+            self._remove_old()
+
+    def _compress_run(self):
+        while True:
+            rotated = self._compress_queue.get()
+            if rotated is None:
+                break
+            try:
+                with open(rotated, 'rb') as f_in, \
+                        gzip.open(rotated + '.gz', 'wb') as f_out:
+                    shutil.copyfileobj(f_in, f_out)
+                os.remove(rotated)
+            except OSError:
+                # keep the uncompressed file rather than lose it
+                pass
+            self._remove_old()
+
+    def _remove_old(self):
+        if not self.backups:
+            return
+
+        rotated = sorted(f for f in glob.glob(glob.escape(self.path) + '.*')
+                         if ROTATED_SUFFIX_PATTERN.search(f))
+        for f in rotated[:-self.backups]:
+            try:
+                os.remove(f)
+            except OSError:
+                pass
+
+
+class RingBufferLog(object):
+    '''
+    Keep the last `max_size` bytes of log lines in memory, and only write them
+    to the output when dump() is called, eg after an error.
+    '''
+
+    def __init__(self, output, max_size):
+        self.output = output
+        self.max_size = max_size
+        self._chunks = collections.deque()
+        self._size = 0
+
+    def write(self, data):
+        self._chunks.append(data)
+        self._size += len(data)
+
+        while self._size > self.max_size:
+            excess = self._size - self.max_size
+            first = self._chunks[0]
+            if len(first) <= excess:
+                self._chunks.popleft()
+                self._size -= len(first)
+                continue
+
+            # drop the oldest lines of the chunk, up to a line boundary
+            cut = first.find(b'\n', excess - 1) + 1
+            if cut == 0:
+                cut = len(first)
+            self._chunks[0] = first[cut:]
+            self._size -= cut
+            if not self._chunks[0]:
+                self._chunks.popleft()
+
+    def dump(self):
+        for chunk in self._chunks:
+            self.output.write(chunk)
+        self.output.flush()
+        self._chunks.clear()
+        self._size = 0
+
+    def flush(self):
+        # nothing is written until the next dump
+        pass
+
+    def close(self):
+        self.output.close()
@@ -0,0 +1,212 @@
+# Copyright (C) 2018 Jaguar Land Rover
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import json
+import queue
+import socket
+import threading
+import vsmlib.binlog
+
+SINK_FILE = 'file'
+SINK_JSON = 'json'
+SINK_UNIX = 'unix'
+SINK_UDP = 'udp'
+SINK_KINDS = (SINK_FILE, SINK_JSON, SINK_UNIX, SINK_UDP)
+
+QUEUE_SIZE_DEFAULT = 256
+
+# datagrams are filled with complete lines up to this size
+DATAGRAM_SIZE_MAX = 8192
+SEND_TIMEOUT_S = 1.0
+
+
+def line_to_json(line):
+    '''
+    Convert a text log line to a JSON object, with the signal fields split out
+    for signal lines.
+    '''
+    text = line.decode('UTF-8', 'replace').rstrip('\n')
+    record = vsmlib.binlog.parse_text_line(text)
+    if record is None:
+        return json.dumps({'message': text})
+
+    return json.dumps({
+        'time': record.time_ms,
+        'direction': 'in' if record.indicator == '>' else 'out',
+        'signal': record.signal,
+        'signum': record.signum,
+        'value': record.value,
+    }, default=repr)
+
+
+def to_json_lines(data):
+    return b''.join((line_to_json(line) + '\n').encode('UTF-8')
+                    for line in data.splitlines() if line)
+
+
+class LogSink(object):
+    '''
+    Destination of the log lines, besides the log file.
+
+    put() only queues a batch of complete lines and returns straight away.  A
+    worker thread writes them with write(), joining whatever has accumulated
+    in the meantime into a single batch, so each sink batches at its own pace.
+    When the queue is full, the batch is dropped for this sink only: a slow
+    sink never holds up the log pipe, the other sinks or the rule evaluation.
+    '''
+
+    def __init__(self, name, queue_size=QUEUE_SIZE_DEFAULT):
+        self.name = name
+        self.dropped = 0
+        self.errors = 0
+        self._queue = queue.Queue(queue_size)
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def put(self, data):
+        try:
+            self._queue.put_nowait(data)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        '''
+        Write the pending lines and stop the worker.
+        '''
+        self._queue.put(None)
+        self._worker.join()
+
+    def write(self, data):
+        raise NotImplementedError
+
+    def finish(self):
+        pass
+
+    def _run(self):
+        done = False
+        while not done:
+            batch = [self._queue.get()]
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            if None in batch:
+                done = True
+                batch = batch[:batch.index(None)]
+            if not batch:
+                continue
+
+            try:
+                self.write(b''.join(batch))
+            except OSError:
+                self.errors += 1
+        self.finish()
+
+
+class FileSink(LogSink):
+    '''
+    Write the log lines to another file, as they are.
+    '''
+
+    def __init__(self, path, queue_size=QUEUE_SIZE_DEFAULT):
+        self._file = open(path, 'wb')
+        super().__init__('{}:{}'.format(SINK_FILE, path), queue_size)
+
+    def write(self, data):
+        self._file.write(data)
+        self._file.flush()
+
+    def finish(self):
+        self._file.close()
+
+
+class JsonLinesSink(FileSink):
+    '''
+    Write the log lines to a file as JSON objects, one per line.
+    '''
+
+    def __init__(self, path, queue_size=QUEUE_SIZE_DEFAULT):
+        super().__init__(path, queue_size)
+        self.name = '{}:{}'.format(SINK_JSON, path)
+
+    def write(self, data):
+        super().write(to_json_lines(data))
+
+
+class DatagramSink(LogSink):
+    '''
+    Send the log lines as JSON objects to a Unix or UDP datagram socket, eg a
+    local log collector.  Each datagram holds as many complete lines as fit.
+    Nothing is buffered if the collector isn't there: the lines are lost.
+    '''
+
+    def __init__(self, family, address, queue_size=QUEUE_SIZE_DEFAULT):
+        self._address = address
+        self._socket = socket.socket(family, socket.SOCK_DGRAM)
+        self._socket.settimeout(SEND_TIMEOUT_S)
+        kind = SINK_UNIX if family == socket.AF_UNIX else SINK_UDP
+        super().__init__('{}:{}'.format(kind, address), queue_size)
+
+    def write(self, data):
+        datagram = b''
+        for line in to_json_lines(data).splitlines(keepends=True):
+            if datagram and len(datagram) + len(line) > DATAGRAM_SIZE_MAX:
+                self._send(datagram)
+                datagram = b''
+            datagram += line
+        if datagram:
+            self._send(datagram)
+
+    def finish(self):
+        self._socket.close()
+
+    def _send(self, datagram):
+        try:
+            self._socket.sendto(datagram, self._address)
+        except OSError:
+            self.errors += 1
+
+
+def parse_spec(spec):
+    '''
+    Split a KIND:TARGET sink specification, raising ValueError if it is not
+    valid.
+    '''
+    kind, _, target = spec.partition(':')
+    if kind not in SINK_KINDS or not target:
+        raise ValueError("invalid log sink '{}', expected one of {} followed "
+                         "by ':' and a path or address".format(
+                             spec, ', '.join(SINK_KINDS)))
+
+    if kind == SINK_UDP:
+        host, _, port = target.rpartition(':')
+        try:
+            return kind, (host or 'localhost', int(port))
+        except ValueError:
+            raise ValueError("invalid UDP address '{}', expected "
+                             "[HOST:]PORT".format(target))
+    return kind, target
+
+
+def create(spec, queue_size=QUEUE_SIZE_DEFAULT):
+    '''
+    Create a sink from its KIND:TARGET specification:
+
+    * file:PATH       write the log lines to another file
+    * json:PATH       write the log lines to a file in the JSON-lines format
+    * unix:PATH       send JSON lines to a Unix datagram socket
+    * udp:[HOST:]PORT send JSON lines to a UDP socket
+    '''
+    kind, target = parse_spec(spec)
+    if kind == SINK_FILE:
+        return FileSink(target, queue_size)
+    if kind == SINK_JSON:
+        return JsonLinesSink(target, queue_size)
+    if kind == SINK_UNIX:
+        return DatagramSink(socket.AF_UNIX, target, queue_size)
+    return DatagramSink(socket.AF_INET, target, queue_size)
@@ -0,0 +1,343 @@
+# Copyright (C) 2018 Jaguar Land Rover
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import ast
+import copy
+import operator
+import vsmlib.expression
+
+BINARY_OPERATORS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod,
+    ast.Pow: operator.pow,
+}
+
+UNARY_OPERATORS = {
+    ast.Not: operator.not_,
+    ast.USub: operator.neg,
+    ast.UAdd: operator.pos,
+}
+
+COMPARE_OPERATORS = {
+    ast.Eq: operator.eq,
+    ast.NotEq: operator.ne,
+    ast.Lt: operator.lt,
+    ast.LtE: operator.le,
+    ast.Gt: operator.gt,
+    ast.GtE: operator.ge,
+}
+
+# comparison operator to use when swapping its operands
+SWAPPED_COMPARE_OPERATORS = {
+    ast.Eq: ast.Eq,
+    ast.NotEq: ast.NotEq,
+    ast.Lt: ast.Gt,
+    ast.LtE: ast.GtE,
+    ast.Gt: ast.Lt,
+    ast.GtE: ast.LtE,
+}
+
+
+# largest result of a folded multiplication or power, in bits for integers and
+# in items for sequences, so that folding can't exhaust the memory or the time
+MAX_FOLDED_SIZE = 4096
+
+
+def _size(value):
+    if isinstance(value, bool):
+        return 1
+    if isinstance(value, int):
+        return value.bit_length()
+    if isinstance(value, (str, bytes, tuple)):
+        return len(value)
+    return 1
+
+
+def _folded_size_ok(op, left, right):
+    '''
+    Return whether the result of a multiplication or a power of constants
+    stays within MAX_FOLDED_SIZE, without computing it.
+    '''
+    if isinstance(op, ast.Mult):
+        if isinstance(left, int) and not isinstance(right, int):
+            left, right = right, left
+        if isinstance(right, int) and \
+                isinstance(left, (str, bytes, tuple)):
+            return len(left) * max(right, 0) <= MAX_FOLDED_SIZE
+        return _size(left) + _size(right) <= MAX_FOLDED_SIZE
+    if isinstance(op, ast.Pow):
+        if isinstance(left, int) and isinstance(right, int) and right > 0:
+            return _size(left) * right <= MAX_FOLDED_SIZE
+    return True
+
+
+def _is_constant(node):
+    return isinstance(node, ast.Constant)
+
+
+class ConstantFolder(ast.NodeTransformer):
+    '''
+    Replace the arithmetic and comparison sub-expressions which only have
+    constant operands by their value.  Only the operators allowed in condition
+    expressions are folded, and not the multiplications or powers whose result
+    would be too large.
+    '''
+
+    def __init__(self):
+        self.folded = 0
+
+    def _constant(self, node, value):
+        self.folded += 1
+        return ast.copy_location(ast.Constant(value), node)
+
+    def visit_BinOp(self, node):
+        self.generic_visit(node)
+        func = BINARY_OPERATORS.get(type(node.op))
+        if func and \
+                isinstance(node.op, vsmlib.expression.ALLOWED_NODES) and \
+                _is_constant(node.left) and _is_constant(node.right) and \
+                _folded_size_ok(node.op, node.left.value, node.right.value):
+            try:
+                return self._constant(node, func(node.left.value,
+                                                 node.right.value))
+            except Exception:
+                # leave it to fail at run-time, like without optimization
+                pass
+        return node
+
+    def visit_UnaryOp(self, node):
+        self.generic_visit(node)
+        func = UNARY_OPERATORS.get(type(node.op))
+        if func and \
+                isinstance(node.op, vsmlib.expression.ALLOWED_NODES) and \
+                _is_constant(node.operand):
+            try:
+                return self._constant(node, func(node.operand.value))
+            except Exception:
+                pass
+        return node
+
+    def visit_Compare(self, node):
+        self.generic_visit(node)
+        operands = [node.left] + node.comparators
+        funcs = [COMPARE_OPERATORS.get(type(op)) for op in node.ops]
+        if all(funcs) and all(_is_constant(o) for o in operands):
+            try:
+                result = all(func(a.value, b.value) for func, a, b in
+                             zip(funcs, operands, operands[1:]))
+                return self._constant(node, result)
+            except Exception:
+                pass
+        return node
+
+
+class RuleOptimizer(object):
+    '''
+    Optimize the condition expressions of a rules file.
+
+    Each condition expression goes through the following passes:
+
+    * constant sub-expressions are folded, eg `x > (88 - 10) * 1.6` becomes
+      `x > 124.8`
+    * boolean operations are flattened and simplified, duplicate operands are
+      removed and operands which are constant in a boolean context are dropped;
+      the other operands keep their order, as the first ones may guard the
+      evaluation of the next ones, eg `a != 'off' and a > 3`
+    * identical expressions are compiled once and the function is shared, so
+      it only needs to be evaluated once per signal update
+
+    Conditions which can never be true, because they fold to a false constant
+    or compare a signal to disjoint ranges or values, are detected as well.
+
+    Every change is recorded as a human-readable message in `changes`.
+    '''
+
+    def __init__(self):
+        self.changes = []
+        self._expressions = {}
+
+    def optimize(self, expr, label):
+        '''
+        Return an optimized copy of the `expr` expression AST node.
+
+        The `label` is used in the messages recorded for this expression.
+        '''
+        folder = ConstantFolder()
+        expr = folder.visit(copy.deepcopy(expr))
+        if folder.folded:
+            self.changes.append("{}: folded {} constant sub-expression(s)"
+                                .format(label, folder.folded))
+
+        before = ast.dump(expr)
+        expr = self._simplify(expr, label)
+        if ast.dump(expr) != before:
+            self.changes.append("{}: simplified to '{}'".format(
+                label, ast.unparse(expr)))
+
+        return ast.fix_missing_locations(expr)
+
+    def compile(self, expr, label, names=None, aggregate=None, temporal=None):
+        '''
+        Compile an expression with vsmlib.expression.compile_expression() or
+        return the same function as an identical expression which has already
+        been compiled.  The `aggregate` function must return the same
+        function for the same arguments, and the temporal operators of the
+        expression are shared along with it.
+        '''
+        key = (ast.dump(expr), tuple(sorted((names or {}).items())))
+        if key in self._expressions:
+            self.changes.append("{}: shared expression '{}'".format(
+                label, ast.unparse(expr)))
+        else:
+            self._expressions[key] = \
+                vsmlib.expression.compile_expression(expr, names, aggregate,
+                                                     temporal)
+        return self._expressions[key]
+
+    def never_true(self, expr):
+        '''
+        Return True if the expression can't evaluate to true.
+        '''
+        if _is_constant(expr):
+            return not expr.value
+
+        if isinstance(expr, ast.BoolOp):
+            if isinstance(expr.op, ast.Or):
+                return all(self.never_true(v) for v in expr.values)
+            return any(self.never_true(v) for v in expr.values) or \
+                self._contradiction(expr.values)
+
+        if isinstance(expr, ast.Compare):
+            return self._contradiction([expr])
+
+        return False
+
+    def _simplify(self, expr, label):
+        '''
+        Simplify an expression evaluated in a boolean context.
+        '''
+        if isinstance(expr, ast.UnaryOp) and isinstance(expr.op, ast.Not):
+            expr.operand = self._simplify(expr.operand, label)
+            if _is_constant(expr.operand):
+                return ast.copy_location(
+                    ast.Constant(not expr.operand.value), expr)
+            return expr
+
+        if not isinstance(expr, ast.BoolOp):
+            return expr
+
+        is_and = isinstance(expr.op, ast.And)
+        values = []
+        seen = set()
+        for value in expr.values:
+            value = self._simplify(value, label)
+            # flatten nested operations of the same kind
+            if isinstance(value, ast.BoolOp) and \
+                    type(value.op) is type(expr.op):
+                sub_values = value.values
+            else:
+                sub_values = [value]
+
+            for sub_value in sub_values:
+                if _is_constant(sub_value):
+                    if bool(sub_value.value) != is_and:
+                        # short-circuits the whole operation
+                        return ast.copy_location(
+                            ast.Constant(not is_and), expr)
+                    continue
+
+                key = ast.dump(sub_value)
+                if key in seen:
+                    continue
+                seen.add(key)
+                values.append(sub_value)
+
+        if not values:
+            return ast.copy_location(ast.Constant(is_and), expr)
+        if len(values) == 1:
+            return values[0]
+
+        expr.values = values
+        return expr
+
+    def _contradiction(self, values):
+        '''
+        Check whether a conjunction of comparisons between signals and constants
+        can't be satisfied.
+        '''
+        bounds = {}
+
+        for value in values:
+            if not isinstance(value, ast.Compare) or len(value.ops) != 1:
+                continue
+
+            op = type(value.ops[0])
+            left, right = value.left, value.comparators[0]
+            if _is_constant(left) and isinstance(right, ast.Name):
+                left, right = right, left
+                op = SWAPPED_COMPARE_OPERATORS.get(op)
+            if op not in COMPARE_OPERATORS or \
+                    not isinstance(left, ast.Name) or not _is_constant(right):
+                continue
+
+            bound = bounds.setdefault(left.id, {'eq': set(), 'ne': set(),
+                                                'ranges': []})
+            constant = right.value
+            if op is ast.Eq:
+                bound['eq'].add(constant)
+            elif op is ast.NotEq:
+                bound['ne'].add(constant)
+            else:
+                bound['ranges'].append((COMPARE_OPERATORS[op], constant))
+
+        for bound in bounds.values():
+            if len(bound['eq']) > 1:
+                return True
+
+            for constant in bound['eq']:
+                if constant in bound['ne']:
+                    return True
+                try:
+                    if not all(func(constant, limit) for func, limit in
+                               bound['ranges']):
+                        return True
+                except TypeError:
+                    pass
+
+            if self._empty_range(bound['ranges']):
+                return True
+
+        return False
+
+    def _empty_range(self, ranges):
+        low = high = None
+        low_strict = high_strict = False
+
+        try:
+            for func, limit in ranges:
+                if func in (operator.gt, operator.ge):
+                    strict = func is operator.gt
+                    if low is None or limit > low or \
+                            (limit == low and strict):
+                        low, low_strict = limit, strict
+                else:
+                    strict = func is operator.lt
+                    if high is None or limit < high or \
+                            (limit == high and strict):
+                        high, high_strict = limit, strict
+
+            if low is None or high is None:
+                return False
+            if low > high:
+                return True
+            return low == high and (low_strict or high_strict)
+        except TypeError:
+            # not comparable, eg mixing numbers and strings
+            return False
@@ -0,0 +1,197 @@
+# Copyright (C) 2018 Jaguar Land Rover
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+'''
+Index of the conditions comparing a single signal to a constant.
+
+Rules files often have many conditions like `vehicle.speed > 50` or
+`transmission.gear == 'reverse'` on the same signal.  Instead of evaluating
+all of them each time the signal changes, their constants are indexed: the
+thresholds of the range comparisons in sorted lists, one for each operator,
+and the constants of the equality comparisons in hash buckets.
+
+When the signal changes from an old to a new value, the conditions which are
+false for both values are skipped: only those which are true for the new
+value, or were true for the old one and become false, are selected.  They are
+found by bisecting the sorted thresholds for both values and by looking up
+the buckets of both values.  The other conditions of the signal are always
+selected, as long as they are subscribed to it.
+'''
+
+import ast
+import bisect
+
+# the value of a signal which hasn't been set yet
+UNSET = object()
+
+OP_EQ = '=='
+OP_GT = '>'
+OP_GE = '>='
+OP_LT = '<'
+OP_LE = '<='
+THRESHOLD_OPS = (OP_GT, OP_GE, OP_LT, OP_LE)
+
+COMPARE_OPS = {
+    ast.Eq: OP_EQ,
+    ast.Gt: OP_GT,
+    ast.GtE: OP_GE,
+    ast.Lt: OP_LT,
+    ast.LtE: OP_LE,
+}
+
+# operator to use when the constant is on the left-hand side
+SWAPPED_OPS = {
+    OP_EQ: OP_EQ,
+    OP_GT: OP_LT,
+    OP_GE: OP_LE,
+    OP_LT: OP_GT,
+    OP_LE: OP_GE,
+}
+
+
+def _is_number(value):
+    return isinstance(value, (int, float))
+
+
+def match(expr):
+    '''
+    Return an (operator, constant) tuple if an expression AST node compares a
+    single signal name to a constant in a way which can be indexed, or None.
+    '''
+    if not isinstance(expr, ast.Compare) or len(expr.ops) != 1:
+        return None
+
+    op = COMPARE_OPS.get(type(expr.ops[0]))
+    left, right = expr.left, expr.comparators[0]
+    if isinstance(left, ast.Constant) and isinstance(right, ast.Name):
+        left, right = right, left
+        op = SWAPPED_OPS.get(op)
+    if op is None or not isinstance(left, ast.Name) or \
+            not isinstance(right, ast.Constant):
+        return None
+
+    constant = right.value
+    if op in THRESHOLD_OPS:
+        # the order of other types, eg strings, is left to the evaluation
+        if not _is_number(constant):
+            return None
+    else:
+        try:
+            hash(constant)
+        except TypeError:
+            return None
+    return op, constant
+
+
+class _SignalIndex(object):
+
+    def __init__(self, rules, predicates):
+        # position of each rule, to select them in their original order
+        self.positions = {rule: i for i, rule in enumerate(rules)}
+        self.indexed = set()
+        self.unindexed = []
+        self.buckets = {}
+        self.thresholds = {op: ([], []) for op in THRESHOLD_OPS}
+
+        entries = {op: [] for op in THRESHOLD_OPS}
+        for rule in rules:
+            predicate = predicates.get(rule)
+            if predicate is None:
+                self.unindexed.append(rule)
+                continue
+            self.indexed.add(rule)
+            op, constant = predicate
+            if op == OP_EQ:
+                self.buckets.setdefault(constant, []).append(rule)
+            else:
+                entries[op].append((constant, self.positions[rule], rule))
+
+        self.has_thresholds = any(entries.values())
+        for op, op_entries in entries.items():
+            op_entries.sort(key=lambda entry: entry[:2])
+            constants, op_rules = self.thresholds[op]
+            constants.extend(entry[0] for entry in op_entries)
+            op_rules.extend(entry[2] for entry in op_entries)
+
+    def _true_range(self, op, value):
+        '''
+        Return the (start, end) range of the thresholds of an operator which
+        are true for a value.
+        '''
+        constants = self.thresholds[op][0]
+        if op == OP_GT:
+            return 0, bisect.bisect_left(constants, value)
+        if op == OP_GE:
+            return 0, bisect.bisect_right(constants, value)
+        if op == OP_LT:
+            return bisect.bisect_right(constants, value), len(constants)
+        return bisect.bisect_left(constants, value), len(constants)
+
+    def select(self, old, new):
+        selected = list(self.unindexed)
+
+        for value in (new, old) if old != new else (new,):
+            selected.extend(self.buckets.get(value, ()))
+
+        for op, (constants, op_rules) in self.thresholds.items():
+            if not constants:
+                continue
+            new_start, new_end = self._true_range(op, new)
+            old_start, old_end = self._true_range(op, old)
+            # the true thresholds are a prefix or a suffix, so the union of
+            # both values is too
+            selected.extend(op_rules[min(new_start, old_start):
+                                     max(new_end, old_end)])
+
+        selected.sort(key=self.positions.__getitem__)
+        return selected
+
+
+class PredicateIndex(object):
+    '''
+    Select the rules to execute when a signal changes.
+
+    `rules` maps each signal to the list of rules using it, in the order they
+    are executed, and `predicates` maps the rules which only compare one signal
+    to a constant to their (operator, constant) tuple, as returned by match().
+    The indexed rules must always be subscribed to their signal.
+    '''
+
+    def __init__(self, rules, predicates):
+        self.indexed = 0
+        self._signals = {}
+        for signal, signal_rules in rules.items():
+            if any(rule in predicates for rule in signal_rules):
+                self._signals[signal] = _SignalIndex(signal_rules, predicates)
+                self.indexed += len(self._signals[signal].indexed)
+
+    def subscribe(self, signal, rules):
+        '''
+        Set the rules currently subscribed to a signal, of which the ones which
+        aren't indexed are selected each time it changes.
+        '''
+        index = self._signals.get(signal)
+        if index is not None:
+            index.unindexed = [rule for rule in rules
+                               if rule not in index.indexed]
+
+    def select(self, signal, rules, old, new):
+        '''
+        Return the rules of a signal to execute when it changes from the old
+        to the new value.  All the rules are returned the first time the
+        signal is set, or when a value can't be compared to the thresholds.
+        '''
+        index = self._signals.get(signal)
+        if index is None or old is UNSET:
+            return rules
+        if index.has_thresholds and \
+                not (_is_number(old) and _is_number(new)):
+            return rules
+        try:
+            return index.select(old, new)
+        except TypeError:
+            # unhashable value
+            return rules
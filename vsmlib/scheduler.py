@@ -0,0 +1,151 @@
+# Copyright (C) 2018 Jaguar Land Rover
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+'''
+Shared scheduler of the functions to call at a given time.
+
+Rather than a thread or a `threading.Timer` for each pending deadline, the
+deadlines are kept in a heap and a single thread waits for the earliest one,
+so each of them only costs a heap entry.  Cancelled deadlines are left in the
+heap and skipped once they are due, unless most of the heap is cancelled, in
+which case it is rebuilt.
+'''
+
+import heapq
+import itertools
+import threading
+import traceback
+
+# minimum size of the heap to rebuild it without its cancelled deadlines
+COMPACT_MIN = 64
+
+
+def _print_error(err):
+    traceback.print_exception(type(err), err, err.__traceback__)
+
+
+class Deadline(object):
+    '''
+    Function to call at a time, as returned by DeadlineScheduler.schedule().
+    '''
+
+    def __init__(self, time_ms, function, args):
+        self.time_ms = time_ms
+        self.function = function
+        self.args = args
+
+    @property
+    def cancelled(self):
+        return self.function is None
+
+
+class DeadlineScheduler(object):
+    '''
+    Call functions once the time returned by `clock`, in ms, reaches their
+    deadline.  They are called from the thread of the scheduler, which is
+    only started when the first deadline is scheduled, unless `threaded` is
+    False, in which case run_due() must be called instead.  The exceptions
+    raised by the functions called from the thread are passed to `error`,
+    which prints their traceback by default, and the thread carries on.
+    '''
+
+    def __init__(self, clock, threaded=True, error=None):
+        self.clock = clock
+        self.threaded = threaded
+        self.error = error or _print_error
+        self._heap = []
+        self._cancelled = 0
+        # breaks the ties between identical deadlines, in scheduling order
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def __len__(self):
+        '''
+        Return the number of deadlines which haven't been cancelled.
+        '''
+        with self._condition:
+            return len(self._heap) - self._cancelled
+
+    def schedule(self, time_ms, function, *args):
+        '''
+        Call a function with some arguments at a time, and return the
+        Deadline to pass to cancel().
+        '''
+        deadline = Deadline(time_ms, function, args)
+        with self._condition:
+            heapq.heappush(self._heap, (time_ms, next(self._counter),
+                                        deadline))
+            # the thread may be waiting for a later deadline
+            if self._heap[0][2] is deadline:
+                self._condition.notify()
+            if self.threaded and self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        return deadline
+
+    def cancel(self, deadline):
+        '''
+        Cancel a deadline if its function hasn't been called yet.
+        '''
+        with self._condition:
+            if deadline.cancelled:
+                return
+            deadline.function = None
+            deadline.args = None
+            self._cancelled += 1
+            if self._cancelled > len(self._heap) // 2 and \
+                    len(self._heap) >= COMPACT_MIN:
+                self._heap = [entry for entry in self._heap
+                              if not entry[2].cancelled]
+                heapq.heapify(self._heap)
+                self._cancelled = 0
+
+    def _pop_due(self, now_ms):
+        # the next deadline which is due and wasn't cancelled, or None
+        while self._heap and self._heap[0][0] <= now_ms:
+            deadline = heapq.heappop(self._heap)[2]
+            if deadline.cancelled:
+                self._cancelled -= 1
+                continue
+            function, args = deadline.function, deadline.args
+            deadline.function = None
+            deadline.args = None
+            return function, args
+        return None
+
+    def run_due(self):
+        '''
+        Call the functions whose deadline is due, and return how many.
+        '''
+        count = 0
+        while True:
+            with self._condition:
+                due = self._pop_due(self.clock())
+            if due is None:
+                return count
+            function, args = due
+            function(*args)
+            count += 1
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    now_ms = self.clock()
+                    due = self._pop_due(now_ms)
+                    if due is not None:
+                        break
+                    timeout = None
+                    if self._heap:
+                        timeout = (self._heap[0][0] - now_ms) / 1000
+                    self._condition.wait(timeout)
+            # called without the lock so the function may schedule others
+            function, args = due
+            try:
+                function(*args)
+            except Exception as err:
+                self.error(err)
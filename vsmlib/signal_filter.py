@@ -0,0 +1,107 @@
+# Copyright (C) 2018 Jaguar Land Rover
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import threading
+
+
+def _is_number(value):
+    # bool is a subclass of int but a discrete value, so never filter it
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+class SignalFilter(object):
+    '''
+    Reduce the rate of a high-frequency input signal.
+
+    Values are passed to push() as they are received and only some of them are
+    passed on to the callback:
+
+    * interval: at most one value is processed every `interval_ms`
+                milliseconds; values received in between are coalesced and only
+                the latest one is processed at the end of the interval
+    * deadband: a numerical value is only processed if it differs by at least
+                `deadband` from the last processed value
+
+    Non-numerical values are never suppressed by the deadband, so discrete
+    signals keep their semantics.
+
+    The end of an interval is a deadline on a shared
+    vsmlib.scheduler.DeadlineScheduler, whose clock gives the time in ms, so
+    the latest value is processed from the thread of the scheduler.
+    '''
+
+    def __init__(self, signal, callback, scheduler, interval_ms=0,
+                 deadband=None):
+        self.signal = signal
+        self.interval_ms = interval_ms
+        self.deadband = deadband
+        self.received = 0
+        self.processed = 0
+        self._callback = callback
+        self._scheduler = scheduler
+        self._lock = threading.Lock()
+        self._last_time = None
+        self._last_value = None
+        self._pending = None
+        self._deadline = None
+
+    def push(self, value):
+        with self._lock:
+            self.received += 1
+            now = self._scheduler.clock()
+
+            if self._deadline:
+                self._pending = value
+                return
+
+            if self._last_time is not None and self.interval_ms and \
+                    now - self._last_time < self.interval_ms:
+                self._pending = value
+                self._deadline = self._scheduler.schedule(
+                        self._last_time + self.interval_ms,
+                        self._timeout_func)
+                return
+
+            deliver = self._accept(value, now)
+
+        if deliver:
+            self._callback(self.signal, value)
+
+    def cancel(self):
+        with self._lock:
+            if self._deadline:
+                self._scheduler.cancel(self._deadline)
+                self._deadline = None
+
+    def stats(self):
+        return {'received': self.received, 'processed': self.processed}
+
+    def _accept(self, value, now):
+        '''
+        Decide whether a value is processed; must be called with the lock.
+        '''
+        if self.deadband is not None and _is_number(value) and \
+                _is_number(self._last_value) and \
+                abs(value - self._last_value) < self.deadband:
+            return False
+
+        self._last_time = now
+        self._last_value = value
+        self.processed += 1
+        return True
+
+    def _timeout_func(self):
+        with self._lock:
+            # cancelled since the deadline was reached
+            if self._deadline is None:
+                return
+            self._deadline = None
+            value = self._pending
+            self._pending = None
+            deliver = self._accept(value, self._scheduler.clock())
+
+        if deliver:
+            self._callback(self.signal, value)
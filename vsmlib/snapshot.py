@@ -0,0 +1,58 @@
+# Copyright (C) 2018 Jaguar Land Rover
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import hashlib
+import marshal
+import os
+
+SNAPSHOT_MAGIC = b'VSMS'
+SNAPSHOT_VERSION = 1
+
+
+def file_digest(filename):
+    '''
+    Return a digest of a file's contents, to check a snapshot was taken with
+    the same rules file.
+    '''
+    with open(filename, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def write(filename, snapshot):
+    '''
+    Write a snapshot dictionary to a file.
+
+    The snapshot may only contain built-in types (dict, list, tuple, str,
+    numbers, booleans and None).  It is first written to a temporary file which
+    then replaces the previous snapshot, so a crash while writing it doesn't
+    corrupt the last good snapshot.
+    '''
+    data = SNAPSHOT_MAGIC + bytes([SNAPSHOT_VERSION]) + marshal.dumps(snapshot)
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_filename, filename)
+
+
+def read(filename):
+    '''
+    Read a snapshot from a file and return it or None if it is not valid.
+    '''
+    try:
+        with open(filename, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return None
+
+    header_len = len(SNAPSHOT_MAGIC) + 1
+    if data[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC or \
+            len(data) < header_len or data[header_len - 1] != SNAPSHOT_VERSION:
+        return None
+
+    try:
+        return marshal.loads(data[header_len:])
+    except (EOFError, ValueError, TypeError):
+        return None
@@ -0,0 +1,110 @@
+# Copyright (C) 2018 Jaguar Land Rover
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+'''
+Detection of the input signals which stop being received.
+
+Each monitored signal has a timeout: when it hasn't been received for that
+long, it is stale until it is received again.  Receiving a signal only records
+the time it was received at, in constant time: each signal has a single
+deadline on a shared vsmlib.scheduler.DeadlineScheduler, which is only moved
+when it is reached, to the time the signal was last received plus its
+timeout.  A signal received steadily thus costs a heap operation per timeout
+period rather than per value, however often it is received.
+'''
+
+import threading
+
+# suffix of the name of the signal raised when a signal times out
+TIMEOUT_SUFFIX = '_timeout'
+
+
+def timeout_signal(signal):
+    '''
+    Return the name of the signal raised when a signal times out.
+    '''
+    return signal + TIMEOUT_SUFFIX
+
+
+class StalenessMonitor(object):
+    '''
+    Call `timed_out` with the name of each signal which hasn't been received
+    for longer than its timeout, from the thread of the scheduler and with
+    `lock` held.  Signals which have never been received time out as well,
+    counting from when their timeout was set.
+    '''
+
+    def __init__(self, clock, scheduler, timed_out, lock=None):
+        self.clock = clock
+        self.scheduler = scheduler
+        self.timed_out = timed_out
+        self.lock = lock or threading.RLock()
+        # timeout of each signal in ms, and when it was last received
+        self.timeouts = {}
+        self.stale = set()
+        self._received_ms = {}
+        self._deadlines = {}
+
+    def set_timeouts(self, timeouts):
+        '''
+        Set the timeout of each monitored signal, keeping track of the time
+        the signals which were already monitored were last received.
+        '''
+        with self.lock:
+            now_ms = self.clock()
+            for signal in list(self._received_ms):
+                if signal not in timeouts:
+                    deadline = self._deadlines.pop(signal, None)
+                    if deadline:
+                        self.scheduler.cancel(deadline)
+                    del self._received_ms[signal]
+                    self.stale.discard(signal)
+
+            for signal, timeout_ms in timeouts.items():
+                self._received_ms.setdefault(signal, now_ms)
+                if signal in self._deadlines:
+                    # moved to its new time when reached
+                    if timeout_ms >= self.timeouts[signal]:
+                        continue
+                    self.scheduler.cancel(self._deadlines[signal])
+                if signal not in self.stale:
+                    self._schedule(signal,
+                                   self._received_ms[signal] + timeout_ms)
+            self.timeouts = dict(timeouts)
+
+    def received(self, signal):
+        '''
+        Record that a signal was received, and return whether it was stale.
+        '''
+        if signal not in self.timeouts:
+            return False
+        with self.lock:
+            now_ms = self.clock()
+            self._received_ms[signal] = now_ms
+            if signal not in self.stale:
+                return False
+            self.stale.discard(signal)
+            self._schedule(signal, now_ms + self.timeouts[signal])
+            return True
+
+    def _schedule(self, signal, time_ms):
+        self._deadlines[signal] = self.scheduler.schedule(time_ms,
+                                                          self._expired,
+                                                          signal)
+
+    def _expired(self, signal):
+        with self.lock:
+            # the timeout may have just been removed
+            if self._deadlines.get(signal) is None:
+                return
+            deadline_ms = self._received_ms[signal] + self.timeouts[signal]
+            if deadline_ms > self.clock():
+                # received since the deadline was scheduled
+                self._schedule(signal, deadline_ms)
+                return
+            del self._deadlines[signal]
+            self.stale.add(signal)
+            self.timed_out(signal)
@@ -0,0 +1,257 @@
+# Copyright (C) 2018 Jaguar Land Rover
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+'''
+Table of the current signal values in shared memory.
+
+VSM writes the value of each signal to a file mapped in memory, typically in
+/dev/shm, so other processes can read the current state directly instead of
+subscribing to the signals or parsing the logs.
+
+The file starts with a header followed by one fixed-size slot for each signal
+of the signal number file, in signal number order, then by the names and
+numbers of the signals of each slot.  Each slot holds a sequence counter, the
+time of the last update, the value type and the value itself.  The counter is
+odd while the slot is being written, so readers retry until they have read the
+slot with the same even counter before and after it (a seqlock): the writer
+serializes its updates, which may come from several threads of VSM, and
+readers never block it.
+
+Strings longer than the space in a slot are truncated.
+'''
+
+import mmap
+import os
+import struct
+import threading
+import time
+
+MAGIC = b'VSMT'
+VERSION = 1
+
+HEADER = struct.Struct('<4sB3xII')
+GENERATION = struct.Struct('<I')
+GENERATION_OFFSET = HEADER.size
+SLOTS_OFFSET = GENERATION_OFFSET + GENERATION.size
+SLOT_SIZE = 64
+SEQUENCE = struct.Struct('<I')
+SLOT_FIELDS = struct.Struct('<IBxH')
+SLOT_HEADER = struct.Struct('<I' + SLOT_FIELDS.format[1:])
+VALUE_SIZE = SLOT_SIZE - SLOT_HEADER.size
+NAME_ENTRY = struct.Struct('<IH')
+INT_VALUE = struct.Struct('<q')
+FLOAT_VALUE = struct.Struct('<d')
+
+TYPE_UNSET = 0
+TYPE_NONE = 1
+TYPE_BOOL = 2
+TYPE_INT = 3
+TYPE_FLOAT = 4
+TYPE_STRING = 5
+
+# spin this many times on a slot being written before giving up
+READ_RETRIES_MAX = 10000
+
+
+def _encode(value):
+    if value is None:
+        return TYPE_NONE, b''
+    if isinstance(value, bool):
+        return TYPE_BOOL, bytes([value])
+    if isinstance(value, int) and -(1 << 63) <= value < (1 << 63):
+        return TYPE_INT, INT_VALUE.pack(value)
+    if isinstance(value, float):
+        return TYPE_FLOAT, FLOAT_VALUE.pack(value)
+    data = str(value).encode('UTF-8')[:VALUE_SIZE]
+    return TYPE_STRING, data
+
+
+def _decode(value_type, data):
+    if value_type == TYPE_BOOL:
+        return bool(data[0])
+    if value_type == TYPE_INT:
+        return INT_VALUE.unpack(data)[0]
+    if value_type == TYPE_FLOAT:
+        return FLOAT_VALUE.unpack(data)[0]
+    if value_type == TYPE_STRING:
+        return data.decode('UTF-8', 'ignore')
+    return None
+
+
+class StateTableWriter(object):
+    '''
+    Create a state table with a slot for each signal of a signal name to
+    number dictionary, and update it.  Signals without a number are ignored.
+
+    The table is first written to a temporary file and then renamed, so
+    readers never see a partial table.  It is left in place when closed.
+    The methods updating it may be called from several threads.
+    '''
+
+    def __init__(self, path, signal_to_num):
+        signals = sorted(signal_to_num.items(), key=lambda item: item[1])
+        self._slots = {signal: i for i, (signal, _) in enumerate(signals)}
+        self._sequences = [0] * len(signals)
+        self._generation = 0
+        # the seqlock only supports one update of a slot at a time
+        self._lock = threading.Lock()
+
+        names = b''.join(NAME_ENTRY.pack(num, len(name.encode('UTF-8'))) +
+                         name.encode('UTF-8') for name, num in signals)
+        names_offset = SLOTS_OFFSET + len(signals) * SLOT_SIZE
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, len(signals), names_offset))
+            f.write(bytes(names_offset - HEADER.size))
+            f.write(names)
+        os.replace(tmp_path, path)
+
+        self._file = open(path, 'r+b')
+        self._mmap = mmap.mmap(self._file.fileno(), 0)
+
+    def set(self, signal, value, time_ms=0):
+        '''
+        Update the value of a signal, returning whether it has a slot.
+        '''
+        with self._lock:
+            return self._set(signal, value, time_ms)
+
+    def update(self, values, time_ms=0):
+        '''
+        Update the values of several signals from a dictionary.
+        '''
+        with self._lock:
+            for signal, value in values.items():
+                self._set(signal, value, time_ms)
+
+    def _set(self, signal, value, time_ms):
+        index = self._slots.get(signal)
+        if index is None:
+            return False
+
+        value_type, data = _encode(value)
+        offset = SLOTS_OFFSET + index * SLOT_SIZE
+        sequence = self._sequences[index] + 1
+        SEQUENCE.pack_into(self._mmap, offset, sequence)
+        SLOT_FIELDS.pack_into(self._mmap, offset + SEQUENCE.size,
+                              time_ms & 0xffffffff, value_type, len(data))
+        data_offset = offset + SLOT_HEADER.size
+        self._mmap[data_offset:data_offset + len(data)] = data
+        self._sequences[index] = sequence + 1
+        SEQUENCE.pack_into(self._mmap, offset, sequence + 1)
+
+        self._generation = (self._generation + 1) & 0xffffffff
+        GENERATION.pack_into(self._mmap, GENERATION_OFFSET, self._generation)
+        return True
+
+    def close(self):
+        self._mmap.close()
+        self._file.close()
+
+
+class StateTableReader(object):
+    '''
+    Read the current signal values from a state table.
+
+        with StateTableReader('/dev/shm/vsm-state') as table:
+            gear = table.get('transmission.gear')
+    '''
+
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        try:
+            self._mmap = mmap.mmap(self._file.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+        except ValueError:
+            self._file.close()
+            raise ValueError("not a state table: '{}'".format(path))
+
+        magic, version, count, names_offset = \
+            HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError("not a state table: '{}'".format(path))
+
+        self.signals = {}
+        self.signal_numbers = {}
+        offset = names_offset
+        for index in range(count):
+            num, length = NAME_ENTRY.unpack_from(self._mmap, offset)
+            offset += NAME_ENTRY.size
+            name = self._mmap[offset:offset + length].decode('UTF-8')
+            offset += length
+            self.signals[name] = index
+            self.signal_numbers[num] = index
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._mmap.close()
+        self._file.close()
+
+    @property
+    def generation(self):
+        '''
+        Counter incremented on each update, to check whether anything changed.
+        '''
+        return GENERATION.unpack_from(self._mmap, GENERATION_OFFSET)[0]
+
+    def read(self, signal):
+        '''
+        Return a (value, time in ms) tuple for a signal name or number, or
+        None if the signal hasn't been set or isn't in the table.
+        '''
+        if isinstance(signal, int):
+            index = self.signal_numbers.get(signal)
+        else:
+            index = self.signals.get(signal)
+        if index is None:
+            return None
+        return self._read_slot(index)
+
+    def get(self, signal, default=None):
+        '''
+        Return the value of a signal name or number, or default if it isn't
+        set.
+        '''
+        entry = self.read(signal)
+        return default if entry is None else entry[0]
+
+    def values(self):
+        '''
+        Return a dictionary with the value of all the signals which are set.
+        Each value is consistent, but the table as a whole may be updated
+        while it is read.
+        '''
+        values = {}
+        for signal, index in self.signals.items():
+            entry = self._read_slot(index)
+            if entry is not None:
+                values[signal] = entry[0]
+        return values
+
+    def _read_slot(self, index):
+        offset = SLOTS_OFFSET + index * SLOT_SIZE
+        data_offset = offset + SLOT_HEADER.size
+        for retry in range(READ_RETRIES_MAX):
+            sequence, time_ms, value_type, length = \
+                SLOT_HEADER.unpack_from(self._mmap, offset)
+            if sequence & 1 == 0:
+                data = self._mmap[data_offset:data_offset + length]
+                if SEQUENCE.unpack_from(self._mmap, offset)[0] == sequence:
+                    if value_type == TYPE_UNSET:
+                        return None
+                    return _decode(value_type, data), time_ms
+            if retry % 100 == 99:
+                # let the writer finish if it was interrupted
+                time.sleep(0)
+        raise TimeoutError("state table slot {} is not being updated "
+                           "consistently".format(index))
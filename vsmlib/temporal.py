@@ -0,0 +1,127 @@
+# Copyright (C) 2018 Jaguar Land Rover
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+'''
+Temporal operators of the condition expressions.
+
+Conditions may use `held(expr, ms)`, which is true once `expr` has been true
+for at least `ms` milliseconds in a row, and `within(a, b, ms)`, which is true
+while `b` is true if it became true at most `ms` milliseconds after `a` last
+became true.
+
+Each operator keeps track of when its sub-expressions became true: it is
+updated each time one of their signals is set, whether or not the condition
+using it is evaluated then.  `within` only changes when its signals are set,
+but `held` becomes true on its own once its time has elapsed: it then schedules
+a deadline on a shared vsmlib.scheduler.DeadlineScheduler, and calls back to
+have its conditions evaluated when it is reached.
+'''
+
+# number of sub-expressions of each operator, before the time in ms
+TEMPORAL_FUNCTIONS = {'held': 1, 'within': 2}
+
+
+def _evaluate(expression, variables):
+    try:
+        return bool(expression(variables))
+    except KeyError:
+        # a signal isn't set yet
+        return False
+
+
+class Held(object):
+    '''
+    Whether an expression has been true for at least `length_ms`.  The
+    `expired` function is called with this object once it has.
+    '''
+
+    def __init__(self, expression, signals, length_ms, clock, scheduler,
+                 expired):
+        self.expression = expression
+        self.signals = signals
+        self.length_ms = length_ms
+        self.clock = clock
+        self.scheduler = scheduler
+        self.expired = expired
+        # when the expression became true, or None while it is false
+        self.since_ms = None
+        self._deadline = None
+
+    def update(self, variables):
+        '''
+        Evaluate the expression after one of its signals was set.
+        '''
+        if _evaluate(self.expression, variables):
+            if self.since_ms is None:
+                self.since_ms = self.clock()
+                self._deadline = self.scheduler.schedule(
+                    self.since_ms + self.length_ms, self.expired, self)
+        elif self.since_ms is not None:
+            self.since_ms = None
+            self.scheduler.cancel(self._deadline)
+            self._deadline = None
+
+    def __call__(self):
+        return self.since_ms is not None and \
+                self.clock() - self.since_ms >= self.length_ms
+
+
+class Within(object):
+    '''
+    Whether the second expression is true and became true at most
+    `length_ms` after the first one last became true.
+    '''
+
+    def __init__(self, first, second, signals, length_ms, clock):
+        self.first = first
+        self.second = second
+        self.signals = signals
+        self.length_ms = length_ms
+        self.clock = clock
+        # when each expression last became true, and whether it still is
+        self.first_ms = None
+        self.second_ms = None
+        self._first_true = False
+        self._second_true = False
+
+    def update(self, variables):
+        '''
+        Evaluate both expressions after one of their signals was set.
+        '''
+        now_ms = None
+        first_true = _evaluate(self.first, variables)
+        if first_true and not self._first_true:
+            now_ms = self.clock()
+            self.first_ms = now_ms
+        self._first_true = first_true
+
+        second_true = _evaluate(self.second, variables)
+        if second_true and not self._second_true:
+            self.second_ms = now_ms if now_ms is not None else self.clock()
+        self._second_true = second_true
+
+    def __call__(self):
+        return self._second_true and self.first_ms is not None and \
+                self.first_ms <= self.second_ms <= \
+                self.first_ms + self.length_ms
+
+
+def operator(function, expressions, signals, length_ms, clock, scheduler,
+             expired):
+    '''
+    Return the object computing a temporal operator, given the functions
+    evaluating its sub-expressions for a dictionary of signal values and the
+    signals they use.  It must be updated with the signal values each time one
+    of these signals is set, and returns the value of the operator when called
+    without arguments.
+    '''
+    if function == 'held':
+        return Held(expressions[0], signals, length_ms, clock, scheduler,
+                    expired)
+    if function == 'within':
+        return Within(expressions[0], expressions[1], signals, length_ms,
+                      clock)
+    raise ValueError("unknown temporal operator '{}'".format(function))
@@ -1,4 +1,17 @@
-def parse_signal_num_file(filename):
+import sys
+
+# optional field of the signal number file lines with the timeout of a signal
+TIMEOUT_FIELD = 'timeout='
+
+
+def parse_signal_num_file(filename, timeouts=None):
+    '''
+    Parse a signal number file, made of its version number followed by a
+    'signal number' line for each signal, and return the number of each signal
+    and the version.  A line may end with 'timeout=MS' to detect when the
+    signal stops being received, these timeouts are added to the optional
+    `timeouts` dictionary.
+    '''
     signal_to_num = {}
     vsi_version = -1
     try:
@@ -16,10 +29,20 @@ def parse_signal_num_file(filename):
                         exit(1)
                 else:
                     try:
-                        signal, signum_str = line_stripped.split(" ")
-                        signal = signal.strip()
-                        signum = int(signum_str.strip())
+                        signal, signum_str, *options = line_stripped.split()
+                        signum = int(signum_str)
+                        timeout_ms = None
+                        for option in options:
+                            if not option.startswith(TIMEOUT_FIELD):
+                                raise ValueError("unknown field '{}'".format(
+                                    option))
+                            timeout_ms = int(option[len(TIMEOUT_FIELD):])
+                            if timeout_ms <= 0:
+                                raise ValueError("invalid timeout '{}'"
+                                                 .format(option))
                         signal_to_num[signal] = signum
+                        if timeout_ms and timeouts is not None:
+                            timeouts[signal] = timeout_ms
                     except ValueError as err:
                         print("malformed signal number file line: line: {}: " \
                                 "{}".format(line, err), file=sys.stderr)
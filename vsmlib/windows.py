@@ -0,0 +1,174 @@
+# Copyright (C) 2018 Jaguar Land Rover
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+'''
+Aggregates of the recent values of a signal, for the condition expressions.
+
+Conditions may use `avg(signal, ms)`, `min(signal, ms)`, `max(signal, ms)`,
+`delta(signal, ms)` and `count(signal, ms)` to aggregate the values a signal
+was set to in the last `ms` milliseconds.  The values of each aggregated
+signal are kept in a fixed-size ring buffer along with their time, so a
+window can't hold more than its last `capacity` values.
+
+Each window length of a signal keeps its aggregates up to date as values are
+added and expire, rather than going through the whole window each time: a
+running sum for the average, and monotonic queues of the values which may
+still become the minimum or the maximum.  Only numbers are aggregated, other
+values are only counted.  When no value was set during a window, the
+aggregates are those of the current value.
+'''
+
+import collections
+
+AGGREGATE_FUNCTIONS = ('avg', 'min', 'max', 'delta', 'count')
+CAPACITY_DEFAULT = 1024
+
+
+def _is_number(value):
+    return isinstance(value, (int, float))
+
+
+class _Window(object):
+
+    def __init__(self, ring, length_ms):
+        self._ring = ring
+        self.length_ms = length_ms
+        # sequence number of the oldest value in the window
+        self.start = max(ring.total - ring.capacity, 0)
+        self.sum = 0
+        self.numbers = 0
+        # sequence numbers of the values which are smaller, or larger, than all
+        # the values after them in the window
+        self.mins = collections.deque()
+        self.maxs = collections.deque()
+        for seq in range(self.start, ring.total):
+            self.add(seq, ring.value(seq))
+
+    def add(self, seq, value):
+        if not _is_number(value):
+            return
+        self.sum += value
+        self.numbers += 1
+        values = self._ring.values
+        capacity = self._ring.capacity
+        while self.mins and values[self.mins[-1] % capacity] >= value:
+            self.mins.pop()
+        self.mins.append(seq)
+        while self.maxs and values[self.maxs[-1] % capacity] <= value:
+            self.maxs.pop()
+        self.maxs.append(seq)
+
+    def expire(self, end_seq, time_limit_ms=None):
+        '''
+        Remove the values before a sequence number, or older than a time.
+        '''
+        ring = self._ring
+        while self.start < ring.total:
+            index = self.start % ring.capacity
+            if self.start >= end_seq and (time_limit_ms is None or
+                                          ring.times[index] >= time_limit_ms):
+                break
+            value = ring.values[index]
+            if _is_number(value):
+                self.sum -= value
+                self.numbers -= 1
+                if self.mins[0] == self.start:
+                    self.mins.popleft()
+                if self.maxs[0] == self.start:
+                    self.maxs.popleft()
+            self.start += 1
+
+    def _update(self):
+        self.expire(0, self._ring.clock() - self.length_ms)
+
+    def avg(self):
+        self._update()
+        if not self.numbers:
+            return self._ring.last()
+        return self.sum / self.numbers
+
+    def min(self):
+        self._update()
+        if not self.mins:
+            return self._ring.last()
+        return self._ring.value(self.mins[0])
+
+    def max(self):
+        self._update()
+        if not self.maxs:
+            return self._ring.last()
+        return self._ring.value(self.maxs[0])
+
+    def delta(self):
+        self._update()
+        last = self._ring.last()
+        if self.start >= self._ring.total - 1:
+            return 0
+        first = self._ring.value(self.start)
+        if not (_is_number(first) and _is_number(last)):
+            return 0
+        return last - first
+
+    def count(self):
+        self._update()
+        return self._ring.total - self.start
+
+
+class SignalWindow(object):
+    '''
+    Ring buffer of the last values of a signal and of the time they were set
+    at, as returned by `clock`, in ms.
+    '''
+
+    def __init__(self, clock, capacity=CAPACITY_DEFAULT):
+        self.clock = clock
+        self.capacity = capacity
+        self.times = [0] * capacity
+        self.values = [None] * capacity
+        # number of values ever added, the sequence number of the next one
+        self.total = 0
+        self._windows = {}
+
+    def append(self, value, time_ms=None):
+        if time_ms is None:
+            time_ms = self.clock()
+
+        # the oldest value is about to be overwritten
+        if self.total >= self.capacity:
+            for window in self._windows.values():
+                window.expire(self.total - self.capacity + 1)
+
+        index = self.total % self.capacity
+        self.times[index] = time_ms
+        self.values[index] = value
+        for window in self._windows.values():
+            window.add(self.total, value)
+        self.total += 1
+
+    def value(self, seq):
+        return self.values[seq % self.capacity]
+
+    def last(self):
+        '''
+        Return the current value, raising a KeyError if there is none.
+        '''
+        if not self.total:
+            raise KeyError('no value')
+        return self.value(self.total - 1)
+
+    def aggregate(self, function, length_ms):
+        '''
+        Return a function without arguments computing an aggregate of the
+        values in the last length_ms.
+        '''
+        if function not in AGGREGATE_FUNCTIONS:
+            raise ValueError("unknown aggregate function '{}'".format(
+                function))
+        window = self._windows.get(length_ms)
+        if window is None:
+            window = _Window(self, length_ms)
+            self._windows[length_ms] = window
+        return getattr(window, function)